@@ -0,0 +1,349 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+import cv2
+import numpy as np
+from metrics import metrics
+from ollama_stub_server import StubOllamaServer
+
+# Offline end-to-end benchmark: synthetic receipts (laid out like the ones in bill_image/)
+# go through the real cleaning, OCR, parsing and insertion code, while the LLM is
+# replaced by the local stub server. Stage latencies come from the metrics spans.
+# Each path runs in its own process so peak RSS, metrics and the caches/databases
+# (all created in a temporary directory) are per path.
+
+PATHS = ("batch", "single")
+EXTRACTION_MODES = ("single", "two-call")
+STAGES = ("clean", "ocr", "extract", "categorize", "insert")
+
+VENDORS = ["CLASSIC Fast Food", "Sharma General Store", "City Cab Services", "Blue Bottle Cafe", "Metro Utilities"]
+ITEMS = [
+    "ONION RAVA SADA", "GARLIC CHATNI", "PAV BHAJI", "CHEESE PAV BHAJI", "VEG PULAV", "FRESH LIME SODA",
+    "CHAAS", "MASALA DOSA", "COLD COFFEE", "RICE 5KG", "TOOR DAL", "CAB FARE", "TOLL CHARGES", "ELECTRICITY",
+]
+
+
+def generate_bill(index: int, rng: np.random.Generator, width: int = 768, noise: float = 8.0,
+                  min_items: int = 3, max_items: int = 10):
+    """
+    Draws one receipt: vendor header, date and bill number, a Particulars/Qty/Rate/Amount
+    table and the totals, on tinted paper with Gaussian noise of the given sigma.
+    Returns (BGR image, ground truth dict).
+    """
+    scale = width / 768
+    items = [
+        (ITEMS[rng.integers(len(ITEMS))], int(rng.integers(1, 5)), int(rng.integers(2, 50)) * 5)
+        for _ in range(int(rng.integers(min_items, max_items + 1)))
+    ]
+    line_height = int(34 * scale)
+    height = int((330 + 34 * len(items) + 200) * scale)
+    image = np.full((height, width, 3), (236, 240, 226), np.uint8)
+
+    def text(value, x, y, size=0.75, thickness=2):
+        cv2.putText(image, value, (int(x * scale), int(y)), cv2.FONT_HERSHEY_SIMPLEX, size * scale, (40, 40, 40),
+                    max(1, round(thickness * scale)), cv2.LINE_AA)
+
+    vendor = VENDORS[index % len(VENDORS)]
+    invoice_no = str(20000 + index)
+    issue_date = f"{int(rng.integers(1, 13)):02d}/{int(rng.integers(1, 29)):02d}/2024"
+    y = 60 * scale
+    text(vendor.upper(), 200, y, 1.1, 3)
+    text("465, Mehta Building, Matunga", 150, y + line_height)
+    text("------------ Tax Invoice ------------", 40, y + 2 * line_height)
+    text(f"Date : {issue_date}      Bill No. : {invoice_no}", 30, y + 3 * line_height)
+    text("Particulars               Qty   Rate  Amount", 30, y + 5 * line_height)
+    y += 6 * line_height
+    for description, quantity, rate in items:
+        text(f"{description:<24}", 30, y)
+        text(f"{quantity:>3}   {rate:>4}   {quantity * rate:>5}", 430, y)
+        y += line_height
+    total = sum(quantity * rate for _, quantity, rate in items)
+    text(f"Sub Total : {total:.2f}", 330, y + line_height)
+    text(f"Total : {total}", 400, y + 2 * line_height, 0.9, 3)
+
+    if noise:
+        image = np.clip(image + rng.normal(0, noise, image.shape), 0, 255).astype(np.uint8)
+    truth = {
+        "invoice_no": invoice_no,
+        "issue_date": issue_date,
+        "billed_by": vendor,
+        "description": [description for description, _, _ in items],
+        "ammount": [quantity * rate for _, quantity, rate in items],
+        "grand_total": total,
+    }
+    return image, truth
+
+
+def write_bills(folder: str, count: int, width: int = 768, noise: float = 8.0, seed: int = 0) -> list[dict]:
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    truths = []
+    for index in range(count):
+        image, truth = generate_bill(index, rng, width, noise)
+        cv2.imwrite(os.path.join(folder, f"bill_{index:04d}.png"), image)
+        truths.append(truth)
+    return truths
+
+
+# --- stub LLM ---
+
+_ITEM_LINE = re.compile(r"^\s*([A-Za-z][A-Za-z0-9 ().&-]*?)\s+(\d+)\s+(\d+)\s+(\d+)\s*$", re.MULTILINE)
+
+
+def stub_responder(payload: dict) -> str:
+    """Answers the agents' prompts (both extraction modes) from the OCR text they contain."""
+    prompt = payload.get("prompt", "")
+    if "Service Descriptions to categorize:" in prompt:
+        section = prompt.split("Service Descriptions to categorize:", 1)[1]
+        return json.dumps(["food" for line in section.splitlines() if line.startswith("- ")])
+
+    if "Raw Invoice text to analyze:" in prompt:
+        text = prompt.split("Raw Invoice text to analyze:", 1)[1]
+        items = _ITEM_LINE.findall(text) or [("Unknown item", "1", "0", "0")]
+        invoice = re.search(r"Bill\s*No\.?\s*:?\s*(\d+)", text)
+        date = re.search(r"\d{2}/\d{2}/\d{2,4}", text)
+        fields = {
+            # OCR misses still need a unique invoice number per bill
+            "invoice_no": invoice.group(1) if invoice else f"unread-{hashlib.sha1(text.encode('utf-8')).hexdigest()[:10]}",
+            "issue_date": date.group(0) if date else "",
+            "billed_to": "",
+            "billed_by": text.strip().splitlines()[0] if text.strip() else "",
+        }
+        if payload.get("format"):
+            # Single-pass mode: schema-constrained, categories included
+            return json.dumps({
+                **fields,
+                "line_items": [
+                    {"description": description.strip(), "amount": int(amount), "category": "food"}
+                    for description, _, _, amount in items
+                ],
+                "grand_total": sum(int(amount) for _, _, _, amount in items),
+            })
+        return json.dumps({
+            **fields,
+            "description": [description.strip() for description, _, _, _ in items],
+            "ammount": [int(amount) for _, _, _, amount in items],
+            "grand_total": sum(int(amount) for _, _, _, amount in items),
+        })
+
+    return "```sql\nSELECT COUNT(*) FROM invoices;\n```"
+
+
+# --- measurement ---
+
+def peak_rss_mb() -> float | None:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize(samples: list[float]) -> dict:
+    if not samples:
+        return {"count": 0, "p50": None, "p95": None, "total": 0.0}
+    return {
+        "count": len(samples),
+        "p50": round(float(np.percentile(samples, 50)), 4),
+        "p95": round(float(np.percentile(samples, 95)), 4),
+        "total": round(float(np.sum(samples)), 4),
+    }
+
+
+def _stage_report() -> dict:
+    return {stage: summarize(metrics.stage_samples(stage)) for stage in STAGES}
+
+
+def _counters() -> dict:
+    """Counters recorded during the run, e.g. {"llm_calls{agent=extraction,mode=stream}": 20}."""
+    return {
+        counter["name"] + ("{" + ",".join(f"{k}={v}" for k, v in counter["labels"].items()) + "}"
+                           if counter["labels"] else ""): counter["value"]
+        for counter in metrics.snapshot()["counters"]
+    }
+
+
+def _llm_usage(bills: int) -> dict:
+    """
+    LLM calls, prompt/response characters and tokens per bill, summed over the agents,
+    and the estimated OCR text tokens before and after compaction.
+    Tokens are as reported by Ollama; a stream closed early (streamed extraction) reports none,
+    so characters are the complete measure.
+    """
+    totals = defaultdict(float)
+    snapshot = metrics.snapshot()
+    for counter in snapshot["counters"]:
+        if counter["name"] == "llm_calls":
+            totals["calls"] += counter["value"]
+    for summary in snapshot["summaries"]:
+        if summary["name"] in ("llm_prompt_chars", "llm_response_chars", "llm_prompt_tokens", "llm_response_tokens"):
+            totals[summary["name"].removeprefix("llm_")] += summary["sum"]
+        elif summary["name"] == "ocr_text_tokens":
+            # Estimated OCR text tokens before / after compaction
+            totals[f"ocr_tokens_{summary['labels']['stage']}"] += summary["sum"]
+    return {name: round(value / bills, 1) if bills else None for name, value in sorted(totals.items())}
+
+
+def run_batch_path(bill_folder: str) -> dict:
+    """image_cleaning -> perform_ocr -> parse_multiple_invoices -> insert (as insert_extracted_data does)."""
+    import image_cleaning
+    import ocr_processor
+    import parser
+    from data_insertion import insert_bills
+
+    metrics.reset()
+    stage_seconds = {}
+    cleaned_folder = os.path.abspath("cleaned")
+    os.makedirs(cleaned_folder, exist_ok=True)
+
+    def timed_stage(stage, func, *args):
+        stage_started = time.perf_counter()
+        result = func(*args)
+        stage_seconds[stage] = round(time.perf_counter() - stage_started, 4)
+        return result
+
+    started = time.perf_counter()
+    timed_stage("clean", image_cleaning.image_cleaning, bill_folder, cleaned_folder)
+    timed_stage("ocr", ocr_processor.perform_ocr, cleaned_folder, ocr_processor.output_file)
+    bills = timed_stage("parse", parser.parse_multiple_invoices)
+    inserted = timed_stage("insert", insert_bills, bills)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "path": "batch",
+        "bills": len(bills),
+        "line_items_inserted": inserted,
+        "seconds": round(elapsed, 4),
+        "bills_per_second": round(len(bills) / elapsed, 3) if elapsed else None,
+        "stage_seconds": stage_seconds,
+        # per item; insert is one transaction per batch, so a single sample
+        "stages": _stage_report(),
+        # the batch path runs stage by stage, so a bill's latency is the whole run
+        "end_to_end": summarize([elapsed]),
+        "llm_per_bill": _llm_usage(len(bills)),
+        "counters": _counters(),
+    }
+
+
+def run_single_path(bill_folder: str) -> dict:
+    """The upload page, bill by bill: clean in memory -> OCR the array -> parse -> insert."""
+    from image_cleaning import clean_image_array_with_plan
+    from ocr_processor import perform_ocr_on_array
+    from parser import parse_single_invoice_text
+    from data_insertion import insert_single_bill_data
+
+    metrics.reset()
+    end_to_end = []
+    bills = 0
+
+    started = time.perf_counter()
+    for filename in sorted(os.listdir(bill_folder)):
+        bill_started = time.perf_counter()
+        with open(os.path.join(bill_folder, filename), "rb") as f:
+            source_bytes = f.read()
+        cleaned_image, _ = clean_image_array_with_plan(source_bytes)
+        if cleaned_image is None:
+            continue
+        ocr_text = perform_ocr_on_array(cleaned_image)
+        bill = parse_single_invoice_text(ocr_text, filename) if ocr_text else {}
+        if bill and insert_single_bill_data(bill):
+            bills += 1
+        end_to_end.append(time.perf_counter() - bill_started)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "path": "single",
+        "bills": bills,
+        "seconds": round(elapsed, 4),
+        "bills_per_second": round(bills / elapsed, 3) if elapsed else None,
+        "stages": _stage_report(),
+        "end_to_end": summarize(end_to_end),
+        "llm_per_bill": _llm_usage(bills),
+        "counters": _counters(),
+    }
+
+
+def _run_in_child(path: str, bill_folder: str, workdir: str, results):
+    os.chdir(workdir)  # relative databases and ocr_records.jsonl land in the work directory
+    try:
+        result = run_batch_path(bill_folder) if path == "batch" else run_single_path(bill_folder)
+        result["peak_rss_mb"] = peak_rss_mb()
+    except Exception as e:
+        result = {"path": path, "error": f"{type(e).__name__}: {e}"}
+    results.put(result)
+
+
+def run_benchmark(count: int = 20, width: int = 768, noise: float = 8.0, llm_latency: float = 0.2,
+                  token_latency: float = 0.0, paths=PATHS, seed: int = 0, keep: bool = False,
+                  extraction_modes=EXTRACTION_MODES) -> list[dict]:
+    """
+    Generates the bills, starts the stub LLM and runs each path in each extraction mode
+    in a fresh process with cold caches.
+    """
+    root = tempfile.mkdtemp(prefix="bill_benchmark_")
+    bill_folder = os.path.join(root, "bills")
+    write_bills(bill_folder, count, width, noise, seed)
+
+    context = multiprocessing.get_context("spawn")
+    reports = []
+    try:
+        with StubOllamaServer(stub_responder, latency=llm_latency, token_latency=token_latency) as stub:
+            for path in paths:
+                for mode in extraction_modes:
+                    workdir = os.path.join(root, f"{path}-{mode}")
+                    os.makedirs(workdir)
+                    # Read by the child at import time
+                    os.environ["OLLAMA_HOST"] = stub.url
+                    os.environ["BILL_CACHE_DB"] = os.path.join(workdir, "cache.db")
+                    os.environ["CATEGORY_MODEL_PATH"] = os.path.join(workdir, "category_model.npz")
+                    os.environ["BILL_EXTRACTION_MODE"] = mode
+
+                    results = context.Queue()
+                    child = context.Process(target=_run_in_child, args=(path, bill_folder, workdir, results))
+                    child.start()
+                    report = results.get()
+                    child.join()
+                    report["extraction_mode"] = mode
+                    report["llm_requests"] = stub.request_count
+                    stub.request_count = 0
+                    reports.append(report)
+    finally:
+        if keep:
+            print(f"Benchmark files kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    return reports
+
+
+if __name__ == "__main__":
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="Offline end-to-end benchmark with synthetic bills and a stub LLM")
+    arg_parser.add_argument("--bills", type=int, default=20)
+    arg_parser.add_argument("--width", type=int, default=768, help="Synthetic bill width in pixels")
+    arg_parser.add_argument("--noise", type=float, default=8.0, help="Gaussian noise sigma")
+    arg_parser.add_argument("--llm-latency", type=float, default=0.2, help="Stub LLM seconds per request")
+    arg_parser.add_argument("--token-latency", type=float, default=0.0, help="Stub LLM seconds per streamed token")
+    arg_parser.add_argument("--paths", nargs="+", choices=PATHS, default=list(PATHS))
+    arg_parser.add_argument("--extraction-modes", nargs="+", choices=EXTRACTION_MODES, default=list(EXTRACTION_MODES))
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--json", help="Also write the report to this file")
+    arg_parser.add_argument("--keep", action="store_true", help="Keep the generated bills and databases")
+    args = arg_parser.parse_args()
+
+    benchmark_reports = run_benchmark(args.bills, args.width, args.noise, args.llm_latency,
+                                      args.token_latency, args.paths, args.seed, args.keep,
+                                      args.extraction_modes)
+    print(json.dumps(benchmark_reports, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(benchmark_reports, f, indent=2)
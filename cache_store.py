@@ -0,0 +1,160 @@
+import os
+import sqlite3
+import threading
+import time
+from metrics import inc
+
+# Persistent key/value caches stored in a separate SQLite file
+CACHE_DB = os.environ.get("BILL_CACHE_DB", "cache.db")
+
+
+class SQLiteCache:
+    """
+    Size-bounded LRU cache stored in one SQLite table.
+    Args:
+        table: table name used for this cache.
+        max_entries: entries kept before the least recently used are evicted.
+        max_bytes: optional limit on the total size of the stored values.
+        ttl_seconds: optional lifetime of an entry; expired entries count as misses.
+        db_path: SQLite file holding the cache.
+    Hit/miss counters are persisted so they cover every process using the cache.
+    """
+
+    def __init__(self, table: str, max_entries: int = 10000, max_bytes: int | None = None,
+                 ttl_seconds: float | None = None, db_path: str = CACHE_DB):
+        self.table = table
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._con = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per process (connections must not cross a fork)
+        if self._con is None or self._pid != os.getpid():
+            con = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            con.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_last_access ON {self.table} (last_access)")
+            con.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table}_stats (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            """)
+            con.commit()
+            self._con = con
+            self._pid = os.getpid()
+        return self._con
+
+    def _count(self, con: sqlite3.Connection, name: str):
+        con.execute(
+            f"INSERT INTO {self.table}_stats (name, value) VALUES (?, 1) "
+            f"ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key: str) -> str | None:
+        """Returns the cached value or None on a miss."""
+        with self._lock:
+            con = self._connection()
+            now = time.time()
+            row = con.execute(f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+
+            if row and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                con.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                row = None
+
+            if row:
+                con.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (now, key))
+                self._count(con, "hits")
+            else:
+                self._count(con, "misses")
+            con.commit()
+            inc("cache_requests", cache=self.table, result="hit" if row else "miss")
+            return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        """Stores a value and evicts least recently used entries over the limits."""
+        with self._lock:
+            con = self._connection()
+            now = time.time()
+            con.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now),
+            )
+            self._evict(con)
+            con.commit()
+
+    def _evict(self, con: sqlite3.Connection):
+        if self.ttl_seconds is not None:
+            con.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+
+        entries, total_bytes = con.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+        if entries > self.max_entries:
+            removed = con.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY last_access LIMIT ?)",
+                (entries - self.max_entries,),
+            ).rowcount
+            self._add_evictions(con, removed)
+
+        if self.max_bytes is not None and total_bytes > self.max_bytes:
+            # Drop the oldest entries until the total size is under the limit
+            removed = 0
+            for key, size in con.execute(f"SELECT key, size FROM {self.table} ORDER BY last_access").fetchall():
+                if total_bytes <= self.max_bytes:
+                    break
+                con.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                total_bytes -= size
+                removed += 1
+            self._add_evictions(con, removed)
+
+    def _add_evictions(self, con: sqlite3.Connection, removed: int):
+        if removed > 0:
+            con.execute(
+                f"INSERT INTO {self.table}_stats (name, value) VALUES ('evictions', ?) "
+                f"ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (removed,),
+            )
+
+    def delete(self, key: str):
+        with self._lock:
+            con = self._connection()
+            con.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            con.commit()
+
+    def clear(self):
+        with self._lock:
+            con = self._connection()
+            con.execute(f"DELETE FROM {self.table}")
+            con.execute(f"DELETE FROM {self.table}_stats")
+            con.commit()
+
+    def stats(self) -> dict:
+        """Returns hit/miss/eviction counters and the current size of the cache."""
+        with self._lock:
+            con = self._connection()
+            counters = dict(con.execute(f"SELECT name, value FROM {self.table}_stats").fetchall())
+            entries, total_bytes = con.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "entries": entries,
+            "bytes": total_bytes,
+            "hits": hits,
+            "misses": misses,
+            "evictions": counters.get("evictions", 0),
+            "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+        }
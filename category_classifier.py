@@ -0,0 +1,274 @@
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from collections import Counter, defaultdict
+import numpy as np
+from prompt2 import categories
+
+# CPU-only fast path in front of the categorizer LLM:
+# hashed word + character n-gram features with a softmax (multinomial logistic) model in NumPy.
+
+DB_NAME = "ocr_master.db"
+TABLE_NAME = "ocr_line_items"
+MEMO_TABLE = "category_memo"
+
+MODEL_PATH = os.environ.get("CATEGORY_MODEL_PATH", "category_model.npz")
+CONFIDENCE_THRESHOLD = float(os.environ.get("CATEGORY_CLASSIFIER_THRESHOLD", "0.9"))
+N_FEATURES = 2 ** 14
+CHAR_NGRAMS = (3, 4, 5)
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_description(description) -> str:
+    """
+    Lower-cases and collapses whitespace so 'Coffee ' and 'coffee' share an entry.
+    Also the category memo's key, so the memo and the classifier see the same descriptions.
+    """
+    return " ".join(str(description).lower().split())
+
+
+def _hash(token: str) -> int:
+    # crc32 is stable across processes (built-in hash() is salted)
+    return zlib.crc32(token.encode("utf-8")) % N_FEATURES
+
+
+def _tokens(description: str) -> list[str]:
+    text = normalize_description(description)
+    tokens = [f"w:{word}" for word in text.split()]
+    padded = f" {text} "
+    for n in CHAR_NGRAMS:
+        tokens.extend(f"c:{padded[i:i + n]}" for i in range(len(padded) - n + 1))
+    return tokens
+
+
+def _sparse_row(description: str) -> tuple[np.ndarray, np.ndarray]:
+    counts = Counter(_hash(t) for t in _tokens(description))
+    columns = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    return columns, values / max(float(np.linalg.norm(values)), 1e-12)
+
+
+def _densify(rows: list[tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
+    features = np.zeros((len(rows), N_FEATURES), dtype=np.float32)
+    for row, (columns, values) in enumerate(rows):
+        features[row, columns] = values
+    return features
+
+
+def featurize(descriptions: list[str]) -> np.ndarray:
+    """Returns L2-normalized log-count hashed features, one row per description."""
+    return _densify([_sparse_row(d) for d in descriptions])
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class CategoryClassifier:
+    """Linear softmax classifier over hashed n-gram features."""
+
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, classes: list[str]):
+        self.weights = weights
+        self.bias = bias
+        self.classes = classes
+
+    @classmethod
+    def train(cls, descriptions: list[str], labels: list[str], epochs: int = 100,
+              learning_rate: float = 2.0, l2: float = 1e-5, batch_size: int = 256, seed: int = 0):
+        classes = sorted(set(labels))
+        class_index = {c: i for i, c in enumerate(classes)}
+        y = np.array([class_index[label] for label in labels])
+
+        weights = np.zeros((N_FEATURES, len(classes)), dtype=np.float32)
+        bias = np.zeros(len(classes), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+
+        # Mini-batch gradient descent; features are hashed once and densified per batch to bound memory
+        sparse_rows = [_sparse_row(d) for d in descriptions]
+        for _ in range(epochs):
+            order = rng.permutation(len(descriptions))
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                x = _densify([sparse_rows[i] for i in batch])
+                probs = _softmax(x @ weights + bias)
+                probs[np.arange(len(batch)), y[batch]] -= 1.0
+                probs /= len(batch)
+                weights -= learning_rate * (x.T @ probs + l2 * weights)
+                bias -= learning_rate * probs.sum(axis=0)
+
+        return cls(weights, bias, classes)
+
+    def predict(self, descriptions: list[str]) -> tuple[list[str], np.ndarray]:
+        """Returns the predicted categories and their confidences (max class probability)."""
+        if not descriptions:
+            return [], np.zeros(0, dtype=np.float32)
+        # Sparse dot product: only the hashed columns present in each row are touched
+        logits = np.stack([values @ self.weights[columns] for columns, values in map(_sparse_row, descriptions)])
+        probs = _softmax(logits + self.bias)
+        best = probs.argmax(axis=1)
+        return [self.classes[i] for i in best], probs[np.arange(len(best)), best]
+
+    def save(self, path: str = MODEL_PATH):
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, classes=np.array(self.classes))
+
+    @classmethod
+    def load(cls, path: str = MODEL_PATH):
+        with np.load(path) as data:
+            return cls(data["weights"], data["bias"], [str(c) for c in data["classes"]])
+
+
+_model = None
+_model_mtime = None
+
+
+def get_classifier():
+    """Returns the trained classifier, reloading it after a retrain; None if no model exists."""
+    global _model, _model_mtime
+    if not os.path.exists(MODEL_PATH):
+        return None
+    mtime = os.path.getmtime(MODEL_PATH)
+    if _model is None or mtime != _model_mtime:
+        try:
+            _model = CategoryClassifier.load(MODEL_PATH)
+            _model_mtime = mtime
+        except Exception as err:
+            logger.warning("Failed to load category model %s: %s", MODEL_PATH, err)
+            return None
+    return _model
+
+
+def split_by_confidence(description_texts: list[str], threshold: float | None = None):
+    """
+    Scores descriptions locally.
+    Returns ({index: category} for confident predictions, [indexes needing the LLM]).
+    """
+    threshold = CONFIDENCE_THRESHOLD if threshold is None else threshold
+    model = get_classifier()
+    if model is None or not description_texts:
+        return {}, list(range(len(description_texts)))
+
+    labels, confidences = model.predict(description_texts)
+    confident = {i: label for i, (label, conf) in enumerate(zip(labels, confidences)) if conf >= threshold}
+    uncertain = [i for i in range(len(description_texts)) if i not in confident]
+    return confident, uncertain
+
+
+def load_training_data(db_name: str = DB_NAME) -> tuple[list[str], list[str]]:
+    """
+    Labeled descriptions from ocr_line_items and the category memo, one per
+    normalized description (majority label; human-confirmed memo entries win).
+    """
+    con = None
+    try:
+        con = sqlite3.connect(db_name)
+        counts = defaultdict(Counter)
+        for description, category in con.execute(
+            f"SELECT Description, Category FROM {TABLE_NAME} WHERE Description IS NOT NULL AND Category IS NOT NULL"
+        ):
+            if category in categories:
+                counts[normalize_description(description)][category] += 1
+
+        labels = {key: counter.most_common(1)[0][0] for key, counter in counts.items() if key}
+        try:
+            for key, category, source in con.execute(f"SELECT description_key, category, source FROM {MEMO_TABLE}"):
+                if category in categories and (source == "human" or key not in labels):
+                    labels[key] = category
+        except sqlite3.OperationalError:
+            pass  # no memo table yet
+
+        keys = sorted(labels)
+        return keys, [labels[k] for k in keys]
+
+    except sqlite3.Error as e:
+        logger.error("SQLite Error while loading training data: %s", e)
+        return [], []
+    finally:
+        if con:
+            con.close()
+
+
+def retrain(db_name: str = DB_NAME, path: str = MODEL_PATH):
+    descriptions, labels = load_training_data(db_name)
+    if len(set(labels)) < 2:
+        print(f"Not enough labeled data to train ({len(descriptions)} rows, {len(set(labels))} categories)")
+        return None
+
+    started = time.perf_counter()
+    model = CategoryClassifier.train(descriptions, labels)
+    model.save(path)
+    print(f"Trained on {len(descriptions)} descriptions in {time.perf_counter() - started:.2f}s -> {path}")
+    return model
+
+
+def benchmark(holdout: float = 0.2, threshold: float | None = None, llm_chunk_size: int = 50,
+              db_name: str = DB_NAME, seed: int = 0) -> dict:
+    """
+    Trains on part of the labeled data and compares the classifier with the
+    LLM on the held-out part: LLM calls avoided and agreement with the LLM.
+    """
+    from ollama2 import request_categories
+
+    threshold = CONFIDENCE_THRESHOLD if threshold is None else threshold
+    descriptions, labels = load_training_data(db_name)
+    if len(descriptions) < 10:
+        print(f"Not enough labeled data to benchmark ({len(descriptions)} rows)")
+        return {}
+
+    order = np.random.default_rng(seed).permutation(len(descriptions))
+    n_test = max(1, int(len(order) * holdout))
+    test, train = order[:n_test], order[n_test:]
+    model = CategoryClassifier.train([descriptions[i] for i in train], [labels[i] for i in train])
+
+    test_descriptions = [descriptions[i] for i in test]
+    test_labels = [labels[i] for i in test]
+    started = time.perf_counter()
+    predicted, confidences = model.predict(test_descriptions)
+    micros_per_item = (time.perf_counter() - started) / len(test) * 1e6
+
+    llm_labels = []
+    for start in range(0, len(test_descriptions), llm_chunk_size):
+        chunk = test_descriptions[start:start + llm_chunk_size]
+        result = request_categories(chunk)
+        llm_labels.extend(result if result and len(result) == len(chunk) else [None] * len(chunk))
+
+    confident = confidences >= threshold
+    n_confident = int(confident.sum())
+    compared = [(p, l) for p, l in zip(predicted, llm_labels) if l is not None]
+    compared_confident = [(p, l) for p, l, c in zip(predicted, llm_labels, confident) if c and l is not None]
+
+    report = {
+        "train_size": len(train),
+        "holdout_size": len(test),
+        "threshold": threshold,
+        "micros_per_item": round(micros_per_item, 1),
+        "items_avoiding_llm": n_confident,
+        "llm_items_avoided_pct": round(100 * n_confident / len(test), 1),
+        "agreement_with_llm_all_pct": round(100 * np.mean([p == l for p, l in compared]), 1) if compared else None,
+        "agreement_with_llm_confident_pct": round(100 * np.mean([p == l for p, l in compared_confident]), 1) if compared_confident else None,
+        "accuracy_vs_stored_labels_pct": round(100 * np.mean([p == l for p, l in zip(predicted, test_labels)]), 1),
+    }
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="Local category classifier")
+    sub = arg_parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("train", help="Retrain the model from the labeled rows in the database")
+    bench = sub.add_parser("benchmark", help="Compare the classifier with the LLM on a held-out set")
+    bench.add_argument("--holdout", type=float, default=0.2)
+    bench.add_argument("--threshold", type=float, default=None)
+    args = arg_parser.parse_args()
+
+    if args.command == "train":
+        retrain()
+    else:
+        benchmark(args.holdout, args.threshold)
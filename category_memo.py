@@ -0,0 +1,296 @@
+import logging
+import os
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from ollama2 import request_categories
+from category_classifier import normalize_description, split_by_confidence
+from prompt2 import categories
+from metrics import inc, timed
+
+# Persistent description -> category mapping, so only unseen line items hit the categorizer LLM
+
+DB_NAME = "ocr_master.db"
+TABLE_NAME = "ocr_line_items"
+MEMO_TABLE = "category_memo"
+
+logger = logging.getLogger(__name__)
+
+# Human-confirmed categories are never overwritten by seed or LLM results
+SOURCE_PRIORITY = {"seed": 0, "llm": 0, "human": 1}
+
+# Limits for one categorization request: descriptions and their total characters
+CATEGORY_CHUNK_SIZE = int(os.environ.get("BILL_CATEGORY_CHUNK_SIZE", "40"))
+CATEGORY_CHUNK_CHARS = int(os.environ.get("BILL_CATEGORY_CHUNK_CHARS", "3000"))
+
+
+def ensure_memo_table(con: sqlite3.Connection):
+    """Creates the memo table; a newly created table is seeded from ocr_line_items."""
+    exists = con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (MEMO_TABLE,)
+    ).fetchone()
+    if exists:
+        return
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MEMO_TABLE} (
+            description_key TEXT PRIMARY KEY,
+            category TEXT NOT NULL,
+            source TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    try:
+        _seed(con)
+    except sqlite3.OperationalError:
+        pass  # no ocr_line_items table yet
+    con.commit()
+
+
+def _upsert(con: sqlite3.Connection, rows: list[tuple]):
+    # rows: (description_key, category, source, priority, updated_at)
+    con.executemany(
+        f"""
+        INSERT INTO {MEMO_TABLE} (description_key, category, source, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(description_key) DO UPDATE SET
+            category = excluded.category,
+            source = excluded.source,
+            updated_at = excluded.updated_at
+        WHERE ? >= CASE {MEMO_TABLE}.source WHEN 'human' THEN 1 ELSE 0 END
+        """,
+        [(key, category, source, updated_at, priority) for key, category, source, priority, updated_at in rows],
+    )
+
+
+def _seed(con: sqlite3.Connection) -> int:
+    counts = defaultdict(Counter)
+    for description, category in con.execute(
+        f"SELECT Description, Category FROM {TABLE_NAME} WHERE Description IS NOT NULL AND Category IS NOT NULL"
+    ):
+        if category in categories:
+            counts[normalize_description(description)][category] += 1
+
+    now = time.time()
+    rows = [
+        (key, counter.most_common(1)[0][0], "seed", SOURCE_PRIORITY["seed"], now)
+        for key, counter in counts.items() if key
+    ]
+    _upsert(con, rows)
+    return len(rows)
+
+
+def seed_from_line_items(db_name: str = DB_NAME) -> int:
+    """
+    Seeds the memo table with the most frequent category of every description
+    already stored in ocr_line_items. Returns the number of descriptions seeded.
+    """
+    con = None
+    try:
+        con = sqlite3.connect(db_name)
+        ensure_memo_table(con)
+        seeded = _seed(con)
+        con.commit()
+        return seeded
+
+    except sqlite3.Error as e:
+        logger.error("SQLite Error while seeding category memo: %s", e)
+        return 0
+    finally:
+        if con:
+            con.close()
+
+
+def remember_categories(pairs, source: str = "human", db_name: str = DB_NAME) -> int:
+    """
+    Stores (description, category) pairs, e.g. the categories confirmed in the review editor.
+    Returns the number of pairs stored.
+    """
+    now = time.time()
+    rows = [
+        (normalize_description(description), category, source, SOURCE_PRIORITY.get(source, 0), now)
+        for description, category in pairs
+        if description and category in categories and normalize_description(description)
+    ]
+    if not rows:
+        return 0
+
+    con = None
+    try:
+        con = sqlite3.connect(db_name)
+        ensure_memo_table(con)
+        _upsert(con, rows)
+        con.commit()
+        return len(rows)
+    except sqlite3.Error as e:
+        logger.error("SQLite Error while saving category memo: %s", e)
+        return 0
+    finally:
+        if con:
+            con.close()
+
+
+def lookup_categories(description_keys: list[str], db_name: str = DB_NAME) -> dict:
+    """Returns {description_key: category} for the keys already known."""
+    if not description_keys:
+        return {}
+    con = None
+    try:
+        con = sqlite3.connect(db_name)
+        ensure_memo_table(con)
+        found = {}
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(description_keys), 500):
+            chunk = description_keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(con.execute(
+                f"SELECT description_key, category FROM {MEMO_TABLE} WHERE description_key IN ({placeholders})",
+                chunk,
+            ).fetchall())
+        return found
+    except sqlite3.Error as e:
+        logger.error("SQLite Error while reading category memo: %s", e)
+        return {}
+    finally:
+        if con:
+            con.close()
+
+
+def _chunks(description_texts: list[str], max_items: int, max_chars: int):
+    chunk, chars = [], 0
+    for description in description_texts:
+        if chunk and (len(chunk) >= max_items or chars + len(description) > max_chars):
+            yield chunk
+            chunk, chars = [], 0
+        chunk.append(description)
+        chars += len(description)
+    if chunk:
+        yield chunk
+
+
+def _categorize_chunk(chunk: list[str]) -> list[str | None]:
+    labels = request_categories(chunk)
+    if labels is None:
+        return [None] * len(chunk)  # failed call: retrying smaller chunks would not help
+
+    if len(labels) != len(chunk):
+        # Positions cannot be trusted: retry both halves instead of guessing
+        logger.warning("Category labels count mismatch. Expected %d, got %d. Retrying in halves.", len(chunk), len(labels))
+        if len(chunk) == 1:
+            inc("category_fallbacks", reason="count_mismatch")
+            return [None]
+        middle = len(chunk) // 2
+        return _categorize_chunk(chunk[:middle]) + _categorize_chunk(chunk[middle:])
+
+    invalid = sum(label not in categories for label in labels)
+    if invalid:
+        inc("category_fallbacks", invalid, reason="invalid_label")
+    return [label if label in categories else None for label in labels]
+
+
+def categorize_with_llm(description_texts: list[str], chunk_size: int = CATEGORY_CHUNK_SIZE,
+                        chunk_chars: int = CATEGORY_CHUNK_CHARS) -> list[str | None]:
+    """
+    Labels descriptions with the LLM in requests of at most chunk_size descriptions /
+    chunk_chars characters. Every answer is length-checked before its labels are used;
+    descriptions without a valid label come back as None (left for review).
+    """
+    labels = []
+    for chunk in _chunks(description_texts, chunk_size, chunk_chars):
+        labels.extend(_categorize_chunk(chunk))
+    return labels
+
+
+@timed("categorize")
+def categorize_with_memo(description_texts: list[str], db_name: str = DB_NAME) -> list[str | None]:
+    """
+    Known descriptions are answered from the memo table, unseen ones the local
+    classifier is confident about are labeled on the CPU, the remaining unique
+    misses go to the LLM in size-limited chunks, and the labels come back in the
+    original order (None where the LLM gave no valid label).
+    """
+    keys = [normalize_description(d) for d in description_texts]
+    known = lookup_categories(sorted(set(keys)), db_name)
+
+    # Unique misses, in first-seen order, with one original spelling each
+    misses = {}
+    for description, key in zip(description_texts, keys):
+        if key not in known and key not in misses:
+            misses[key] = str(description).strip()
+    inc("categorized_items", sum(key in known for key in keys), source="memo")
+
+    # Local classifier fast path; only low-confidence descriptions stay for the LLM
+    if misses:
+        miss_keys = list(misses)
+        confident, uncertain = split_by_confidence(list(misses.values()))
+        for i, label in confident.items():
+            known[miss_keys[i]] = label
+        misses = {miss_keys[i]: misses[miss_keys[i]] for i in uncertain}
+        if confident:
+            inc("categorized_items", len(confident), source="classifier")
+            logger.info("Category classifier: %d labeled locally", len(confident))
+
+    if misses:
+        logger.info("Category memo: %d known, %d sent to LLM", len(keys) - sum(k in misses for k in keys), len(misses))
+        labels = categorize_with_llm(list(misses.values()))
+        new_labels = {key: label for key, label in zip(misses, labels) if label is not None}
+        known.update(new_labels)
+        remember_categories(
+            [(misses[key], label) for key, label in new_labels.items()], source="llm", db_name=db_name
+        )
+        inc("categorized_items", len(new_labels), source="llm")
+        if len(new_labels) < len(misses):
+            logger.warning("%d descriptions left uncategorized for review", len(misses) - len(new_labels))
+
+    return [known.get(key) for key in keys]
+
+
+def categorize_batch(description_lists: list[list[str]], db_name: str = DB_NAME) -> list[list[str | None]]:
+    """
+    Categorizes the descriptions of many bills together: duplicates across bills are
+    looked up / sent once, and the labels are split back per bill in the original order.
+    """
+    flat = [description for descriptions in description_lists for description in descriptions]
+    labels = categorize_with_memo(flat, db_name) if flat else []
+    result, start = [], 0
+    for descriptions in description_lists:
+        result.append(labels[start:start + len(descriptions)])
+        start += len(descriptions)
+    return result
+
+
+@timed("categorize")
+def categorize_with_proposed(description_texts: list[str], proposed_labels: list[str],
+                             db_name: str = DB_NAME) -> list[str | None]:
+    """
+    Categories for single-pass extraction, where the extraction call already proposed one
+    label per description. The memo still takes precedence (so human corrections stick),
+    valid proposals for unseen descriptions are used and remembered, and descriptions
+    with an invalid proposal go through categorize_with_memo.
+    """
+    keys = [normalize_description(d) for d in description_texts]
+    known = lookup_categories(sorted(set(keys)), db_name)
+    inc("categorized_items", sum(key in known for key in keys), source="memo")
+
+    accepted = {}
+    retry = {}
+    for description, key, label in zip(description_texts, keys, proposed_labels):
+        if key in known or key in accepted:
+            continue
+        if label in categories:
+            accepted[key] = (str(description).strip(), label)
+        else:
+            retry[key] = str(description).strip()
+
+    if accepted:
+        known.update({key: label for key, (_, label) in accepted.items()})
+        remember_categories(accepted.values(), source="llm", db_name=db_name)
+        inc("categorized_items", len(accepted), source="extraction")
+    if retry:
+        logger.info("%d single-pass categories were invalid, categorizing them separately", len(retry))
+        known.update(zip(retry, categorize_with_memo(list(retry.values()), db_name)))
+
+    return [known[key] for key in keys]
+
+
+if __name__ == "__main__":
+    print(f"Seeded {seed_from_line_items()} descriptions into {MEMO_TABLE}")
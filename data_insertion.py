@@ -1,181 +1,258 @@
+import logging
 import sqlite3
-from parser import parse_multiple_invoices
+from parser import iter_parsed_invoices
+from db_schema import ensure_schema
+from date_normalizer import normalize_date
+from metrics import inc, timed
 
 DB_NAME = "ocr_master.db"
-TABLE_NAME = "ocr_line_items" # Ensure this matches your table_creation.py
+INVOICE_TABLE = "invoices" # Ensure these match db_schema.py
+LINE_ITEM_TABLE = "line_items"
 
+# Line items written per transaction by insert_bills
+DEFAULT_BATCH_SIZE = 1000
 
-def insert_extracted_data():
-    con = None
-    insert_count = 0
+logger = logging.getLogger(__name__)
+
+INSERT_INVOICE_SQL = f"""
+    INSERT INTO {INVOICE_TABLE}
+    (
+        Invoice_No,
+        Issue_Date,
+        billed_to,
+        billed_by,
+        Grand_Total,
+        source_file,
+        Issue_Date_ISO
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (Invoice_No) DO UPDATE SET
+        Issue_Date = excluded.Issue_Date,
+        billed_to = excluded.billed_to,
+        billed_by = excluded.billed_by,
+        Grand_Total = excluded.Grand_Total,
+        source_file = excluded.source_file,
+        Issue_Date_ISO = excluded.Issue_Date_ISO
+"""
+
+# Upsert (not REPLACE) so the summary-table update trigger sees overwritten line items
+INSERT_LINE_ITEM_SQL = f"""
+    INSERT INTO {LINE_ITEM_TABLE}
+    (
+        Invoice_No,
+        line_item_id,
+        Description,
+        Category,
+        Amount
+    )
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (Invoice_No, line_item_id) DO UPDATE SET
+        Description = excluded.Description,
+        Category = excluded.Category,
+        Amount = excluded.Amount
+"""
+
+# A re-inserted bill with fewer line items must not keep the old extra rows
+DELETE_STALE_LINE_ITEMS_SQL = f"DELETE FROM {LINE_ITEM_TABLE} WHERE Invoice_No = ? AND line_item_id > ?"
+
+
+def connect_db(db_name: str = DB_NAME) -> sqlite3.Connection:
+    """
+    Opens a connection tuned for bulk writes: WAL journaling and synchronous=NORMAL
+    (one fsync per checkpoint instead of per commit). Transactions are managed explicitly.
+    The schema is created or migrated on first use.
+    """
+    con = sqlite3.connect(db_name, timeout=30, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    ensure_schema(con)
+    return con
+
+
+def bill_to_rows(bill_dict: dict) -> tuple[tuple, list[tuple]]:
+    """
+    Converts one parsed bill into parameter tuples:
+    (invoice row for INSERT_INVOICE_SQL, line item rows for INSERT_LINE_ITEM_SQL).
+    """
+    invoice_no = bill_dict.get("Invoice_No")
+    invoice_row = (
+        invoice_no,
+        bill_dict.get("Issue_Date"),
+        bill_dict.get("billed_to"),
+        bill_dict.get("billed_by"),
+        bill_dict.get("Grand_Total"),
+        bill_dict.get("source_file"),
+        # Normalized at parse time; bills built elsewhere are normalized here
+        bill_dict.get("Issue_Date_ISO") or normalize_date(bill_dict.get("Issue_Date")),
+    )
+    line_rows = [
+        (
+            invoice_no,
+            line_id,
+            item.get('service_description'),
+            item.get('Category'),
+            item.get('Amount'),
+        )
+        for line_id, item in enumerate(bill_dict.get("line_items", []), start=1)
+    ]
+    return invoice_row, line_rows
 
+
+def _write_bill(con: sqlite3.Connection, invoice_row: tuple, line_rows: list[tuple]):
+    con.execute(INSERT_INVOICE_SQL, invoice_row)
+    con.execute(DELETE_STALE_LINE_ITEMS_SQL, (invoice_row[0], len(line_rows)))
+    con.executemany(INSERT_LINE_ITEM_SQL, line_rows)
+
+
+def _write_batch(con: sqlite3.Connection, bills_rows: list[tuple]) -> list:
+    """Writes (invoice row, line item rows) pairs and returns the invoice numbers committed."""
     try:
-        # Connect to database
-        con = sqlite3.connect(DB_NAME)
-        cur = con.cursor()
+        con.execute("BEGIN")
+        con.executemany(INSERT_INVOICE_SQL, [invoice_row for invoice_row, _ in bills_rows])
+        con.executemany(
+            DELETE_STALE_LINE_ITEMS_SQL,
+            [(invoice_row[0], len(line_rows)) for invoice_row, line_rows in bills_rows],
+        )
+        con.executemany(INSERT_LINE_ITEM_SQL, [row for _, line_rows in bills_rows for row in line_rows])
+        con.execute("COMMIT")
+        return [invoice_row[0] for invoice_row, _ in bills_rows]
+    except sqlite3.IntegrityError:
+        con.execute("ROLLBACK")
+    except sqlite3.Error:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
 
-        # Get parsed bill data
-        all_bill_data = parse_multiple_invoices()
+    # A bad row aborted the batch: retry bill by bill so only that bill is skipped
+    committed = []
+    try:
+        con.execute("BEGIN")
+        for invoice_row, line_rows in bills_rows:
+            con.execute("SAVEPOINT bill")
+            try:
+                _write_bill(con, invoice_row, line_rows)
+                con.execute("RELEASE bill")
+                committed.append(invoice_row[0])
+            except sqlite3.IntegrityError as e:
+                con.execute("ROLLBACK TO bill")
+                con.execute("RELEASE bill")
+                logger.warning("Duplicate skipped: Invoice %s → %s", invoice_row[0], e)
+        con.execute("COMMIT")
+    except sqlite3.Error:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    return committed
 
-        if not all_bill_data:
-            print("no data")
-            return
 
-        print(f"data to be extracted, {len(all_bill_data)}")
+@timed("insert")
+def _insert(bills, batch_size: int, con: sqlite3.Connection | None) -> tuple[int, list[dict]]:
+    own_connection = con is None
+    insert_count = 0
+    committed = []
+    batch = {}
+    copies = {}  # invoice -> every bill of the batch written under it
+    batch_lines = 0
 
-        # Loop through each bill
-        for bill_dict in all_bill_data:
-            invoice_no = bill_dict.get("Invoice_No")
-            issue_date = bill_dict.get("Issue_Date")
-            billed_to = bill_dict.get("billed_to")
-            billed_by = bill_dict.get("billed_by")
-            grand_total = bill_dict.get("Grand_Total")
-            source_file = bill_dict.get("source_file")
+    def write():
+        nonlocal insert_count
+        for invoice_no in _write_batch(con, list(batch.values())):
+            insert_count += len(batch[invoice_no][1])
+            committed.extend(copies[invoice_no])
 
-            line_items = bill_dict.get("line_items", [])
+    try:
+        if own_connection:
+            con = connect_db()
 
-            if not line_items:
-                print(f"Skipping invoice {invoice_no}: no line items to insert.")
+        for bill_dict in bills:
+            if not bill_dict.get("line_items"):
+                logger.warning("Skipping invoice %s: no line items to insert.", bill_dict.get('Invoice_No'))
+                continue
+            if bill_dict.get("Invoice_No") is None:
+                logger.warning("Skipping bill %s: no invoice number.", bill_dict.get('source_file'))
                 continue
 
-            # Insert one row per line item
-            for line_id, item in enumerate(line_items, start=1):
-                desc = item.get('service_description')
-                amt = item.get('Amount')
-                category = item.get('Category')
-                try:
-                    cur.execute(
-                        f"""
-                        INSERT OR REPLACE INTO {TABLE_NAME}
-                        (
-                            Invoice_No,
-                            line_item_id,
-                            Issue_Date,
-                            billed_to,
-                            billed_by,
-                            Description,
-                            Category,
-                            Amount,
-                            Grand_Total,
-                            source_file
-                        )
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        """,
-                        (
-                            invoice_no,
-                            line_id,
-                            issue_date,
-                            billed_to,
-                            billed_by,
-                            desc,
-                            category,
-                            amt,
-                            grand_total,
-                            source_file,
-                        ),
-                    )
-                    insert_count += 1
-
-                except sqlite3.IntegrityError as e:
-                    print(
-                        f"Duplicate skipped: Invoice {invoice_no}, "
-                        f"line_item_id {line_id} → {e}"
-                    )
-
-        con.commit()
-        print(f"data insertion for {insert_count} completed")
-
-    except sqlite3.Error as e:
-        print(f"SQLite Error: {e}")
+            # Keyed by invoice: a bill repeated within one batch replaces the earlier copy
+            invoice_row, line_rows = bill_to_rows(bill_dict)
+            previous = batch.pop(invoice_row[0], None)
+            if previous:
+                batch_lines -= len(previous[1])
+            batch[invoice_row[0]] = (invoice_row, line_rows)
+            copies.setdefault(invoice_row[0], []).append(bill_dict)
+            batch_lines += len(line_rows)
+            if batch_lines >= batch_size:
+                write()
+                batch = {}
+                copies = {}
+                batch_lines = 0
 
-    except Exception as e:
-        print(f"General Error during insertion: {e}")
+        if batch:
+            write()
+        inc("line_items_inserted", insert_count)
+        return insert_count, committed
 
     finally:
-        if con:
+        if own_connection and con:
             con.close()
 
-def insert_single_bill_data(bill_dict: dict) -> int:
+
+def insert_bills(bills, batch_size: int = DEFAULT_BATCH_SIZE, con: sqlite3.Connection | None = None) -> int:
     """
-    Inserts a single structured bill dictionary into the database.
+    Streams any iterable of parsed bills into the database with executemany,
+    committing one transaction per batch_size line items.
+    Args:
+        bills: iterable of bill dicts (as returned by the parser).
+        batch_size: line items per transaction.
+        con: optional open connection (e.g. from connect_db); opened and closed here otherwise.
     Returns the number of line items inserted.
     """
-    con = None
-    insert_count = 0
+    return _insert(bills, batch_size, con)[0]
 
+
+def commit_bills(bills, batch_size: int = DEFAULT_BATCH_SIZE, con: sqlite3.Connection | None = None) -> list[dict]:
+    """
+    Same as insert_bills, but returns the bills whose rows were committed. Bills skipped
+    (no line items, no invoice number) or rolled back on an IntegrityError are left out.
+    """
+    return _insert(bills, batch_size, con)[1]
+
+
+def insert_extracted_data():
     try:
-        con = sqlite3.connect(DB_NAME)
-        cur = con.cursor()
-
-        invoice_no = bill_dict.get("Invoice_No")
-        issue_date = bill_dict.get("Issue_Date")
-        billed_to = bill_dict.get("billed_to")
-        billed_by = bill_dict.get("billed_by")
-        grand_total = bill_dict.get("Grand_Total")
-        source_file = bill_dict.get("source_file")
-        line_items = bill_dict.get("line_items", [])
-
-        if not line_items:
-            print(f"Skipping invoice {invoice_no}: no line items to insert.")
-            return 0
-
-        for line_id, item in enumerate(line_items, start=1):
-            desc = item.get('service_description')
-            amt = item.get('Amount')
-            category = item.get('Category')
+        # Bills are parsed lazily from the OCR records and streamed into insert_bills
+        insert_count = insert_bills(iter_parsed_invoices())
+        if not insert_count:
+            logger.info("no data")
+            return
 
-            try:
-                cur.execute(
-                    f"""
-                    INSERT OR REPLACE INTO {TABLE_NAME}
-                    (
-                        Invoice_No,
-                        line_item_id,
-                        Issue_Date,
-                        billed_to,
-                        billed_by,
-                        Description,
-                        Category,
-                        Amount,
-                        Grand_Total,
-                        source_file
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (
-                        invoice_no,
-                        line_id,
-                        issue_date,
-                        billed_to,
-                        billed_by,
-                        desc,
-                        category,
-                        amt,
-                        grand_total,
-                        source_file,
-                    ),
-                )
-                insert_count += 1
-            except sqlite3.IntegrityError as e:
-                print(
-                    f"Duplicate skipped: Invoice {invoice_no}, "
-                    f"line_item_id {line_id} → {e}"
-                )
+        logger.info("data insertion for %d completed", insert_count)
 
-        con.commit()
-        print(f"Inserted {insert_count} line items for invoice {invoice_no}.")
+    except sqlite3.Error as e:
+        logger.error("SQLite Error: %s", e)
+
+    except Exception as e:
+        logger.error("General Error during insertion: %s", e)
+
+def insert_single_bill_data(bill_dict: dict) -> int:
+    """
+    Inserts a single structured bill dictionary into the database.
+    Returns the number of line items inserted.
+    """
+    try:
+        insert_count = insert_bills([bill_dict])
+        if insert_count:
+            logger.info("Inserted %d line items for invoice %s.", insert_count, bill_dict.get('Invoice_No'))
         return insert_count
 
     except sqlite3.Error as e:
-        print(f"SQLite Error during single bill insertion: {e}")
+        logger.error("SQLite Error during single bill insertion: %s", e)
         return 0
     except Exception as e:
-        print(f"General Error during single bill insertion: {e}")
+        logger.error("General Error during single bill insertion: %s", e)
         return 0
-    finally:
-        if con:
-            con.close()
 
 
 if __name__ == "__main__":
+    from metrics import configure_logging
+    configure_logging()
     insert_extracted_data()
@@ -0,0 +1,79 @@
+import re
+from datetime import datetime
+import pandas as pd
+
+# Converts the free-text Issue_Date written by the LLM into ISO-8601 (YYYY-MM-DD).
+# prompt1 asks for MM/DD/YYYY, so month-first formats are tried before day-first ones;
+# day-first only matches when the month-first reading is impossible (e.g. 25/12/2025).
+DATE_FORMATS = [
+    "%m/%d/%Y", "%m-%d-%Y", "%m.%d.%Y",
+    "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y",
+    "%Y-%m-%d", "%Y/%m/%d",
+    "%m/%d/%y", "%d/%m/%y", "%m-%d-%y", "%d-%m-%y",
+    "%d %b %Y", "%d %B %Y", "%b %d %Y", "%B %d %Y",
+    "%d-%b-%Y", "%d-%b-%y",
+]
+
+MIN_YEAR = 1990
+MAX_YEAR = 2100
+
+_NOISE = re.compile(r"[^0-9A-Za-z/\-. ]")
+_NUMERIC_DATE = re.compile(r"\d{1,4}[/\-.]\d{1,2}[/\-.]\d{2,4}")
+
+
+def _clean(text: str) -> str:
+    # "Dec 25, 2025++" -> "Dec 25 2025"
+    return " ".join(_NOISE.sub(" ", text.replace(",", " ")).split())
+
+
+def normalize_date(value) -> str | None:
+    """Returns the date as YYYY-MM-DD, or None if it cannot be parsed."""
+    if value is None:
+        return None
+    text = _clean(str(value))
+    if not text:
+        return None
+
+    candidates = [text]
+    match = _NUMERIC_DATE.search(text)
+    if match and match.group(0) != text:
+        candidates.append(match.group(0))
+
+    for candidate in candidates:
+        for fmt in DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(candidate, fmt)
+            except ValueError:
+                continue
+            if MIN_YEAR <= parsed.year <= MAX_YEAR:
+                return parsed.strftime("%Y-%m-%d")
+    return None
+
+
+def normalize_dates(values: pd.Series) -> pd.Series:
+    """
+    Vectorized normalize_date for backfilling whole columns: each format is
+    parsed over the still-unparsed rows at once instead of row by row.
+    Returns a Series of YYYY-MM-DD strings (None where unparseable).
+    """
+    text = values.astype("string").str.replace(",", " ", regex=False)
+    text = text.str.replace(_NOISE.pattern, " ", regex=True).str.split().str.join(" ")
+    extracted = text.str.extract(f"({_NUMERIC_DATE.pattern})", expand=False)
+
+    parsed = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+    for candidate in (text, extracted):
+        for fmt in DATE_FORMATS:
+            missing = parsed.isna() & candidate.notna()
+            if not missing.any():
+                break
+            attempt = pd.to_datetime(candidate[missing], format=fmt, errors="coerce")
+            attempt = attempt[(attempt.dt.year >= MIN_YEAR) & (attempt.dt.year <= MAX_YEAR)]
+            parsed.loc[attempt.index] = attempt
+
+    iso = parsed.dt.strftime("%Y-%m-%d")
+    return iso.astype(object).where(parsed.notna(), None)
+
+
+if __name__ == "__main__":
+    for sample in ["12/25/2025++", "25-12-2025", "2025-12-25", "Dec 25, 2025", "03/04/25", "n/a"]:
+        print(f"{sample!r} -> {normalize_date(sample)}")
@@ -0,0 +1,469 @@
+import logging
+import sqlite3
+import pandas as pd
+from date_normalizer import normalize_dates
+
+# Versioned schema for ocr_master.db, tracked in PRAGMA user_version.
+#   version 1: single ocr_line_items table (invoice header repeated on every line item)
+#   version 2: invoices header table + line_items child table with indexes;
+#              ocr_line_items is kept as a view so existing queries still work
+#   version 3: invoices.Issue_Date_ISO (YYYY-MM-DD, indexed) next to the raw Issue_Date text
+#   version 4: category x month and vendor x month summary tables kept current by triggers
+#   version 5: summary triggers also handle REPLACE overwrites on any connection
+#              (rows about to be overwritten are parked in *_overwritten tables)
+
+DB_NAME = "ocr_master.db"
+SCHEMA_VERSION = 5
+
+logger = logging.getLogger(__name__)
+
+
+def get_schema_version(con: sqlite3.Connection) -> int:
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version == 0:
+        # Databases created before versioning have the single ocr_line_items table
+        legacy = con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ocr_line_items'"
+        ).fetchone()
+        return 1 if legacy else 0
+    return version
+
+
+def _create_v2_objects(con: sqlite3.Connection):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS invoices (
+            Invoice_No TEXT PRIMARY KEY,
+            Issue_Date TEXT,
+            billed_to TEXT,
+            billed_by TEXT,
+            Grand_Total REAL,
+            source_file TEXT
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS line_items (
+            Invoice_No TEXT NOT NULL REFERENCES invoices (Invoice_No),
+            line_item_id INTEGER NOT NULL,
+            Description TEXT,
+            Category TEXT,
+            Amount REAL,
+            PRIMARY KEY (Invoice_No, line_item_id)
+        )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_line_items_category ON line_items (Category)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_invoices_issue_date ON invoices (Issue_Date)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_invoices_billed_by ON invoices (billed_by)")
+
+    # Compatibility view with the original column layout (used by prompt3 and the dashboard)
+    con.execute("""
+        CREATE VIEW IF NOT EXISTS ocr_line_items AS
+        SELECT
+            li.Invoice_No,
+            li.line_item_id,
+            inv.Issue_Date,
+            inv.billed_to,
+            inv.billed_by,
+            li.Description,
+            li.Category,
+            li.Amount,
+            inv.Grand_Total,
+            inv.source_file
+        FROM line_items li
+        JOIN invoices inv ON inv.Invoice_No = li.Invoice_No
+    """)
+    # Old-style inserts into the view are split into the two tables
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS ocr_line_items_insert
+        INSTEAD OF INSERT ON ocr_line_items
+        BEGIN
+            INSERT INTO invoices (Invoice_No, Issue_Date, billed_to, billed_by, Grand_Total, source_file)
+            VALUES (NEW.Invoice_No, NEW.Issue_Date, NEW.billed_to, NEW.billed_by, NEW.Grand_Total, NEW.source_file)
+            ON CONFLICT (Invoice_No) DO UPDATE SET
+                Issue_Date = excluded.Issue_Date,
+                billed_to = excluded.billed_to,
+                billed_by = excluded.billed_by,
+                Grand_Total = excluded.Grand_Total,
+                source_file = excluded.source_file;
+            INSERT OR REPLACE INTO line_items (Invoice_No, line_item_id, Description, Category, Amount)
+            VALUES (NEW.Invoice_No, NEW.line_item_id, NEW.Description, NEW.Category, NEW.Amount);
+        END
+    """)
+
+
+def _migrate_to_v2(con: sqlite3.Connection, from_version: int):
+    if from_version == 1:
+        con.execute("ALTER TABLE ocr_line_items RENAME TO ocr_line_items_v1")
+
+    _create_v2_objects(con)
+
+    if from_version == 1:
+        # One header per invoice (taken from its first line item), then the line items
+        con.execute("""
+            INSERT OR REPLACE INTO invoices (Invoice_No, Issue_Date, billed_to, billed_by, Grand_Total, source_file)
+            SELECT Invoice_No, Issue_Date, billed_to, billed_by, Grand_Total, source_file
+            FROM ocr_line_items_v1 v
+            WHERE line_item_id = (SELECT MIN(line_item_id) FROM ocr_line_items_v1 WHERE Invoice_No = v.Invoice_No)
+        """)
+        con.execute("""
+            INSERT OR REPLACE INTO line_items (Invoice_No, line_item_id, Description, Category, Amount)
+            SELECT Invoice_No, line_item_id, Description, Category, Amount
+            FROM ocr_line_items_v1
+        """)
+        con.execute("DROP TABLE ocr_line_items_v1")
+
+
+def backfill_iso_dates(con: sqlite3.Connection) -> int:
+    """Fills Issue_Date_ISO for every invoice that lacks it. Returns the number of rows parsed."""
+    missing = pd.read_sql_query(
+        "SELECT Invoice_No, Issue_Date FROM invoices WHERE Issue_Date_ISO IS NULL AND Issue_Date IS NOT NULL", con
+    )
+    if missing.empty:
+        return 0
+    missing["Issue_Date_ISO"] = normalize_dates(missing["Issue_Date"])
+    parsed = missing[missing["Issue_Date_ISO"].notna()]
+    con.executemany(
+        "UPDATE invoices SET Issue_Date_ISO = ? WHERE Invoice_No = ?",
+        zip(parsed["Issue_Date_ISO"], parsed["Invoice_No"]),
+    )
+    return len(parsed)
+
+
+def _migrate_to_v3(con: sqlite3.Connection, from_version: int):
+    con.execute("ALTER TABLE invoices ADD COLUMN Issue_Date_ISO TEXT")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_invoices_issue_date_iso ON invoices (Issue_Date_ISO)")
+
+    # The compatibility view gains the ISO column (appended, so existing column positions stay)
+    con.execute("DROP TRIGGER IF EXISTS ocr_line_items_insert")
+    con.execute("DROP VIEW IF EXISTS ocr_line_items")
+    con.execute("""
+        CREATE VIEW ocr_line_items AS
+        SELECT
+            li.Invoice_No,
+            li.line_item_id,
+            inv.Issue_Date,
+            inv.billed_to,
+            inv.billed_by,
+            li.Description,
+            li.Category,
+            li.Amount,
+            inv.Grand_Total,
+            inv.source_file,
+            inv.Issue_Date_ISO
+        FROM line_items li
+        JOIN invoices inv ON inv.Invoice_No = li.Invoice_No
+    """)
+    con.execute("""
+        CREATE TRIGGER ocr_line_items_insert
+        INSTEAD OF INSERT ON ocr_line_items
+        BEGIN
+            INSERT INTO invoices (Invoice_No, Issue_Date, billed_to, billed_by, Grand_Total, source_file, Issue_Date_ISO)
+            VALUES (NEW.Invoice_No, NEW.Issue_Date, NEW.billed_to, NEW.billed_by, NEW.Grand_Total, NEW.source_file, NEW.Issue_Date_ISO)
+            ON CONFLICT (Invoice_No) DO UPDATE SET
+                Issue_Date = excluded.Issue_Date,
+                billed_to = excluded.billed_to,
+                billed_by = excluded.billed_by,
+                Grand_Total = excluded.Grand_Total,
+                source_file = excluded.source_file,
+                Issue_Date_ISO = excluded.Issue_Date_ISO;
+            INSERT OR REPLACE INTO line_items (Invoice_No, line_item_id, Description, Category, Amount)
+            VALUES (NEW.Invoice_No, NEW.line_item_id, NEW.Description, NEW.Category, NEW.Amount);
+        END
+    """)
+    backfill_iso_dates(con)
+
+
+# --- version 4: summary tables ---
+
+MONTH_SQL = "COALESCE(substr({ref}.Issue_Date_ISO, 1, 7), 'unknown')"
+
+CATEGORY_UPSERT = """
+    ON CONFLICT (Category, month) DO UPDATE SET
+        total_amount = total_amount + excluded.total_amount,
+        item_count = item_count + excluded.item_count
+"""
+
+VENDOR_UPSERT = """
+    ON CONFLICT (billed_by, month) DO UPDATE SET
+        total_amount = total_amount + excluded.total_amount,
+        item_count = item_count + excluded.item_count,
+        invoice_count = invoice_count + excluded.invoice_count,
+        grand_total = grand_total + excluded.grand_total
+"""
+
+PRUNE_EMPTY_SUMMARY_ROWS = """
+    DELETE FROM category_month_summary WHERE item_count = 0;
+    DELETE FROM vendor_month_summary WHERE item_count = 0 AND invoice_count = 0;
+"""
+
+
+def _line_item_delta(ref: str, sign: int, parked: str | None = None) -> str:
+    # One line item (NEW/OLD row of line_items, or the row of the `parked` table with NEW's key),
+    # attributed through its invoice; lines whose invoice does not exist yet are counted
+    # when the invoice is inserted
+    month = MONTH_SQL.format(ref="inv")
+    if parked:
+        rows = (f"{parked} {ref} JOIN invoices inv ON inv.Invoice_No = {ref}.Invoice_No "
+                f"WHERE {ref}.Invoice_No = NEW.Invoice_No AND {ref}.line_item_id = NEW.line_item_id")
+    else:
+        rows = f"invoices inv WHERE inv.Invoice_No = {ref}.Invoice_No"
+    return f"""
+        INSERT INTO category_month_summary (Category, month, total_amount, item_count)
+        SELECT COALESCE({ref}.Category, 'Uncategorized'), {month}, {sign} * COALESCE({ref}.Amount, 0), {sign}
+        FROM {rows}
+        {CATEGORY_UPSERT};
+        INSERT INTO vendor_month_summary (billed_by, month, total_amount, item_count, invoice_count, grand_total)
+        SELECT COALESCE(inv.billed_by, 'Unknown'), {month}, {sign} * COALESCE({ref}.Amount, 0), {sign}, 0, 0
+        FROM {rows}
+        {VENDOR_UPSERT};
+    """
+
+
+def _invoice_delta(ref: str, sign: int) -> str:
+    # One invoice (NEW/OLD row of invoices) together with all of its current line items
+    month = MONTH_SQL.format(ref=ref)
+    return f"""
+        INSERT INTO category_month_summary (Category, month, total_amount, item_count)
+        SELECT COALESCE(li.Category, 'Uncategorized'), {month}, {sign} * COALESCE(SUM(li.Amount), 0), {sign} * COUNT(*)
+        FROM line_items li WHERE li.Invoice_No = {ref}.Invoice_No
+        GROUP BY COALESCE(li.Category, 'Uncategorized')
+        {CATEGORY_UPSERT};
+        INSERT INTO vendor_month_summary (billed_by, month, total_amount, item_count, invoice_count, grand_total)
+        SELECT COALESCE({ref}.billed_by, 'Unknown'), {month}, {sign} * COALESCE(SUM(li.Amount), 0), {sign} * COUNT(*),
+               {sign}, {sign} * COALESCE({ref}.Grand_Total, 0)
+        FROM line_items li WHERE li.Invoice_No = {ref}.Invoice_No
+        {VENDOR_UPSERT};
+    """
+
+
+def _parked_invoice_delta(parked: str, sign: int) -> str:
+    # The row of the `parked` invoices table with NEW's key, together with all of its current line items
+    month = MONTH_SQL.format(ref="p")
+    return f"""
+        INSERT INTO category_month_summary (Category, month, total_amount, item_count)
+        SELECT COALESCE(li.Category, 'Uncategorized'), {month}, {sign} * COALESCE(SUM(li.Amount), 0), {sign} * COUNT(*)
+        FROM {parked} p JOIN line_items li ON li.Invoice_No = p.Invoice_No
+        WHERE p.Invoice_No = NEW.Invoice_No
+        GROUP BY COALESCE(li.Category, 'Uncategorized')
+        {CATEGORY_UPSERT};
+        INSERT INTO vendor_month_summary (billed_by, month, total_amount, item_count, invoice_count, grand_total)
+        SELECT COALESCE(p.billed_by, 'Unknown'), {month}, {sign} * COALESCE(SUM(li.Amount), 0), {sign} * COUNT(li.Invoice_No),
+               {sign}, {sign} * COALESCE(p.Grand_Total, 0)
+        FROM {parked} p LEFT JOIN line_items li ON li.Invoice_No = p.Invoice_No
+        WHERE p.Invoice_No = NEW.Invoice_No
+        GROUP BY p.Invoice_No
+        {VENDOR_UPSERT};
+    """
+
+
+def rebuild_summaries(con: sqlite3.Connection):
+    """Recomputes both summary tables from scratch."""
+    con.execute("DELETE FROM category_month_summary")
+    con.execute("DELETE FROM vendor_month_summary")
+    month = MONTH_SQL.format(ref="inv")
+    con.execute(f"""
+        INSERT INTO category_month_summary (Category, month, total_amount, item_count)
+        SELECT COALESCE(li.Category, 'Uncategorized'), {month}, COALESCE(SUM(li.Amount), 0), COUNT(*)
+        FROM line_items li JOIN invoices inv ON inv.Invoice_No = li.Invoice_No
+        GROUP BY 1, 2
+    """)
+    con.execute(f"""
+        INSERT INTO vendor_month_summary (billed_by, month, total_amount, item_count, invoice_count, grand_total)
+        SELECT COALESCE(inv.billed_by, 'Unknown'), {month},
+               COALESCE(SUM(lines.total_amount), 0), COALESCE(SUM(lines.item_count), 0),
+               COUNT(*), COALESCE(SUM(inv.Grand_Total), 0)
+        FROM invoices inv
+        LEFT JOIN (
+            SELECT Invoice_No, SUM(Amount) AS total_amount, COUNT(*) AS item_count
+            FROM line_items GROUP BY Invoice_No
+        ) lines ON lines.Invoice_No = inv.Invoice_No
+        GROUP BY 1, 2
+    """)
+
+
+def _migrate_to_v4(con: sqlite3.Connection, from_version: int):
+    con.execute("""
+        CREATE TABLE category_month_summary (
+            Category TEXT NOT NULL,
+            month TEXT NOT NULL,
+            total_amount REAL NOT NULL DEFAULT 0,
+            item_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (Category, month)
+        )
+    """)
+    con.execute("""
+        CREATE TABLE vendor_month_summary (
+            billed_by TEXT NOT NULL,
+            month TEXT NOT NULL,
+            total_amount REAL NOT NULL DEFAULT 0,
+            item_count INTEGER NOT NULL DEFAULT 0,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            grand_total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (billed_by, month)
+        )
+    """)
+
+    # Every change is applied as "subtract the old row, add the new row", so updates and
+    # deletes keep the totals exact (REPLACE overwrites are handled from version 5 on)
+    triggers = {
+        "line_items_summary_insert": ("AFTER INSERT ON line_items", _line_item_delta("NEW", 1)),
+        "line_items_summary_delete": ("AFTER DELETE ON line_items", _line_item_delta("OLD", -1) + PRUNE_EMPTY_SUMMARY_ROWS),
+        "line_items_summary_update": ("AFTER UPDATE ON line_items",
+                                      _line_item_delta("OLD", -1) + _line_item_delta("NEW", 1) + PRUNE_EMPTY_SUMMARY_ROWS),
+        "invoices_summary_insert": ("AFTER INSERT ON invoices", _invoice_delta("NEW", 1)),
+        "invoices_summary_delete": ("AFTER DELETE ON invoices", _invoice_delta("OLD", -1) + PRUNE_EMPTY_SUMMARY_ROWS),
+        "invoices_summary_update": ("AFTER UPDATE OF Issue_Date_ISO, billed_by, Grand_Total ON invoices",
+                                    _invoice_delta("OLD", -1) + _invoice_delta("NEW", 1) + PRUNE_EMPTY_SUMMARY_ROWS),
+    }
+    for name, (event, body) in triggers.items():
+        con.execute(f"CREATE TRIGGER {name} {event} BEGIN {body} END")
+
+    # View inserts upsert line items so the update trigger (not a silent REPLACE) sees overwrites
+    con.execute("DROP TRIGGER IF EXISTS ocr_line_items_insert")
+    con.execute("""
+        CREATE TRIGGER ocr_line_items_insert
+        INSTEAD OF INSERT ON ocr_line_items
+        BEGIN
+            INSERT INTO invoices (Invoice_No, Issue_Date, billed_to, billed_by, Grand_Total, source_file, Issue_Date_ISO)
+            VALUES (NEW.Invoice_No, NEW.Issue_Date, NEW.billed_to, NEW.billed_by, NEW.Grand_Total, NEW.source_file, NEW.Issue_Date_ISO)
+            ON CONFLICT (Invoice_No) DO UPDATE SET
+                Issue_Date = excluded.Issue_Date,
+                billed_to = excluded.billed_to,
+                billed_by = excluded.billed_by,
+                Grand_Total = excluded.Grand_Total,
+                source_file = excluded.source_file,
+                Issue_Date_ISO = excluded.Issue_Date_ISO;
+            INSERT INTO line_items (Invoice_No, line_item_id, Description, Category, Amount)
+            VALUES (NEW.Invoice_No, NEW.line_item_id, NEW.Description, NEW.Category, NEW.Amount)
+            ON CONFLICT (Invoice_No, line_item_id) DO UPDATE SET
+                Description = excluded.Description,
+                Category = excluded.Category,
+                Amount = excluded.Amount;
+        END
+    """)
+    rebuild_summaries(con)
+
+
+def _migrate_to_v5(con: sqlite3.Connection, from_version: int):
+    # INSERT OR REPLACE deletes the conflicting row without firing the delete triggers
+    # (unless the writer enabled PRAGMA recursive_triggers). So BEFORE INSERT parks that row,
+    # and AFTER INSERT subtracts it; when the delete triggers do fire, or the insert turns
+    # into an upsert's update, those triggers subtract the old row and drop the parked copy.
+    # A copy left parked by INSERT OR IGNORE is never subtracted: the next insert of that key
+    # parks the current row again first.
+    con.execute("""
+        CREATE TABLE line_items_overwritten (
+            Invoice_No TEXT NOT NULL,
+            line_item_id INTEGER NOT NULL,
+            Category TEXT,
+            Amount REAL,
+            PRIMARY KEY (Invoice_No, line_item_id)
+        )
+    """)
+    con.execute("""
+        CREATE TABLE invoices_overwritten (
+            Invoice_No TEXT PRIMARY KEY,
+            billed_by TEXT,
+            Grand_Total REAL,
+            Issue_Date_ISO TEXT
+        )
+    """)
+
+    unpark_line = ("DELETE FROM line_items_overwritten "
+                   "WHERE Invoice_No = {ref}.Invoice_No AND line_item_id = {ref}.line_item_id;")
+    unpark_invoice = "DELETE FROM invoices_overwritten WHERE Invoice_No = {ref}.Invoice_No;"
+    triggers = {
+        "line_items_summary_park": ("BEFORE INSERT ON line_items", f"""
+            {unpark_line.format(ref="NEW")}
+            INSERT INTO line_items_overwritten (Invoice_No, line_item_id, Category, Amount)
+            SELECT Invoice_No, line_item_id, Category, Amount FROM line_items
+            WHERE Invoice_No = NEW.Invoice_No AND line_item_id = NEW.line_item_id;
+        """),
+        "line_items_summary_insert": ("AFTER INSERT ON line_items",
+                                      _line_item_delta("p", -1, parked="line_items_overwritten")
+                                      + unpark_line.format(ref="NEW") + _line_item_delta("NEW", 1)
+                                      + PRUNE_EMPTY_SUMMARY_ROWS),
+        "line_items_summary_delete": ("AFTER DELETE ON line_items",
+                                      _line_item_delta("OLD", -1) + unpark_line.format(ref="OLD")
+                                      + PRUNE_EMPTY_SUMMARY_ROWS),
+        "line_items_summary_update": ("AFTER UPDATE ON line_items",
+                                      _line_item_delta("OLD", -1) + _line_item_delta("NEW", 1)
+                                      + unpark_line.format(ref="OLD") + unpark_line.format(ref="NEW")
+                                      + PRUNE_EMPTY_SUMMARY_ROWS),
+        "invoices_summary_park": ("BEFORE INSERT ON invoices", f"""
+            {unpark_invoice.format(ref="NEW")}
+            INSERT INTO invoices_overwritten (Invoice_No, billed_by, Grand_Total, Issue_Date_ISO)
+            SELECT Invoice_No, billed_by, Grand_Total, Issue_Date_ISO FROM invoices
+            WHERE Invoice_No = NEW.Invoice_No;
+        """),
+        "invoices_summary_insert": ("AFTER INSERT ON invoices",
+                                    _parked_invoice_delta("invoices_overwritten", -1)
+                                    + unpark_invoice.format(ref="NEW") + _invoice_delta("NEW", 1)
+                                    + PRUNE_EMPTY_SUMMARY_ROWS),
+        "invoices_summary_delete": ("AFTER DELETE ON invoices",
+                                    _invoice_delta("OLD", -1) + unpark_invoice.format(ref="OLD")
+                                    + PRUNE_EMPTY_SUMMARY_ROWS),
+        "invoices_summary_update": ("AFTER UPDATE OF Issue_Date_ISO, billed_by, Grand_Total ON invoices",
+                                    _invoice_delta("OLD", -1) + _invoice_delta("NEW", 1) + PRUNE_EMPTY_SUMMARY_ROWS),
+        # Any column: an upsert that changes none of the summarized ones still leaves a parked copy
+        "invoices_summary_unpark": ("AFTER UPDATE ON invoices",
+                                    unpark_invoice.format(ref="OLD") + unpark_invoice.format(ref="NEW")),
+    }
+    for name, (event, body) in triggers.items():
+        con.execute(f"DROP TRIGGER IF EXISTS {name}")
+        con.execute(f"CREATE TRIGGER {name} {event} BEGIN {body} END")
+    # Totals written by REPLACE overwrites under version 4 may have drifted
+    rebuild_summaries(con)
+
+
+MIGRATIONS = {
+    2: _migrate_to_v2,
+    3: _migrate_to_v3,
+    4: _migrate_to_v4,
+    5: _migrate_to_v5,
+}
+
+
+def ensure_schema(con: sqlite3.Connection) -> int:
+    """
+    Creates or migrates the database in place to SCHEMA_VERSION.
+    Each migration step runs in its own write transaction. Returns the resulting version.
+    """
+    version = get_schema_version(con)
+    is_new_database = version == 0
+    while version < SCHEMA_VERSION:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            # Another connection may have migrated while we waited for the write lock
+            version = get_schema_version(con)
+            if version >= SCHEMA_VERSION:
+                con.execute("COMMIT")
+                break
+            # A new database (version 0) starts from the version 2 layout
+            target = max(version, 1) + 1
+            MIGRATIONS[target](con, version)
+            con.execute(f"PRAGMA user_version = {target}")
+            con.execute("COMMIT")
+        except sqlite3.Error:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+        if not is_new_database:
+            logger.info("Database migrated from schema version %d to %d", version, target)
+        version = target
+    return version
+
+
+if __name__ == "__main__":
+    con = None
+    try:
+        con = sqlite3.connect(DB_NAME, isolation_level=None)
+        before = get_schema_version(con)
+        after = ensure_schema(con)
+        if before == 1:
+            con.execute("VACUUM")  # reclaim the space of the old wide table
+        print(f"schema version {after}")
+    except sqlite3.Error as e:
+        print(f"error is {e}")
+    finally:
+        if con:
+            con.close()
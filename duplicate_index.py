@@ -0,0 +1,293 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+import cv2
+import numpy as np
+from image_cleaning import decode_grayscale
+from metrics import inc
+
+# Near-duplicate detection for bill images: the same physical bill sent again as another
+# photo, scan or file name is recognised before cleaning, OCR and the LLM run.
+# Every accepted image gets two perceptual hashes of its ink map in the image_hashes table:
+# a 256-bit hash to find candidates quickly and a 1024-bit one to confirm them, because
+# receipts printed from the same template are close at 256 bits even when the items differ.
+
+DB_NAME = "ocr_master.db"
+HASH_TABLE = "image_hashes"
+
+# Lowest 16x16 (candidate) and 32x32 (confirmation) DCT coefficients of a 128x128 ink map
+HASH_SIZE = 16
+HASH_BITS = HASH_SIZE * HASH_SIZE
+FINE_HASH_SIZE = 32
+FINE_HASH_BITS = FINE_HASH_SIZE * FINE_HASH_SIZE
+# Candidate radius on the 256-bit hash: re-encoded, rescaled, relit and cropped copies of a
+# receipt stay within ~14 bits of the original
+CANDIDATE_DISTANCE = 16
+# Max 1024-bit distance of a confirmed duplicate. Copies of a receipt are mostly within ~60
+# bits; different receipts from the same template are 80+ bits apart
+DUPLICATE_DISTANCE = int(os.environ.get("BILL_DUPLICATE_DISTANCE", "64"))
+# The hash only needs a coarse ink map, so large photos are decoded at reduced resolution
+HASH_DECODE_PIXELS = 1024 * 1024
+# Rows / columns with less ink than this share are margin or specks, not content
+MIN_INK_FRACTION = 0.01
+
+logger = logging.getLogger(__name__)
+
+
+def ink_map(gray_image) -> np.ndarray:
+    """
+    Binarized ink (1.0) vs paper (0.0), cropped to the printed content. Receipts are mostly
+    blank paper, whose pixel noise would flip the bits of a plain grayscale hash; after
+    binarization blank areas are exactly 0 and cropping removes framing and margins.
+    """
+    blurred = cv2.GaussianBlur(gray_image, (3, 3), 0)
+    _, ink = cv2.threshold(blurred, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    rows = np.flatnonzero(ink.sum(axis=1) > ink.shape[1] * MIN_INK_FRACTION)
+    cols = np.flatnonzero(ink.sum(axis=0) > ink.shape[0] * MIN_INK_FRACTION)
+    if len(rows) and len(cols):
+        ink = ink[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    return ink.astype(np.float32)
+
+
+def _dct_hash(dct: np.ndarray, size: int) -> int:
+    coefficients = dct[:size, :size].flatten()
+    bits = coefficients > np.median(coefficients[1:])  # DC term left out of the median
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def perceptual_hashes(gray_image) -> tuple[int, int]:
+    """pHashes (256-bit, 1024-bit): signs of the low-frequency DCT coefficients of the ink map against their median."""
+    size = 4 * FINE_HASH_SIZE
+    dct = cv2.dct(cv2.resize(ink_map(gray_image), (size, size), interpolation=cv2.INTER_AREA))
+    return _dct_hash(dct, HASH_SIZE), _dct_hash(dct, FINE_HASH_SIZE)
+
+
+def image_hashes(image_bytes: bytes) -> tuple[int, int] | None:
+    """Perceptual hashes of encoded image bytes, None if they are not a readable image."""
+    gray_image = decode_grayscale(image_bytes, HASH_DECODE_PIXELS)
+    if gray_image is None:
+        return None
+    return perceptual_hashes(gray_image)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    """
+    In-memory Hamming-distance index. Hashes are split into max_distance + 1 bit ranges,
+    each with an exact-match table: two hashes within max_distance bits must agree exactly
+    on at least one range, so a lookup is max_distance + 1 dictionary probes plus a distance
+    check of the few candidates found, not a scan of every stored hash.
+    (A BK-tree prunes poorly here: distances between receipt hashes are concentrated
+    in a narrow band, so most branches stay within the search radius.)
+    """
+
+    def __init__(self, max_distance: int = CANDIDATE_DISTANCE, bits: int = HASH_BITS):
+        self.max_distance = max_distance
+        parts = max_distance + 1
+        # (shift, mask) of each bit range; the ranges cover the hash exactly
+        bounds = [part * bits // parts for part in range(parts + 1)]
+        self._ranges = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self._tables = [defaultdict(list) for _ in range(parts)]
+        self._items = {}  # hash -> items stored under it
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _keys(self, value: int):
+        return ((value >> shift) & mask for shift, mask in self._ranges)
+
+    def add(self, value: int, item):
+        if value not in self._items:
+            self._items[value] = []
+            for table, key in zip(self._tables, self._keys(value)):
+                table[key].append(value)
+        self._items[value].append(item)
+
+    def remove(self, value: int, item):
+        items = self._items.get(value)
+        if not items or item not in items:
+            return
+        items.remove(item)
+        if not items:
+            del self._items[value]
+            for table, key in zip(self._tables, self._keys(value)):
+                table[key].remove(value)
+                if not table[key]:
+                    del table[key]
+
+    def search(self, value: int) -> list[tuple[int, object]]:
+        """(distance, item) for every stored item within max_distance, closest first."""
+        candidates = set()
+        for table, key in zip(self._tables, self._keys(value)):
+            candidates.update(table.get(key, ()))
+        matches = []
+        for candidate in candidates:
+            distance = hamming_distance(value, candidate)
+            if distance <= self.max_distance:
+                matches.extend((distance, item) for item in self._items[candidate])
+        return sorted(matches, key=lambda match: match[0])
+
+
+class DuplicateIndex:
+    """
+    image_hashes table in ocr_master.db plus a MultiIndexHash over the 256-bit hashes.
+    Rows: (content_hash, phash, phash_fine, source_file); the content hash (sha256) tells
+    a retry of the same file apart from a new version saved under its name.
+    Only bills that were inserted / saved are stored. While a bill is being processed its
+    hashes are held as an in-memory reservation, so a copy arriving at the same time is
+    still caught; the reservation is confirmed (stored) or released when processing ends.
+    """
+
+    def __init__(self, db_name: str = DB_NAME, max_distance: int = DUPLICATE_DISTANCE):
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(db_name, timeout=30, check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {HASH_TABLE} (
+                content_hash TEXT PRIMARY KEY,
+                phash TEXT NOT NULL,
+                phash_fine TEXT NOT NULL,
+                source_file TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._con.commit()
+
+        self._index = MultiIndexHash()
+        self._stored = set()  # content hashes loaded from / written to the table
+        self._loaded_until = 0.0
+        self._reserved = {}  # key -> (index value, index item) of a bill still being processed
+        with self._lock:
+            self._refresh()
+        logger.debug("Duplicate index: %d image hashes loaded", len(self._index))
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _refresh(self):
+        # Rows written since the last load, e.g. by the pipeline while the app is running.
+        # >= with the stored set: rows sharing the last timestamp are not missed or added twice
+        rows = self._con.execute(
+            f"SELECT content_hash, phash, phash_fine, source_file, created_at FROM {HASH_TABLE} WHERE created_at >= ?",
+            (self._loaded_until,),
+        ).fetchall()
+        for content_hash, phash, phash_fine, source_file, created_at in rows:
+            self._loaded_until = max(self._loaded_until, created_at)
+            if content_hash in self._stored:
+                continue
+            self._stored.add(content_hash)
+            # Hashes are stored as hex: 256-bit values do not fit an SQLite INTEGER
+            self._index.add(int(phash, 16), (source_file, content_hash, int(phash_fine, 16)))
+
+    def _find(self, hashes: tuple[int, int], content_hash: str, source_file: str, same_file_is_duplicate: bool):
+        value, fine_value = hashes
+        matches = []
+        for _, (stored_file, stored_content_hash, stored_fine_value) in self._index.search(value):
+            # The same file again (a retry) is never its own duplicate
+            if stored_file == source_file and (stored_content_hash == content_hash or not same_file_is_duplicate):
+                continue
+            distance = hamming_distance(fine_value, stored_fine_value)
+            if distance <= self.max_distance:
+                matches.append({"duplicate_of": stored_file, "distance": distance,
+                                "stored": stored_content_hash in self._stored})
+        return min(matches, key=lambda match: match["distance"], default=None)
+
+    def _reserve(self, key: str, hashes: tuple[int, int], content_hash: str, source_file: str):
+        self._release(key)
+        value, fine_value = hashes
+        item = (source_file, content_hash, fine_value)
+        if content_hash not in self._stored:
+            self._index.add(value, item)
+        self._reserved[key] = (value, item)
+
+    def _release(self, key: str):
+        reservation = self._reserved.pop(key, None)
+        if reservation and reservation[1][1] not in self._stored:
+            self._index.remove(*reservation)
+
+    def check(self, image_bytes: bytes, source_file: str, same_file_is_duplicate: bool = False,
+              reserve_as: str | None = None) -> dict | None:
+        """
+        Returns {"duplicate_of": source_file, "distance": bits, "stored": bool} for the closest
+        near-duplicate among the stored bills and the reservations ("stored": False, a bill still
+        being processed or reviewed). Nothing is stored; with reserve_as, an image that is not
+        a duplicate is reserved under that key until confirm() or release().
+        Earlier versions of source_file (same name, other content) count as the same bill being
+        updated, not as duplicates, unless same_file_is_duplicate: uploads pass True, because
+        photos of different bills often share names like "image.jpg".
+        Unreadable images return None and are left to the cleaning stage to reject.
+        """
+        hashes = image_hashes(image_bytes)
+        if hashes is None:
+            return None
+        content_hash = hashlib.sha256(image_bytes).hexdigest()
+        # Checked and reserved under one lock, so two copies in the same batch cannot both pass
+        with self._lock:
+            self._refresh()
+            duplicate = self._find(hashes, content_hash, source_file, same_file_is_duplicate)
+            if duplicate is None and reserve_as is not None:
+                self._reserve(reserve_as, hashes, content_hash, source_file)
+        if duplicate:
+            inc("duplicate_images")
+            logger.info("%s looks like a duplicate of %s (%d bits apart)",
+                        source_file, duplicate["duplicate_of"], duplicate["distance"])
+        return duplicate
+
+    def reserve(self, image_bytes: bytes, source_file: str, key: str):
+        """Reserves an image without checking it, e.g. a flagged duplicate the user chose to process anyway."""
+        hashes = image_hashes(image_bytes)
+        if hashes is not None:
+            with self._lock:
+                self._reserve(key, hashes, hashlib.sha256(image_bytes).hexdigest(), source_file)
+
+    def confirm(self, key: str):
+        """Stores the hashes reserved under key once their bill is in the database."""
+        with self._lock:
+            reservation = self._reserved.pop(key, None)
+            if reservation is None:
+                return
+            value, (source_file, content_hash, fine_value) = reservation
+            self._con.execute(
+                f"""
+                INSERT OR IGNORE INTO {HASH_TABLE} (content_hash, phash, phash_fine, source_file, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (content_hash, f"{value:0{HASH_BITS // 4}x}", f"{fine_value:0{FINE_HASH_BITS // 4}x}",
+                 source_file, time.time()),
+            )
+            self._con.commit()
+            self._stored.add(content_hash)
+
+    def release(self, key: str):
+        """Drops the reservation under key: its bill failed or was never saved."""
+        with self._lock:
+            self._release(key)
+
+    def close(self):
+        self._con.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="List near-duplicate bill images in a folder (nothing is stored)")
+    arg_parser.add_argument("folder")
+    arg_parser.add_argument("--max-distance", type=int, default=DUPLICATE_DISTANCE)
+    args = arg_parser.parse_args()
+
+    index = DuplicateIndex(":memory:", args.max_distance)
+    for filename in sorted(os.listdir(args.folder)):
+        if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
+            continue
+        with open(os.path.join(args.folder, filename), "rb") as f:
+            duplicate = index.check(f.read(), filename, reserve_as=filename)
+        if duplicate:
+            print(f"{filename}: duplicate of {duplicate['duplicate_of']} ({duplicate['distance']} bits apart)")
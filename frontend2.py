@@ -1,30 +1,89 @@
 import streamlit as st
 import pandas as pd
+import logging
 import sqlite3
-from streamlit_dynamic_filters import DynamicFilters
-from ollama3 import response_to_user_query
-import os
-import tempfile
-from image_cleaning import clean_single_image_bytes
-from ocr_processor import perform_ocr_on_image_path
-from parser import parse_multiple_invoices # Import parse_multiple_invoices for potential future use or consistency
-from parser import parse_single_invoice_text
+import time
+from query_cache import get_sql_for_question, run_query, forget_question, get_data_version
+from upload_jobs import UploadJobQueue, ACTIVE_STATUSES
+from duplicate_index import DuplicateIndex
 from data_insertion import insert_single_bill_data
+from category_memo import remember_categories
+from date_normalizer import normalize_date
+from db_schema import ensure_schema
+from metrics import configure_logging, metrics
 
 st.set_page_config(layout="wide") # Use wide layout for better display
+configure_logging()
+logger = logging.getLogger("frontend2")
 st.title("Expense Tracking Dashboard")
 
 DB_NAME = "ocr_master.db"
 TABLE_NAME = "ocr_line_items"
 
-def load_data(): 
+PAGE_SIZES = [25, 50, 100, 250]
+
+@st.cache_resource
+def init_database():
+    # Create or migrate the schema once per server process
+    con = sqlite3.connect(DB_NAME)
+    try:
+        ensure_schema(con)
+    finally:
+        con.close()
+
+init_database()
+
+# Cached loaders: data_version (PRAGMA data_version) is part of every cache key,
+# so cached results are reused across reruns and dropped as soon as new bills are written
+
+def _filter_clause(categories, invoice_nos):
+    # Filters are pushed down into SQL so only matching rows are read
+    conditions, params = [], []
+    if categories:
+        category_condition = f"Category IN ({','.join('?' * len(categories))})"
+        if "Uncategorized" in categories:
+            category_condition = f"({category_condition} OR Category IS NULL)"
+        conditions.append(category_condition)
+        params.extend(categories)
+    if invoice_nos:
+        conditions.append(f"Invoice_No IN ({','.join('?' * len(invoice_nos))})")
+        params.extend(invoice_nos)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def load_filter_options(data_version):
+    con = sqlite3.connect(DB_NAME)
     try:
+        categories = [row[0] for row in con.execute("SELECT DISTINCT COALESCE(Category, 'Uncategorized') FROM line_items ORDER BY 1")]
+        invoice_nos = [row[0] for row in con.execute("SELECT Invoice_No FROM invoices ORDER BY Invoice_No")]
+        return categories, invoice_nos
+    finally:
+        con.close()
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def count_rows(data_version, categories, invoice_nos):
+    where, params = _filter_clause(categories, invoice_nos)
+    con = sqlite3.connect(DB_NAME)
+    try:
+        return con.execute(f"SELECT COUNT(*) FROM {TABLE_NAME} {where}", params).fetchone()[0]
+    finally:
+        con.close()
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def load_data(data_version, categories=(), invoice_nos=(), page=1, page_size=PAGE_SIZES[0]):
+    """Loads one page of line items matching the filters."""
+    try:
+        where, params = _filter_clause(categories, invoice_nos)
         con = sqlite3.connect(DB_NAME) 
-        df = pd.read_sql_query(f"SELECT * FROM {TABLE_NAME}", con) 
+        df = pd.read_sql_query(
+            f"SELECT * FROM {TABLE_NAME} {where} ORDER BY Invoice_No, line_item_id LIMIT ? OFFSET ?",
+            con,
+            params=[*params, page_size, (page - 1) * page_size],
+        )
         con.close() 
         
-        # Handle potential None values in filter columns before passing to DynamicFilters
-        # This prevents TypeError when sorting options in multiselect
+        # Show missing categories the same way as in the filter options
         df['Category'] = df['Category'].fillna('Uncategorized')
         return df
         
@@ -37,152 +96,200 @@ def load_data():
         st.error(f"An unexpected error occurred: {e}")
         return pd.DataFrame()
 
-# Load and display the data
-data_df = load_data()
-
 # --- File Uploader Section ---
-st.sidebar.header("Upload New Bill")
-uploaded_file = st.sidebar.file_uploader("Choose an image file (JPG, JPEG, PNG)", type=["jpg", "jpeg", "png"])
- 
-def handle_uploaded_file(uploaded_file_obj):
-    st.sidebar.info("Processing uploaded bill...")
-    try:
-        # Create a temporary directory for processing
-        # Using a fixed temp directory for easier access if needed, but tempfile.TemporaryDirectory is safer
-        # For simplicity and to avoid issues with Streamlit's rerun, let's use a session state for paths
-        
-        # Save original uploaded file to a temporary location for display
-        original_image_path = os.path.join(tempfile.gettempdir(), f"original_{uploaded_file_obj.name}")
-        with open(original_image_path, "wb") as f:
-            f.write(uploaded_file.getvalue())
-        
-        cleaned_image_path = os.path.join(tempfile.gettempdir(), f"cleaned_{uploaded_file.name}")
-
-        st.sidebar.text("1. Cleaning image...")
-        with st.spinner("Cleaning image..."):
-            if not clean_single_image_bytes(uploaded_file_obj.getvalue(), cleaned_image_path):
-                st.sidebar.error(f"Failed to clean image {uploaded_file_obj.name}.")
-                return # Exit processing if cleaning fails
-
-        st.sidebar.text("2. Performing OCR...")
-        with st.spinner("Performing OCR..."):
-            ocr_text = perform_ocr_on_image_path(cleaned_image_path)
-            if not ocr_text:
-                st.sidebar.error(f"Failed to extract text (OCR) from {uploaded_file_obj.name}.")
-                return # Exit processing if OCR fails
-
-        st.sidebar.text("3. Parsing and Categorizing data...")
-        with st.spinner("Parsing and Categorizing data..."):
-            structured_bill_data = parse_single_invoice_text(ocr_text, uploaded_file_obj.name)
-            
-            if not structured_bill_data or not structured_bill_data.get("line_items"):
-                st.sidebar.error(f"Failed to parse structured data or no line items found from {uploaded_file.name}.")
-                with st.sidebar.expander("View Raw OCR Text"):
-                    st.code(ocr_text)
-                return # Exit processing if parsing fails
-
-        st.sidebar.success("Processing complete! Review extracted data below.")
-
-        # --- Display Visual Feedback ---
-        st.subheader("Uploaded Bill Details")
-        col1, col2 = st.columns(2)
-        with col1:
-            st.image(original_image_path, caption="Original Image", use_column_width=True)
-        with col2:
-            st.image(cleaned_image_path, caption="Cleaned Image", use_column_width=True)
-        
-        with st.expander("View Raw OCR Text"):
-            st.code(ocr_text, height=300)
-
-        # --- Interactive Data Review and Correction ---
-        st.subheader("Review and Correct Extracted Data")
-
-        # Display main invoice details for editing
-        st.markdown("##### Invoice Header Details")
-        col_inv1, col_inv2, col_inv3 = st.columns(3)
-        structured_bill_data["Invoice_No"] = col_inv1.text_input("Invoice No.", value=structured_bill_data.get("Invoice_No", ""))
-        structured_bill_data["Issue_Date"] = col_inv2.text_input("Issue Date", value=structured_bill_data.get("Issue_Date", ""))
-        structured_bill_data["Grand_Total"] = col_inv3.number_input("Grand Total", value=structured_bill_data.get("Grand_Total", 0.0), format="%.2f")
-
-        col_inv4, col_inv5 = st.columns(2)
-        structured_bill_data["billed_to"] = col_inv4.text_input("Billed To", value=structured_bill_data.get("billed_to", ""))
-        structured_bill_data["billed_by"] = col_inv5.text_input("Billed By", value=structured_bill_data.get("billed_by", ""))
-        structured_bill_data["source_file"] = uploaded_file_obj.name # Ensure source file is correct
-
-        st.markdown("##### Line Items")
-        # Convert line_items list of dicts to DataFrame for st.data_editor
-        line_items_df = pd.DataFrame(structured_bill_data.get("line_items", []))
-        
-        # Ensure 'Amount' is numeric for editing
-        if 'Amount' in line_items_df.columns:
-            line_items_df['Amount'] = pd.to_numeric(line_items_df['Amount'], errors='coerce').fillna(0.0)
-
-        edited_line_items_df = st.data_editor(
-            line_items_df,
-            num_rows="dynamic", # Allows adding/deleting rows
-            use_container_width=True,
-            key="line_items_editor"
-        )
+# Uploads are processed by background workers (upload_jobs.py); the script only submits
+# them and shows their progress, so reruns never reprocess a bill
+UPLOAD_POLL_SECONDS = 1.0
 
-        if st.button("Confirm and Save to Database"):
-            # Convert edited DataFrame back to list of dicts
-            structured_bill_data["line_items"] = edited_line_items_df.to_dict(orient='records')
-            
-            with st.spinner("Inserting data into database..."):
-                inserted_count = insert_single_bill_data(structured_bill_data)
-                if inserted_count > 0:
-                    st.success(f"Successfully processed and added {inserted_count} line items from {uploaded_file_obj.name}!")
-                    data_df = load_data() # Reload data to update the displayed table
-                    st.rerun() # Rerun to update the dataframe display
-                else:
-                    st.error(f"Failed to insert data for {uploaded_file.name}.")
+@st.cache_resource
+def get_upload_queue():
+    return UploadJobQueue(duplicate_index=DuplicateIndex())
 
-    except Exception as e:
-        st.sidebar.error(f"An error occurred during bill processing: {e}")
-        st.sidebar.exception(e) # Display full exception for debugging
+upload_queue = get_upload_queue()
+
+st.sidebar.header("Upload New Bills")
+uploaded_files = st.sidebar.file_uploader("Choose image files (JPG, JPEG, PNG)", type=["jpg", "jpeg", "png"],
+                                          accept_multiple_files=True)
 
-if uploaded_file is not None:
-    handle_uploaded_file(uploaded_file)
+# job_id -> uploaded file; submitting an already known image just returns its job
+uploaded_by_job = {upload_queue.submit(f.name, f.getvalue()): f for f in uploaded_files or []}
+upload_jobs = upload_queue.jobs(list(uploaded_by_job))
+
+STAGE_LABELS = {"dedup": "Checking for duplicates...", "cleaning": "Cleaning image...", "ocr": "Performing OCR...", "parsing": "Parsing and Categorizing data..."}
+
+def show_job_status(job):
+    if job["status"] == "queued":
+        st.sidebar.progress(0.0, text=f"{job['filename']}: waiting...")
+    elif job["status"] == "running":
+        st.sidebar.progress(job["progress"], text=f"{job['filename']}: {STAGE_LABELS.get(job['stage'], job['stage'])}")
+    elif job["status"] == "done":
+        st.sidebar.success(f"{job['filename']}: ready for review.")
+    elif job["status"] == "saved":
+        st.sidebar.info(f"{job['filename']}: saved to database.")
+    elif job["status"] == "duplicate":
+        st.sidebar.warning(job["error"])
+        if st.sidebar.button("Process anyway", key=f"process-{job['job_id']}"):
+            upload_queue.submit(job["filename"], uploaded_by_job[job["job_id"]].getvalue(), retry=True, allow_duplicate=True)
+            st.rerun()
+    else:
+        st.sidebar.error(job["error"] or f"Processing {job['filename']} failed.")
+        if job["ocr_text"]:
+            with st.sidebar.expander("View Raw OCR Text"):
+                st.code(job["ocr_text"])
+        if st.sidebar.button("Retry", key=f"retry-{job['job_id']}"):
+            upload_queue.submit(job["filename"], uploaded_by_job[job["job_id"]].getvalue(), retry=True)
+            st.rerun()
+
+def review_bill(job, source_bytes):
+    structured_bill_data = dict(job["bill"])
+    job_id = job["job_id"]
+
+    # --- Display Visual Feedback ---
+    st.subheader("Uploaded Bill Details")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.image(source_bytes, caption="Original Image", use_column_width=True)
+    with col2:
+        cleaned_image = upload_queue.cleaned_image(job_id)
+        if cleaned_image is not None:
+            st.image(cleaned_image, caption="Cleaned Image", use_column_width=True)
+    if job["preprocessing"]:
+        st.caption(f"Preprocessing: {job['preprocessing']}")
+
+    with st.expander("View Raw OCR Text"):
+        st.code(job["ocr_text"], height=300)
+
+    # --- Interactive Data Review and Correction ---
+    st.subheader("Review and Correct Extracted Data")
+
+    # Display main invoice details for editing; widget keys are per job so each bill keeps its own edits
+    st.markdown("##### Invoice Header Details")
+    col_inv1, col_inv2, col_inv3 = st.columns(3)
+    structured_bill_data["Invoice_No"] = col_inv1.text_input("Invoice No.", value=structured_bill_data.get("Invoice_No", ""), key=f"invoice_no-{job_id}")
+    structured_bill_data["Issue_Date"] = col_inv2.text_input("Issue Date", value=structured_bill_data.get("Issue_Date", ""), key=f"issue_date-{job_id}")
+    structured_bill_data["Issue_Date_ISO"] = normalize_date(structured_bill_data["Issue_Date"]) # keep in sync with edits
+    structured_bill_data["Grand_Total"] = col_inv3.number_input("Grand Total", value=structured_bill_data.get("Grand_Total", 0.0), format="%.2f", key=f"grand_total-{job_id}")
+
+    col_inv4, col_inv5 = st.columns(2)
+    structured_bill_data["billed_to"] = col_inv4.text_input("Billed To", value=structured_bill_data.get("billed_to", ""), key=f"billed_to-{job_id}")
+    structured_bill_data["billed_by"] = col_inv5.text_input("Billed By", value=structured_bill_data.get("billed_by", ""), key=f"billed_by-{job_id}")
+    structured_bill_data["source_file"] = job["filename"] # Ensure source file is correct
+
+    st.markdown("##### Line Items")
+    # Convert line_items list of dicts to DataFrame for st.data_editor
+    line_items_df = pd.DataFrame(structured_bill_data.get("line_items", []))
+
+    # Ensure 'Amount' is numeric for editing
+    if 'Amount' in line_items_df.columns:
+        line_items_df['Amount'] = pd.to_numeric(line_items_df['Amount'], errors='coerce').fillna(0.0)
+
+    edited_line_items_df = st.data_editor(
+        line_items_df,
+        num_rows="dynamic", # Allows adding/deleting rows
+        use_container_width=True,
+        key=f"line_items_editor-{job_id}"
+    )
+
+    if st.button("Confirm and Save to Database", key=f"save-{job_id}"):
+        # Convert edited DataFrame back to list of dicts
+        structured_bill_data["line_items"] = edited_line_items_df.to_dict(orient='records')
+
+        with st.spinner("Inserting data into database..."):
+            inserted_count = insert_single_bill_data(structured_bill_data)
+            if inserted_count > 0:
+                # Human-confirmed categories feed the description -> category memo
+                remember_categories(
+                    (item.get('service_description'), item.get('Category'))
+                    for item in structured_bill_data["line_items"]
+                )
+                upload_queue.mark_saved(job_id)
+                st.success(f"Successfully processed and added {inserted_count} line items from {job['filename']}!")
+                st.rerun() # Rerun to update the dataframe display
+            else:
+                st.error(f"Failed to insert data for {job['filename']}.")
+
+for job in upload_jobs:
+    show_job_status(job)
+
+# Options are job ids, so the selection survives other jobs finishing
+review_jobs = {job["job_id"]: job for job in upload_jobs if job["status"] == "done"}
+if review_jobs:
+    review_job_id = next(iter(review_jobs))
+    if len(review_jobs) > 1:
+        review_job_id = st.selectbox("Bill to review", list(review_jobs), key="review_job",
+                                     format_func=lambda job_id: review_jobs[job_id]["filename"])
+    review_bill(review_jobs[review_job_id], uploaded_by_job[review_job_id].getvalue())
 
 st.sidebar.markdown("---") # Separator
 
 
 #adding filter
-filters_obj= DynamicFilters(
-    data_df,
-    filters= ['Category','Invoice_No']
-)
+data_version = get_data_version()
+try:
+    category_options, invoice_options = load_filter_options(data_version)
+except sqlite3.Error as e:
+    st.error(f"Error loading data from database: {e}")
+    category_options, invoice_options = [], []
 
 with st.sidebar:
     st.header("Filter Expenses")
-    # 2. Display the filter widgets in the sidebar
-    filters_obj.display_filters()
+    selected_categories = st.multiselect("Category", category_options)
+    selected_invoices = st.multiselect("Invoice_No", invoice_options)
+    page_size = st.selectbox("Rows per page", PAGE_SIZES)
 
-st.dataframe(filters_obj.filter_df(), width='stretch')
+# Tuples keep the cache keys hashable and order-independent
+selected_categories = tuple(sorted(selected_categories))
+selected_invoices = tuple(sorted(selected_invoices))
+try:
+    total_rows = count_rows(data_version, selected_categories, selected_invoices)
+except sqlite3.Error as e:
+    st.error(f"Error loading data from database: {e}")
+    total_rows = 0
+
+page_count = max(1, -(-total_rows // page_size))
+# Keyed on the filters so the page resets to 1 when they change
+page = st.number_input(f"Page (of {page_count}, {total_rows} rows)", min_value=1, max_value=page_count, value=1, step=1,
+                       key=f"page-{selected_categories}-{selected_invoices}-{page_size}")
+
+st.dataframe(load_data(data_version, selected_categories, selected_invoices, int(page), page_size), width='stretch')
 
 st.title("Chat with your Expenses")
 user_question = st.chat_input("Ask me anything about your expenses (e.g., 'what is the total of amount', 'show me all food expenses')")
 if user_question:
     st.write(f"You asked: {user_question}")
-    print(f"User question: {user_question}")
-    
-    with st.spinner("Generating SQL query..."):
-        sql_query_generation = response_to_user_query(user_question)
+    logger.info("User question: %s", user_question)
     
-    st.code(sql_query_generation, language="sql")
-    print(f"Generated SQL: {sql_query_generation}")
+    # The answer is shown token by token while it is generated;
+    # repeat questions reuse the SQL generated before
+    sql_placeholder = st.empty()
+    sql_query_generation, sql_cached = get_sql_for_question(
+        user_question,
+        on_token=lambda partial: sql_placeholder.code(partial, language="sql"),
+    )
+    sql_placeholder.code(sql_query_generation, language="sql")
+    logger.info("Generated SQL%s: %s", " (cached)" if sql_cached else "", sql_query_generation)
 
     with st.spinner("Fetching information from database..."):
         try:
-            con = sqlite3.connect(DB_NAME)
-            output = pd.read_sql_query(sql_query_generation, con)
-            print(f"Query Result:\n{output}")
-            con.close()
+            # Results are served from memory until new bills are inserted
+            output, result_cached = run_query(sql_query_generation)
+            logger.debug("Query Result%s:\n%s", " (cached)" if result_cached else "", output)
             
             if not output.empty:
                 st.chat_message("assistance").dataframe(output)
             else:
                 st.chat_message("assistance").info("No results found for your query.")
         except Exception as e:
+            forget_question(user_question)
             st.chat_message("assistance").error(f"Error executing SQL query: {e}")
-            print(f"Error executing SQL query: {e}")
+            logger.error("Error executing SQL query: %s", e)
+
+# --- Metrics (this app process since start) ---
+with st.sidebar.expander("Metrics"):
+    st.json(metrics.snapshot(), expanded=False)
+    st.download_button("Download (Prometheus text)", metrics.to_prometheus(), file_name="bill_analyzer_metrics.prom")
+
+# Poll while uploads are still being processed in the background
+if any(job["status"] in ACTIVE_STATUSES for job in upload_jobs):
+    time.sleep(UPLOAD_POLL_SECONDS)
+    st.rerun()
@@ -1,11 +1,247 @@
 import cv2
+import logging
 import os
+import struct
+import time
 import numpy as np
+from metrics import inc, timed
 
 
 input_folder = "bill_image"
 output_folder = "image_cleaning_one_folder"
 
+logger = logging.getLogger(__name__)
+
+# Images above this many pixels are decoded at 1/2, 1/4 or 1/8 resolution (0 disables)
+MAX_DECODE_PIXELS = int(os.environ.get("BILL_MAX_DECODE_PIXELS", str(20_000_000)))
+
+# Adaptive preprocessing: cheap statistics pick which stages each image needs
+ADAPTIVE_PREPROCESSING = os.environ.get("BILL_ADAPTIVE_PREPROCESSING", "1") != "0"
+TARGET_DPI = 300
+PAGE_WIDTH_INCHES = 8.5    # assumed width of the bill in the image, for the DPI estimate
+DOWNSCALE_MARGIN = 1.25    # only resize when the image is this much wider than the target
+BILEVEL_FRACTION = 0.98    # share of near-black/near-white pixels for "already bilevel"
+NOISE_THRESHOLD = 3.0      # estimated noise sigma (grey levels) above which the blur runs
+
+# Preprocessing applied before OCR (also part of the OCR cache key)
+PREPROCESSING_SETTINGS = {
+    "grayscale": True,
+    "decode": "imread_grayscale",
+    "max_decode_pixels": MAX_DECODE_PIXELS,
+    "blur_kernel": 5,
+    "threshold": "otsu",
+    "adaptive": ADAPTIVE_PREPROCESSING and {
+        "target_dpi": TARGET_DPI,
+        "page_width_inches": PAGE_WIDTH_INCHES,
+        "downscale_margin": DOWNSCALE_MARGIN,
+        "bilevel_fraction": BILEVEL_FRACTION,
+        "noise_threshold": NOISE_THRESHOLD,
+    },
+}
+
+_REDUCED_GRAYSCALE = ((2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+                      (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                      (8, cv2.IMREAD_REDUCED_GRAYSCALE_8))
+
+
+def _blur_kernel():
+    size = PREPROCESSING_SETTINGS["blur_kernel"]
+    return (size, size)
+
+
+def image_size(image_bytes: bytes) -> tuple[int, int] | None:
+    """Reads (width, height) from a PNG or JPEG header without decoding the image."""
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n" and len(image_bytes) >= 24:
+        return struct.unpack(">II", image_bytes[16:24])
+
+    if image_bytes[:2] == b"\xff\xd8":
+        offset = 2
+        while offset + 9 <= len(image_bytes):
+            if image_bytes[offset] != 0xFF:
+                return None
+            marker = image_bytes[offset + 1]
+            if marker == 0xFF:  # fill byte
+                offset += 1
+                continue
+            length = struct.unpack(">H", image_bytes[offset + 2:offset + 4])[0]
+            # SOF0..SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", image_bytes[offset + 5:offset + 9])
+                return width, height
+            offset += 2 + length
+    return None
+
+
+def decode_grayscale(image_bytes: bytes, max_pixels: int | None = None):
+    """
+    Decodes image bytes straight to a single-channel array (no BGR copy).
+    Oversized images are decoded at reduced resolution so they never sit in memory full size.
+    Returns None if the bytes are not a readable image.
+    """
+    max_pixels = MAX_DECODE_PIXELS if max_pixels is None else max_pixels
+    flag = cv2.IMREAD_GRAYSCALE
+    size = image_size(image_bytes) if max_pixels else None
+    if size:
+        width, height = size
+        for factor, reduced_flag in _REDUCED_GRAYSCALE:
+            if width * height <= max_pixels:
+                break
+            flag = reduced_flag
+            if (width // factor) * (height // factor) <= max_pixels:
+                break
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+
+
+def _estimate_noise(gray_image) -> float:
+    """
+    Fast noise sigma estimate (Immerkaer, 1996) on a central crop at full resolution:
+    a Laplacian-difference kernel cancels smooth content and leaves the noise.
+    """
+    height, width = gray_image.shape
+    crop = gray_image[max(0, height // 2 - 256):height // 2 + 256, max(0, width // 2 - 256):width // 2 + 256]
+    if crop.shape[0] < 3 or crop.shape[1] < 3:
+        return 0.0
+    kernel = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+    response = cv2.filter2D(crop.astype(np.float32), -1, kernel)[1:-1, 1:-1]
+    return float(np.sqrt(np.pi / 2) * np.abs(response).mean() / 6)
+
+
+def image_statistics(gray_image) -> dict:
+    """Cheap statistics the preprocessing planner decides on (sampled, not full-image passes)."""
+    height, width = gray_image.shape
+    sample = gray_image[::4, ::4]
+    histogram = np.bincount(sample.ravel(), minlength=256)
+    extremes = (histogram[:16].sum() + histogram[240:].sum()) / max(sample.size, 1)
+    return {
+        "width": width,
+        "height": height,
+        "estimated_dpi": round(width / PAGE_WIDTH_INCHES),
+        "bilevel_fraction": round(float(extremes), 4),
+        "pure_bilevel": bool(histogram[1:255].sum() == 0),
+        "noise_sigma": round(_estimate_noise(gray_image), 3),
+    }
+
+
+def plan_preprocessing(stats: dict) -> dict:
+    """
+    Chooses the cheapest stages likely to give good OCR:
+    - downscale to TARGET_DPI first when the image is much larger (e.g. 12 MP phone photos),
+    - skip blur + Otsu for images that are already black and white (scanned PDF exports),
+    - skip the blur when the noise estimate is low.
+    """
+    if not ADAPTIVE_PREPROCESSING:
+        return {"scale": 1.0, "blur": True, "threshold": "otsu"}
+
+    target_width = TARGET_DPI * PAGE_WIDTH_INCHES
+    scale = 1.0
+    if stats["width"] > target_width * DOWNSCALE_MARGIN:
+        scale = round(target_width / stats["width"], 4)
+
+    if stats["pure_bilevel"]:
+        return {"scale": scale, "blur": False, "threshold": "none" if scale == 1.0 else "fixed"}
+    if stats["bilevel_fraction"] >= BILEVEL_FRACTION:
+        return {"scale": scale, "blur": False, "threshold": "fixed"}
+    # Downscaling averages some of the noise away as well
+    noise = stats["noise_sigma"] * scale
+    return {"scale": scale, "blur": noise >= NOISE_THRESHOLD, "threshold": "otsu"}
+
+
+def apply_plan(gray_image, plan: dict, timings: dict | None = None):
+    """Runs the planned stages; per-stage seconds are added to timings if given."""
+    timings = {} if timings is None else timings
+
+    def timed(stage, func, *args):
+        started = time.perf_counter()
+        result = func(*args)
+        timings[stage] = round(time.perf_counter() - started, 6)
+        return result
+
+    image = gray_image
+    if plan["scale"] != 1.0:
+        size = (max(1, round(image.shape[1] * plan["scale"])), max(1, round(image.shape[0] * plan["scale"])))
+        # INTER_AREA avoids aliasing on large reductions but is several times slower than linear
+        interpolation = cv2.INTER_LINEAR if plan["scale"] >= 0.5 else cv2.INTER_AREA
+        image = timed("resize", cv2.resize, image, size, None, 0, 0, interpolation)
+    if plan["blur"]:
+        #removing the noice from the image
+        image = timed("blur", cv2.GaussianBlur, image, _blur_kernel(), 0)
+    if plan["threshold"] == "otsu":
+        #otsu's binarization of image
+        image = timed("threshold", cv2.threshold, image, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+    elif plan["threshold"] == "fixed":
+        image = timed("threshold", cv2.threshold, image, 127, 255, cv2.THRESH_BINARY)[1]
+    return image
+
+
+@timed("clean")
+def clean_image_array_with_plan(image_bytes: bytes, max_pixels: int | None = None):
+    """
+    Like clean_image_array, but also returns the record of what was done:
+    {"plan", "stats", "timings" (seconds per stage), "total_seconds"}.
+    Returns (None, None) if decoding fails.
+    """
+    started = time.perf_counter()
+    gray_image = decode_grayscale(image_bytes, max_pixels)
+    if gray_image is None:
+        return None, None
+    timings = {"decode": round(time.perf_counter() - started, 6)}
+
+    stats_started = time.perf_counter()
+    stats = image_statistics(gray_image)
+    plan = plan_preprocessing(stats)
+    timings["plan"] = round(time.perf_counter() - stats_started, 6)
+
+    binary_image = apply_plan(gray_image, plan, timings)
+    inc("preprocessing_plans", plan=describe_plan(plan))
+    record = {
+        "plan": plan,
+        "stats": stats,
+        "timings": timings,
+        "total_seconds": round(time.perf_counter() - started, 6),
+    }
+    return binary_image, record
+
+
+def describe_plan(plan: dict) -> str:
+    """Short human-readable plan, e.g. 'resize x0.5, otsu threshold'."""
+    steps = []
+    if plan["scale"] != 1.0:
+        steps.append(f"resize x{plan['scale']}")
+    if plan["blur"]:
+        steps.append("blur")
+    if plan["threshold"] != "none":
+        steps.append(f"{plan['threshold']} threshold")
+    return ", ".join(steps) or "no preprocessing"
+
+
+def clean_image_array(image_bytes: bytes, max_pixels: int | None = None):
+    """
+    Cleans an image held in memory and returns the binary image as a NumPy array,
+    ready for OCR without writing it to disk. Returns None if decoding fails.
+    """
+    binary_image, _ = clean_image_array_with_plan(image_bytes, max_pixels)
+    return binary_image
+
+
+def clean_image_file_with_plan(input_path, output_path) -> dict | None:
+    """Cleans and saves one image file; returns its preprocessing record, or None on failure."""
+    try:
+        with open(input_path, "rb") as f:
+            binary_image, record = clean_image_array_with_plan(f.read())
+        if binary_image is None:
+            raise ValueError("could not decode image")
+        cv2.imwrite(output_path,binary_image)
+        return record
+    except Exception as err:
+        logger.error("Failed to convert %s, %s", os.path.basename(input_path), err)
+        return None
+
+def clean_image_file(input_path, output_path):
+    """
+    Cleans a single image file and saves the processed image.
+    Returns True if successful, False otherwise.
+    """
+    return clean_image_file_with_plan(input_path, output_path) is not None
 
 def image_cleaning(input_folder, output_folder):
     valid_extansion = (".jpg", ".jpeg", ".png")
@@ -14,20 +250,11 @@ def image_cleaning(input_folder, output_folder):
         if filename.lower().endswith(valid_extansion):
             input_path = os.path.join(input_folder,filename)
             output_path = os.path.join(output_folder,filename)
-            try:
-                color_image = cv2.imread(input_path)
-                #converting it into grayscale/black&white image
-                gray_image = cv2.cvtColor(color_image,cv2.COLOR_BGR2GRAY) # type: ignore
-                #removing the noice from the image
-                blur_image = cv2.GaussianBlur(gray_image,(5,5),0)
-                #otsu's binarization of image 
-                ret, binary_image = cv2.threshold(blur_image, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
-                cv2.imwrite(output_path,binary_image)
-                # cv2.imwrite(output_path,blur_image)
+            record = clean_image_file_with_plan(input_path, output_path)
+            if record:
                 converted_count += 1
-                print(f"image converted = {converted_count} as {filename}")
-            except Exception as err:
-                print(f"Failed to convert {filename}, {err}")
+                logger.info("image converted = %d as %s (%s, %.3fs)", converted_count, filename,
+                            describe_plan(record['plan']), record['total_seconds'])
 
 def clean_single_image_bytes(image_bytes, output_path):
     """
@@ -39,21 +266,19 @@ def clean_single_image_bytes(image_bytes, output_path):
         True if successful, False otherwise.
     """
     try:
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        color_image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        binary_image = clean_image_array(image_bytes)
 
-        if color_image is None:
-            print(f"Error: Could not decode image from bytes.")
+        if binary_image is None:
+            logger.error("Could not decode image from bytes.")
             return False
 
-        gray_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
-        blur_image = cv2.GaussianBlur(gray_image, (5, 5), 0)
-        ret, binary_image = cv2.threshold(blur_image, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
         cv2.imwrite(output_path, binary_image)
         return True
     except Exception as err:
-        print(f"Failed to clean image from bytes: {err}")
+        logger.error("Failed to clean image from bytes: %s", err)
         return False
 
 if __name__ == "__main__":
+    from metrics import configure_logging
+    configure_logging()
     image_cleaning(input_folder,output_folder)
\ No newline at end of file
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+# Processed-file manifest for folder ingestion: one row per source image with its
+# content hash, mtime and the last pipeline stage it completed, plus that stage's
+# output, so reruns skip unchanged files and resume failed ones where they stopped.
+
+DB_NAME = "ocr_master.db"
+MANIFEST_TABLE = "ingest_manifest"
+
+# Completed stages in pipeline order
+STAGE_ORDER = ("cleaned", "ocr", "parsed", "inserted")
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stage_reached(entry: dict | None, stage: str) -> bool:
+    """True if the entry has completed `stage` (or a later one)."""
+    if not entry or entry.get("stage") not in STAGE_ORDER:
+        return False
+    return STAGE_ORDER.index(entry["stage"]) >= STAGE_ORDER.index(stage)
+
+
+class IngestManifest:
+    """
+    Manifest stored in ocr_master.db. Files are keyed by file name,
+    the same value written to invoices.source_file.
+    """
+
+    def __init__(self, db_name: str = DB_NAME):
+        self.db_name = db_name
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(db_name, timeout=30, check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.row_factory = sqlite3.Row
+        self._con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+                source_file TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                stage TEXT,
+                ocr_text TEXT,
+                bill_json TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._con.commit()
+
+    def entry(self, source_file: str) -> dict | None:
+        with self._lock:
+            row = self._con.execute(
+                f"SELECT * FROM {MANIFEST_TABLE} WHERE source_file = ?", (source_file,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def pending(self, paths: list[str], min_age: float = 0.0,
+                retry_failed: bool = True) -> list[tuple[str, dict | None]]:
+        """
+        Returns (path, manifest entry) for every file that still needs work: new files,
+        changed files (entry reset to None) and files that stopped before "inserted".
+        Files modified less than min_age seconds ago are left for a later pass
+        (they may still be being copied in); retry_failed=False also leaves out
+        unchanged files whose last attempt failed.
+        """
+        now = time.time()
+        work = []
+        for path in paths:
+            stat = os.stat(path)
+            if now - stat.st_mtime < min_age:
+                continue
+            source_file = os.path.basename(path)
+            entry = self.entry(source_file)
+
+            # mtime + size unchanged: trust the stored hash instead of re-reading the file
+            if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                if entry["stage"] != "inserted" and (retry_failed or not entry["error"]):
+                    work.append((path, entry))
+                continue
+
+            content_hash = file_digest(path)
+            if entry and entry["content_hash"] == content_hash:
+                self._touch(source_file, stat)  # only the timestamp changed
+                if entry["stage"] != "inserted" and (retry_failed or not entry["error"]):
+                    work.append((path, entry))
+                continue
+
+            self._reset(source_file, content_hash, stat)
+            work.append((path, None))
+        return work
+
+    def _touch(self, source_file: str, stat: os.stat_result):
+        with self._lock:
+            self._con.execute(
+                f"UPDATE {MANIFEST_TABLE} SET mtime = ?, size = ? WHERE source_file = ?",
+                (stat.st_mtime, stat.st_size, source_file),
+            )
+            self._con.commit()
+
+    def _reset(self, source_file: str, content_hash: str, stat: os.stat_result):
+        # New or changed content: every earlier stage output is stale
+        with self._lock:
+            self._con.execute(
+                f"""
+                INSERT OR REPLACE INTO {MANIFEST_TABLE}
+                (source_file, content_hash, mtime, size, stage, ocr_text, bill_json, error, updated_at)
+                VALUES (?, ?, ?, ?, NULL, NULL, NULL, NULL, ?)
+                """,
+                (source_file, content_hash, stat.st_mtime, stat.st_size, time.time()),
+            )
+            self._con.commit()
+
+    def record(self, source_file: str, stage: str, ocr_text: str | None = None, bill: dict | None = None):
+        """Marks `stage` as completed, storing its output when given (OCR text, parsed bill)."""
+        if stage not in STAGE_ORDER:
+            raise ValueError(f"Unknown stage {stage!r}")
+        with self._lock:
+            self._con.execute(
+                f"""
+                UPDATE {MANIFEST_TABLE}
+                SET stage = ?,
+                    ocr_text = COALESCE(?, ocr_text),
+                    bill_json = COALESCE(?, bill_json),
+                    error = NULL,
+                    updated_at = ?
+                WHERE source_file = ?
+                """,
+                (stage, ocr_text, json.dumps(bill) if bill is not None else None, time.time(), source_file),
+            )
+            self._con.commit()
+
+    def record_error(self, source_file: str, error: str):
+        """Keeps the last completed stage, so the next run resumes after it."""
+        with self._lock:
+            self._con.execute(
+                f"UPDATE {MANIFEST_TABLE} SET error = ?, updated_at = ? WHERE source_file = ?",
+                (error, time.time(), source_file),
+            )
+            self._con.commit()
+
+    def summary(self) -> dict:
+        """Number of files per last completed stage ("new" for none), plus failed files."""
+        with self._lock:
+            rows = self._con.execute(f"SELECT stage, error FROM {MANIFEST_TABLE}").fetchall()
+        counts = Counter(row["stage"] or "new" for row in rows)
+        counts["with_errors"] = sum(1 for row in rows if row["error"])
+        return dict(counts)
+
+    def close(self):
+        self._con.close()
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# Lightweight in-process instrumentation: timing spans per pipeline stage,
+# counters (LLM calls, cache hits, retries, "Other" fallbacks) and value
+# summaries (prompt/response sizes). Exported as JSON or Prometheus text.
+# Metrics are per process; worker processes keep their own.
+
+METRIC_PREFIX = "bill_analyzer"
+LOG_LEVEL = os.environ.get("BILL_LOG_LEVEL", "INFO")
+
+# Recent observations kept per series for the p50/p95 estimates
+RECENT_SAMPLES = 2048
+QUANTILES = (0.5, 0.95)
+
+
+def configure_logging(level: str | None = None):
+    """
+    Sets up console logging for the scripts and the app. BILL_LOG_LEVEL=DEBUG
+    also shows the raw OCR text and LLM output for every bill.
+    """
+    logging.basicConfig(
+        level=(level or LOG_LEVEL).upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
+
+def _quantile(sorted_values: list[float], q: float) -> float:
+    # Linear interpolation, same as numpy.percentile's default
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+class _Summary:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+        self.recent.append(value)
+
+    def as_dict(self) -> dict:
+        values = sorted(self.recent)
+        result = {"count": self.count, "sum": round(self.total, 6), "max": self.max}
+        for q in QUANTILES:
+            result[f"p{int(q * 100)}"] = round(_quantile(values, q), 6) if values else None
+        return result
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Metrics:
+    """Thread-safe registry of counters and summaries, keyed by name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._summaries = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = _Summary()
+            summary.observe(value)
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """Times the block into stage_seconds{stage=...}; failures are also counted."""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc("stage_errors", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage, **labels)
+
+    def timed(self, stage: str, **labels):
+        """Decorator form of span()."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stage_samples(self, stage: str) -> list[float]:
+        """Recent durations recorded for one stage (all label combinations)."""
+        with self._lock:
+            return [
+                value
+                for (name, labels), summary in self._summaries.items()
+                if name == "stage_seconds" and ("stage", stage) in labels
+                for value in summary.recent
+            ]
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+
+    # --- export ---
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                "summaries": [
+                    {"name": name, "labels": dict(labels), **summary.as_dict()}
+                    for (name, labels), summary in sorted(self._summaries.items())
+                ],
+            }
+
+    def to_json(self, indent: int | None = 2) -> str:
+        return json.dumps(self.snapshot(), indent=indent)
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format (counters and summaries)."""
+        def label_text(labels: dict, **extra) -> str:
+            merged = {**labels, **extra}
+            if not merged:
+                return ""
+            escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                       for value in merged.values())
+            return "{" + ",".join(f'{key}="{value}"' for key, value in zip(merged, escaped)) + "}"
+
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+        for counter in snapshot["counters"]:
+            metric = f"{METRIC_PREFIX}_{counter['name']}_total"
+            if metric not in declared:
+                lines.append(f"# TYPE {metric} counter")
+                declared.add(metric)
+            lines.append(f"{metric}{label_text(counter['labels'])} {counter['value']}")
+        for summary in snapshot["summaries"]:
+            metric = f"{METRIC_PREFIX}_{summary['name']}"
+            if metric not in declared:
+                lines.append(f"# TYPE {metric} summary")
+                declared.add(metric)
+            for q in QUANTILES:
+                value = summary[f"p{int(q * 100)}"]
+                if value is not None:
+                    lines.append(f"{metric}{label_text(summary['labels'], quantile=q)} {value}")
+            lines.append(f"{metric}_sum{label_text(summary['labels'])} {summary['sum']}")
+            lines.append(f"{metric}_count{label_text(summary['labels'])} {summary['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Writes the metrics to path: Prometheus text for .prom/.txt, JSON otherwise."""
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json())
+
+
+# Process-wide registry used by every module
+metrics = Metrics()
+span = metrics.span
+timed = metrics.timed
+inc = metrics.inc
+observe = metrics.observe
@@ -0,0 +1,92 @@
+import logging
+import os
+import re
+from metrics import observe
+
+# Pre-prompt compaction of OCR text: the LLM only needs the receipt's words and numbers,
+# not blank lines, separator rows, ASCII-art borders or low-confidence garbage.
+# Lines holding amounts, dates or totals are always kept.
+
+OCR_COMPACTION = os.environ.get("BILL_OCR_COMPACTION", "1") != "0"
+# Tesseract lines below this mean word confidence (0-100) are dropped at OCR time; 0 disables
+OCR_MIN_CONFIDENCE = float(os.environ.get("BILL_OCR_MIN_CONFIDENCE", "30"))
+
+# Share of alphanumeric characters below which a line is mostly punctuation (a border)
+MIN_ALNUM_FRACTION = 0.4
+
+_AMOUNT = re.compile(r"\d+[.,]\d{2}\b|\b\d{2,}\b")
+_DATE = re.compile(r"\b\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4}\b")
+_KEYWORDS = re.compile(
+    r"\b(total|subtotal|sub total|amount|amt|tax|gst|cgst|sgst|vat|bill|invoice|date|qty|rate|"
+    r"balance|due|paid|cash|discount)\b",
+    re.IGNORECASE,
+)
+_BORDER_EDGES = "|!¦ "  # box-drawing edges read as characters
+_SEPARATOR_RUN = re.compile(r"([^\w\s])\1{2,}")  # ------, ======, ......, ****
+# Rough token count: words and single punctuation marks (close to what BPE tokenizers produce for receipts)
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    return len(_TOKEN.findall(text))
+
+
+def is_key_line(line: str) -> bool:
+    """True for lines that hold an amount, a date or a total/tax/invoice keyword."""
+    return bool(_AMOUNT.search(line) or _DATE.search(line) or _KEYWORDS.search(line))
+
+
+def _is_noise(line: str) -> bool:
+    characters = line.replace(" ", "")
+    alnum = sum(c.isalnum() for c in characters)
+    if alnum == 0:
+        return True  # separators and borders
+    if alnum < 3 and not any(c.isdigit() for c in characters):
+        return True  # stray marks read as "l", "|i", ...
+    return alnum / len(characters) < MIN_ALNUM_FRACTION
+
+
+def compact_ocr_text(text: str) -> str:
+    """
+    Collapses whitespace and separator runs, strips box borders, drops blank, border and
+    garbage lines and repeated consecutive lines. Key lines (amounts, dates, totals) are never dropped.
+    """
+    lines = []
+    for raw_line in text.splitlines():
+        line = " ".join(_SEPARATOR_RUN.sub(r"\1", raw_line).split()).strip(_BORDER_EDGES)
+        if not line:
+            continue
+        if is_key_line(line):
+            lines.append(line)  # kept even when repeated: two identical items are two line items
+        elif not _is_noise(line) and not (lines and line == lines[-1]):
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def filter_low_confidence(lines: list[tuple[str, float]], min_confidence: float = OCR_MIN_CONFIDENCE) -> str:
+    """
+    Joins Tesseract text lines given as (text, mean word confidence), leaving out
+    lines below min_confidence unless they are key lines.
+    """
+    kept = [
+        text.strip() for text, confidence in lines
+        if text.strip() and (confidence >= min_confidence or is_key_line(text))
+    ]
+    return "\n".join(kept)
+
+
+def prepare_ocr_text(raw_text: str, agent: str = "extraction") -> str:
+    """
+    Returns the text to put into the prompt (compacted unless BILL_OCR_COMPACTION=0)
+    and records its estimated token count before and after compaction.
+    """
+    tokens_before = estimate_tokens(raw_text)
+    text = compact_ocr_text(raw_text) if OCR_COMPACTION else raw_text
+    tokens_after = estimate_tokens(text) if OCR_COMPACTION else tokens_before
+
+    observe("ocr_text_tokens", tokens_before, agent=agent, stage="raw")
+    observe("ocr_text_tokens", tokens_after, agent=agent, stage="compacted")
+    logger.debug("OCR text compacted from ~%d to ~%d tokens", tokens_before, tokens_after)
+    return text
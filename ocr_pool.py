@@ -0,0 +1,242 @@
+import logging
+import os
+import shlex
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytesseract
+from metrics import span
+from ocr_compaction import OCR_MIN_CONFIDENCE, filter_low_confidence
+
+# tesserocr (requirements.txt) binds the Tesseract C API, so each worker keeps one
+# initialized engine (language data loaded once) and images are passed in memory.
+# If it cannot be installed, every image goes through pytesseract's `tesseract` process.
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+OCR_WORKERS = int(os.environ.get("BILL_OCR_WORKERS", str(os.cpu_count() or 1)))
+OCR_LANG = os.environ.get("BILL_OCR_LANG", "eng")
+# Jobs submitted but not finished before submit() blocks (default: 2 per worker)
+OCR_MAX_PENDING = int(os.environ.get("BILL_OCR_MAX_PENDING", "0"))
+
+logger = logging.getLogger(__name__)
+
+
+def available_engines() -> list[str]:
+    return (["tesserocr"] if tesserocr is not None else []) + ["pytesseract"]
+
+
+def _tessdata_path() -> str | None:
+    """
+    Language data folder of the Tesseract install pytesseract is pointed at (e.g. the Windows
+    one set in ocr_processor), so tesserocr reuses it. None leaves tesserocr on TESSDATA_PREFIX
+    or its built-in default.
+    """
+    if os.environ.get("TESSDATA_PREFIX"):
+        return None
+    folder = os.path.join(os.path.dirname(pytesseract.pytesseract.tesseract_cmd), "tessdata")
+    return folder if os.path.isdir(folder) else None
+
+
+def _apply_config(api, config: str):
+    """Applies the pytesseract-style config string (--psm N, -c key=value) to a tesserocr engine."""
+    args = shlex.split(config)
+    for i, arg in enumerate(args):
+        if arg == "--psm" and i + 1 < len(args):
+            api.SetPageSegMode(int(args[i + 1]))
+        elif arg == "-c" and i + 1 < len(args) and "=" in args[i + 1]:
+            api.SetVariable(*args[i + 1].split("=", 1))
+
+
+class OcrWorkerPool:
+    """
+    Fixed set of OCR worker threads that keep their Tesseract engine initialized.
+    Both engines release the GIL while recognizing (C API / child process), so threads run in parallel.
+    Args:
+        workers: number of workers (default: BILL_OCR_WORKERS or CPU count).
+        max_pending: submit() blocks once this many jobs are queued or running.
+        engine: "tesserocr" or "pytesseract" (default: tesserocr when installed).
+        config: Tesseract options, as given to pytesseract.
+        min_confidence: text lines with a lower mean word confidence are dropped
+            (unless they hold amounts, dates or totals); 0 returns Tesseract's plain text.
+    """
+
+    def __init__(self, workers: int | None = None, max_pending: int | None = None,
+                 engine: str | None = None, config: str = "", lang: str = OCR_LANG,
+                 min_confidence: float = OCR_MIN_CONFIDENCE):
+        self.workers = workers or OCR_WORKERS
+        self.max_pending = max_pending or OCR_MAX_PENDING or 2 * self.workers
+        self.engine = engine or available_engines()[0]
+        if self.engine not in available_engines():
+            raise ValueError(f"OCR engine {self.engine!r} is not available")
+        if tesserocr is None:
+            logger.warning("tesserocr is not installed: OCR starts one tesseract process per image "
+                           "(pip install -r requirements.txt)")
+        self.config = config
+        self.lang = lang
+        self.min_confidence = min_confidence
+
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="ocr")
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._local = threading.local()
+        self._apis = []
+        self._apis_lock = threading.Lock()
+
+    # --- engines (run on the worker threads) ---
+
+    def _tesserocr_api(self):
+        api = getattr(self._local, "api", None)
+        if api is None:
+            tessdata = _tessdata_path()
+            api = tesserocr.PyTessBaseAPI(path=tessdata, lang=self.lang) if tessdata else tesserocr.PyTessBaseAPI(lang=self.lang)
+            _apply_config(api, self.config)
+            self._local.api = api
+            with self._apis_lock:
+                self._apis.append(api)
+        return api
+
+    def _set_image(self, image):
+        api = self._tesserocr_api()
+        if isinstance(image, str):
+            api.SetImageFile(image)
+        else:
+            image = np.ascontiguousarray(image, dtype=np.uint8)
+            channels = 1 if image.ndim == 2 else image.shape[2]
+            api.SetImageBytes(image.tobytes(), image.shape[1], image.shape[0], channels, image.strides[0])
+        return api
+
+    def _recognize_lines(self, image) -> list[tuple[str, float]]:
+        """Text lines with their mean word confidence (0-100), in reading order."""
+        if self.engine == "pytesseract":
+            data = pytesseract.image_to_data(image, lang=self.lang, config=self.config,
+                                             output_type=pytesseract.Output.DICT)
+            lines = {}
+            for i, word in enumerate(data["text"]):
+                confidence = float(data["conf"][i])
+                if confidence < 0 or not word.strip():
+                    continue  # page/block/paragraph rows carry no word
+                key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+                lines.setdefault(key, []).append((word, confidence))
+            return [
+                (" ".join(word for word, _ in words), sum(c for _, c in words) / len(words))
+                for words in lines.values()
+            ]
+
+        api = self._set_image(image)
+        api.Recognize()
+        level = tesserocr.RIL.TEXTLINE
+        return [
+            (result.GetUTF8Text(level), result.Confidence(level))
+            for result in tesserocr.iterate_level(api.GetIterator(), level)
+        ]
+
+    def _recognize(self, image) -> str:
+        with span("ocr", engine=self.engine):
+            if self.min_confidence > 0:
+                return filter_low_confidence(self._recognize_lines(image), self.min_confidence)
+            if self.engine == "pytesseract":
+                return pytesseract.image_to_string(image, lang=self.lang, config=self.config)
+            return self._set_image(image).GetUTF8Text()
+
+    # --- dispatch ---
+
+    def submit(self, image):
+        """
+        Queues one image (file path or NumPy array) and returns a Future with its text.
+        Blocks while max_pending jobs are already in flight.
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._recognize, image)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def ocr(self, image) -> str:
+        return self.submit(image).result()
+
+    def map(self, images):
+        """Yields the text of each image in order, keeping at most max_pending in flight."""
+        futures = deque()
+        for image in images:
+            futures.append(self.submit(image))
+            while futures and futures[0].done():
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._apis_lock:
+            for api in self._apis:
+                api.End()
+            self._apis.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_ocr_pool(config: str = "") -> OcrWorkerPool:
+    """Returns the process-wide OCR pool (created on first use)."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = OcrWorkerPool(config=config)
+        return _default_pool
+
+
+def benchmark(image_paths: list[str], workers: int | None = None, engine: str | None = None) -> list[dict]:
+    """
+    Compares images/second of one pytesseract call per image (the previous path)
+    with the worker pool. OCR caching is not involved.
+    """
+    results = []
+
+    started = time.perf_counter()
+    for path in image_paths:
+        pytesseract.image_to_string(path, lang=OCR_LANG)
+    elapsed = time.perf_counter() - started
+    results.append({"path": "pytesseract, sequential", "images": len(image_paths),
+                    "seconds": round(elapsed, 3), "images_per_second": round(len(image_paths) / elapsed, 2)})
+
+    with OcrWorkerPool(workers, engine=engine) as pool:
+        started = time.perf_counter()
+        for _ in pool.map(image_paths):
+            pass
+        elapsed = time.perf_counter() - started
+        results.append({"path": f"pool ({pool.engine}, {pool.workers} workers)", "images": len(image_paths),
+                        "seconds": round(elapsed, 3), "images_per_second": round(len(image_paths) / elapsed, 2)})
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import ocr_processor  # sets the tesseract executable path
+
+    arg_parser = argparse.ArgumentParser(description="Benchmark the OCR worker pool")
+    arg_parser.add_argument("--folder", default=ocr_processor.input_folder)
+    arg_parser.add_argument("--workers", type=int, default=None)
+    arg_parser.add_argument("--engine", choices=["tesserocr", "pytesseract"], default=None)
+    arg_parser.add_argument("--repeat", type=int, default=1, help="Run over the folder this many times")
+    args = arg_parser.parse_args()
+
+    paths = [
+        os.path.join(args.folder, filename)
+        for filename in sorted(os.listdir(args.folder))
+        if filename.lower().endswith((".jpeg", ".jpg", ".png"))
+    ] * args.repeat
+    for row in benchmark(paths, args.workers, args.engine):
+        print(row)
@@ -1,42 +1,190 @@
 import pytesseract
+import logging
 import os
+import hashlib
+import json
+from collections import deque
+from concurrent.futures import Future
+from functools import lru_cache
+from cache_store import SQLiteCache
+from image_cleaning import PREPROCESSING_SETTINGS
+from ocr_pool import get_ocr_pool
+from ocr_compaction import OCR_MIN_CONFIDENCE
+from ocr_records import RECORDS_FILE, OcrRecordWriter
 
 # set the path to the Tesseract executable
 pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 
+# Extra Tesseract command line options (part of the cache key)
+TESSERACT_CONFIG = ""
 
 input_folder = "image_cleaning_one_folder"
-output_file = "extracted_text.txt"
-
-def perform_ocr(input_folder,output_file):
-    all_extracted_text = ""
-    for filename in os.listdir(input_folder):
-        if filename.endswith((".jpeg",".jpg",".png")):
-            image_path = os.path.join(input_folder,filename)
-            try:
-                text = pytesseract.image_to_string(image_path)
-                print("-"*20)
-                print(text.strip())
-                print("-"*20)
-                all_extracted_text += f"\n--Text from {filename}--\n{text}\n"
-            except Exception as err:
-                print(f"Error in {filename}, {err}")
-
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(all_extracted_text)
-    
-    print(f"Complete OCR done")
+output_file = RECORDS_FILE
+
+# OCR results keyed by image content, so re-runs and re-uploads skip Tesseract
+ocr_cache = SQLiteCache("ocr_cache", max_entries=20000, max_bytes=200 * 1024 * 1024)
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1)
+def get_tesseract_version() -> str:
+    try:
+        return str(pytesseract.get_tesseract_version())
+    except Exception:
+        return "unknown"
+
+
+def ocr_cache_key(image_bytes: bytes, preprocessing: dict | None = None) -> str:
+    """
+    Builds the cache key from the image bytes, the preprocessing settings
+    applied to them and the Tesseract version/config/confidence filter.
+    """
+    return _finish_cache_key(hashlib.sha256(image_bytes), preprocessing)
+
+
+def _finish_cache_key(digest, preprocessing: dict | None = None) -> str:
+    # Continues the sha256 of the image bytes (updated in place)
+    digest.update(json.dumps(preprocessing or {}, sort_keys=True).encode("utf-8"))
+    digest.update(get_tesseract_version().encode("utf-8"))
+    digest.update(TESSERACT_CONFIG.encode("utf-8"))
+    digest.update(f"min_confidence={OCR_MIN_CONFIDENCE}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_cached_source_ocr(source_image_bytes: bytes) -> str | None:
+    """
+    Looks up OCR text for an original (not yet cleaned) image.
+    A hit means both cleaning and OCR can be skipped.
+    """
+    return ocr_cache.get(ocr_cache_key(source_image_bytes, PREPROCESSING_SETTINGS))
+
+
+def cache_source_ocr(source_image_bytes: bytes, text: str):
+    """Stores OCR text for an original image cleaned with the current settings."""
+    if text:
+        ocr_cache.set(ocr_cache_key(source_image_bytes, PREPROCESSING_SETTINGS), text)
+
+
+def run_ocr(image) -> str:
+    """
+    Recognizes one image (file path or NumPy array) on the shared OCR worker pool,
+    which keeps its Tesseract engines initialized between images.
+    """
+    return get_ocr_pool(TESSERACT_CONFIG).ocr(image)
+
+
+def _image_file_key(image_path: str) -> str:
+    # Content-addressed lookup on the exact bytes given to Tesseract
+    with open(image_path, "rb") as f:
+        return ocr_cache_key(f.read())
+
+
+def _ocr_image_file(image_path: str) -> str:
+    key = _image_file_key(image_path)
+    text = ocr_cache.get(key)
+    if text is None:
+        text = run_ocr(image_path)
+        if text:
+            ocr_cache.set(key, text)
+    return text
+
+
+def _start_image_file(pool, image_path: str) -> tuple:
+    # Reads the file once: its sha256 is both the record digest and the start of the cache key
+    try:
+        with open(image_path, "rb") as f:
+            digest = hashlib.sha256(f.read())
+    except OSError as err:
+        return image_path, None, None, err
+    file_sha256 = digest.hexdigest()
+    key = _finish_cache_key(digest)
+    text = ocr_cache.get(key)
+    return image_path, file_sha256, key, pool.submit(image_path) if text is None else text
+
+
+def _finish_image_file(started: tuple) -> tuple:
+    image_path, file_sha256, key, result = started
+    if isinstance(result, Future):
+        try:
+            result = result.result()
+        except Exception as err:
+            result = err
+        else:
+            if result:
+                ocr_cache.set(key, result)
+    return image_path, file_sha256, result
+
+
+def _ocr_image_files(image_paths):
+    """
+    Yields (image_path, file sha256, text) in order; text is the exception if that image failed.
+    Images are looked up in the cache one at a time, at most max_pending ahead of the one
+    being yielded, and misses go to the worker pool, so memory stays flat with the batch size.
+    """
+    pool = get_ocr_pool(TESSERACT_CONFIG)
+    window = deque()
+    for image_path in image_paths:
+        window.append(_start_image_file(pool, image_path))
+        if len(window) >= pool.max_pending:
+            yield _finish_image_file(window.popleft())
+    while window:
+        yield _finish_image_file(window.popleft())
+
+
+def perform_ocr_on_array(image) -> str:
+    """
+    Performs OCR on an image already in memory (e.g. from clean_image_array),
+    so the cleaned image is never encoded to a file first.
+    """
+    try:
+        # Keyed on the raw pixels and shape instead of encoded file bytes
+        key = ocr_cache_key(image.tobytes(), {"shape": list(image.shape), "dtype": str(image.dtype)})
+        text = ocr_cache.get(key)
+        if text is None:
+            text = run_ocr(image)
+            if text:
+                ocr_cache.set(key, text)
+        return text
+    except Exception as err:
+        logger.error("Error performing OCR on in-memory image: %s", err)
+        return ""
+
+
+def perform_ocr(input_folder, output_file=RECORDS_FILE):
+    """
+    OCRs every image in input_folder and writes one JSONL record per bill
+    (filename, image sha256, text) to output_file as each image finishes.
+    """
+    image_paths = (
+        os.path.join(input_folder, filename)
+        for filename in os.listdir(input_folder)
+        if filename.endswith((".jpeg",".jpg",".png"))
+    )
+    with OcrRecordWriter(output_file) as records:
+        for image_path, file_sha256, text in _ocr_image_files(image_paths):
+            filename = os.path.basename(image_path)
+            if isinstance(text, Exception):
+                logger.error("Error in %s, %s", filename, text)
+                continue
+            logger.debug("OCR text of %s:\n%s", filename, text.strip())
+            records.write(filename, file_sha256, text)
+
+    logger.info("Complete OCR done: %d records written to %s", records.count, output_file)
+    logger.info("OCR cache: %s", ocr_cache.stats())
 
 def perform_ocr_on_image_path(image_path: str) -> str:
     """
     Performs OCR on a single image file and returns the extracted text.
     """
     try:
-        text = pytesseract.image_to_string(image_path)
+        text = _ocr_image_file(image_path)
         return text
     except Exception as err:
-        print(f"Error performing OCR on {image_path}: {err}")
+        logger.error("Error performing OCR on %s: %s", image_path, err)
         return ""
 
 if __name__== "__main__":
+    from metrics import configure_logging
+    configure_logging()
     perform_ocr(input_folder,output_file)
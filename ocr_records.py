@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+
+# OCR -> parser hand-off: a JSON Lines file with one record per bill
+#   {"filename": ..., "sha256": ..., "text": ...}
+# Records are appended (and flushed) as OCR finishes each image and read back
+# one line at a time, so neither side holds the whole batch in memory and the
+# OCR text needs no delimiter that could also appear inside it.
+
+RECORDS_FILE = "ocr_records.jsonl"
+
+logger = logging.getLogger(__name__)
+
+
+class OcrRecordWriter:
+    """
+    Appends bill records to a JSONL file. mode="w" starts a new batch,
+    mode="a" adds to the existing records.
+    """
+
+    def __init__(self, path: str = RECORDS_FILE, mode: str = "w"):
+        self.path = path
+        self.count = 0
+        self._file = open(path, mode, encoding="utf-8")
+
+    def write(self, filename: str, sha256: str, text: str):
+        record = {"filename": filename, "sha256": sha256, "text": text}
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        # Flushed per bill, so a reader (or a crash) sees every finished record
+        self._file.flush()
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_records(path: str = RECORDS_FILE):
+    """
+    Yields the records of a JSONL file one at a time.
+    A malformed line (e.g. a partial write from an interrupted run) is logged and skipped.
+    """
+    if not os.path.exists(path):
+        logger.error("OCR records file not found at %s", path)
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning("Skipping malformed record on line %d of %s: %s", line_no, path, e)
+                continue
+            if not isinstance(record, dict) or "text" not in record:
+                logger.warning("Skipping record without text on line %d of %s", line_no, path)
+                continue
+            yield record
@@ -1,65 +1,248 @@
-from prompt1 import data_conversion
-import subprocess
-import re
+from prompt1 import data_conversion, JSON_SCHEMA, data_conversion_with_categories, SINGLE_PASS_SCHEMA
+from ollama_client import get_client
+from cache_store import SQLiteCache
+from metrics import timed
+from ocr_compaction import OCR_COMPACTION, prepare_ocr_text
+import logging
+import os
 import json
+import hashlib
 
+# Extraction results keyed by normalized OCR text, prompt version and model,
+# so replayed batches skip the LLM round trip
+EXTRACTION_CACHE_ENABLED = os.environ.get("BILL_EXTRACTION_CACHE", "1") != "0"
+extraction_cache = SQLiteCache("extraction_cache", max_entries=50000, ttl_seconds=30 * 24 * 3600)
 
+# Stream tokens and stop the generation as soon as the first complete JSON object arrives
+EXTRACTION_STREAMING = os.environ.get("BILL_LLM_STREAM", "1") != "0"
 
-def get_json_from_prompt(raw_invoice_text: str) -> dict:
-    prompt = data_conversion(raw_invoice_text)
+# "single": one schema-constrained call returns the fields and the line item categories;
+# "two-call": extraction here, then the categorization agent (also the fallback for "single")
+EXTRACTION_MODES = ("single", "two-call")
+EXTRACTION_MODE = os.environ.get("BILL_EXTRACTION_MODE", "single")
+if EXTRACTION_MODE not in EXTRACTION_MODES:
+    raise ValueError(f"BILL_EXTRACTION_MODE must be one of {EXTRACTION_MODES}, got {EXTRACTION_MODE!r}")
 
-     # 2. Execute Ollama subprocess
-    process = subprocess.Popen(
-        ["ollama", "run", "glm-4.6:cloud"],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        encoding='utf-8'
-    )
+logger = logging.getLogger(__name__)
 
-    output, error = process.communicate(input=prompt)
 
-    if process.returncode != 0:
-        raise RuntimeError(f"Ollama failed: {error}")
-    
-    # --- Debugging: Print raw LLM output ---
-    print(f"\n--- Raw Ollama Output ---\n{output}\n-------------------------\n")
+def normalize_ocr_text(raw_invoice_text: str) -> str:
+    """Collapses whitespace and drops blank lines so trivial OCR differences share a key."""
+    lines = (" ".join(line.split()) for line in raw_invoice_text.splitlines())
+    return "\n".join(line for line in lines if line)
 
-    # 3. Clean the LLM output
-    cleaned_output = output.strip()
 
-    # 3. Extract the LAST JSON object (actual model output, not schema)
-    json_blocks = re.findall(r"\{[\s\S]*?\}", cleaned_output)
+def prompt_fingerprint(mode: str = "two-call") -> str:
+    """Hash of the prompt template and JSON schema of a mode; changes whenever prompt1.py does."""
+    if mode == "single":
+        template = data_conversion_with_categories("") + json.dumps(SINGLE_PASS_SCHEMA, sort_keys=True)
+    else:
+        template = data_conversion("")
+    template += f"compaction={OCR_COMPACTION}"
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()
 
-    if not json_blocks:
-        raise RuntimeError("No JSON object found in Ollama output")
 
-    json_string = json_blocks[-1]  # take LAST JSON block only
+def extraction_cache_key(raw_invoice_text: str, model: str, mode: str = "two-call") -> str:
+    digest = hashlib.sha256(normalize_ocr_text(raw_invoice_text).encode("utf-8"))
+    digest.update(prompt_fingerprint(mode).encode("utf-8"))
+    digest.update(model.encode("utf-8"))
+    return digest.hexdigest()
 
 
-    
-    # match = re.search(r"```json\n?(.*?)\n?```", cleaned_output, re.DOTALL)
-    # if match:
-    #     json_string = match.group(1).strip()
-    # else:
-    #     json_string = cleaned_output.replace("```", "").strip()
-    
+class JsonObjectScanner:
+    """
+    Finds complete top-level JSON objects in text that arrives chunk by chunk.
+    Braces inside JSON strings are ignored, so nested objects are returned whole.
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> list[str]:
+        """Returns the objects completed by this chunk (usually none)."""
+        objects = []
+        for char in chunk:
+            if self._depth == 0:
+                if char == "{":
+                    self._depth = 1
+                    self._buffer = [char]
+                continue
+
+            self._buffer.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    objects.append("".join(self._buffer))
+                    self._buffer = []
+        return objects
+
+
+def find_json_objects(text: str) -> list[str]:
+    """All complete top-level JSON objects in text, nested objects included whole."""
+    return JsonObjectScanner().feed(text)
+
+
+def _is_extraction(json_string: str) -> bool:
+    """True for a parseable object that is not just the schema echoed back."""
+    try:
+        candidate = json.loads(json_string)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(candidate, dict) and candidate != JSON_SCHEMA
+
+
+def stream_json_object(client, prompt: str) -> tuple[str, str]:
+    """
+    Streams the generation and closes it at the first complete JSON object,
+    so the model does not keep writing explanations after the answer.
+    Returns (raw output received, JSON string).
+    """
+    scanner = JsonObjectScanner()
+    received = []
+    stream = client.generate_stream(prompt, agent="extraction")
+    try:
+        for chunk in stream:
+            received.append(chunk)
+            for json_string in scanner.feed(chunk):
+                if _is_extraction(json_string):
+                    return "".join(received), json_string
+    finally:
+        stream.close()
+    raise RuntimeError("No JSON object found in Ollama output")
+
+
+@timed("extract")
+def get_json_from_prompt(raw_invoice_text: str, use_cache: bool | None = None, stream: bool | None = None) -> dict:
+    """
+    Extracts the invoice fields from OCR text with the LLM.
+    Args:
+        raw_invoice_text: OCR text of a single bill.
+        use_cache: False forces a fresh extraction (default: EXTRACTION_CACHE_ENABLED).
+        stream: stop generating at the first complete JSON object (default: EXTRACTION_STREAMING).
+    """
+    if use_cache is None:
+        use_cache = EXTRACTION_CACHE_ENABLED
+    if stream is None:
+        stream = EXTRACTION_STREAMING
+
+    # 1. Compact the OCR text, then reuse a previous extraction of the same text with the same prompt/model
+    invoice_text = prepare_ocr_text(raw_invoice_text)
+    client = get_client()
+    cache_key = extraction_cache_key(invoice_text, client.model)
+    if use_cache:
+        cached = extraction_cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+    prompt = data_conversion(invoice_text)
+
+    if stream:
+        # 2. Stream from Ollama and stop at the first complete object (raises OllamaError on failure)
+        output, json_string = stream_json_object(client, prompt)
+        logger.debug("Raw Ollama output (streamed):\n%s", output)
+    else:
+        # 2. Call Ollama over the shared pooled HTTP client (raises OllamaError on failure)
+        output = client.generate(prompt, agent="extraction")
 
+        # --- Debugging: raw LLM output (BILL_LOG_LEVEL=DEBUG) ---
+        logger.debug("Raw Ollama output:\n%s", output)
 
-    # --- Debugging: Print extracted JSON string ---
-    print(f"\n--- Extracted JSON String ---\n{json_string}\n-----------------------------\n")
+        # 3. Extract the LAST JSON object (actual model output, not schema);
+        #    brace matching keeps nested objects whole, unlike a non-greedy regex
+        json_blocks = [block for block in find_json_objects(output.strip()) if _is_extraction(block)]
+
+        if not json_blocks:
+            raise RuntimeError("No JSON object found in Ollama output")
+
+        json_string = json_blocks[-1]  # take LAST JSON block only
+
+    # --- Debugging: extracted JSON string (BILL_LOG_LEVEL=DEBUG) ---
+    logger.debug("Extracted JSON string:\n%s", json_string)
 
     # 4. converting json string back into dictionary 
     try:
         if not json_string:
             raise ValueError("Extracted JSON string is empty.")
-        return json.loads(json_string)
+        result = json.loads(json_string)
     except json.JSONDecodeError as e:
         raise RuntimeError(f"Failed to parse JSON from Ollama output: {e}\nProblematic string: '{json_string}'") from e
     except ValueError as e:
         raise RuntimeError(f"Error in JSON extraction: {e}") from e
 
+    # 5. Remember the result (a fresh extraction also refreshes the cached entry)
+    if result:
+        extraction_cache.set(cache_key, json.dumps(result))
+    return result
+
+def split_single_pass_result(result: dict) -> tuple[dict, list[str]]:
+    """
+    Converts single-pass output into the two-call shapes: the extraction dict
+    (parallel description/ammount lists, as in JSON_SCHEMA) and the category labels.
+    """
+    line_items = result.get("line_items")
+    if not isinstance(line_items, list) or not all(isinstance(item, dict) for item in line_items):
+        raise RuntimeError(f"Single-pass output has no valid line_items: {result!r}")
+    structured_data_dict = {
+        "invoice_no": result.get("invoice_no"),
+        "issue_date": result.get("issue_date"),
+        "billed_to": result.get("billed_to"),
+        "billed_by": result.get("billed_by"),
+        "description": [item.get("description") for item in line_items],
+        "ammount": [item.get("amount") for item in line_items],
+        "grand_total": result.get("grand_total"),
+    }
+    return structured_data_dict, [item.get("category") for item in line_items]
+
+
+@timed("extract")
+def get_bill_with_categories(raw_invoice_text: str, use_cache: bool | None = None) -> tuple[dict, list[str]]:
+    """
+    Single-pass extraction: one LLM call, constrained to SINGLE_PASS_SCHEMA, returns the
+    invoice fields with a category per line item. Raises OllamaError / RuntimeError when
+    the call or its output fails, so the caller can fall back to the two-call mode.
+    Returns (extraction dict as from get_json_from_prompt, category labels).
+    """
+    if use_cache is None:
+        use_cache = EXTRACTION_CACHE_ENABLED
+
+    invoice_text = prepare_ocr_text(raw_invoice_text)
+    client = get_client()
+    cache_key = extraction_cache_key(invoice_text, client.model, mode="single")
+    if use_cache:
+        cached = extraction_cache.get(cache_key)
+        if cached is not None:
+            return split_single_pass_result(json.loads(cached))
+
+    # Constrained decoding: the response is the JSON object itself, no scanning needed
+    output = client.generate(data_conversion_with_categories(invoice_text), agent="extraction",
+                             format=SINGLE_PASS_SCHEMA)
+    logger.debug("Raw Ollama output (single pass):\n%s", output)
+    try:
+        result = json.loads(output)
+    except json.JSONDecodeError as e:
+        raise RuntimeError(f"Single-pass output is not valid JSON: {e}") from e
+    if not isinstance(result, dict):
+        raise RuntimeError(f"Single-pass output is not a JSON object: {output!r}")
+
+    structured = split_single_pass_result(result)
+    extraction_cache.set(cache_key, json.dumps(result))
+    return structured
+
+
 if __name__ == "__main__":
     SAMPLE_INVOICE_TEXT = """
     Invoice No.: 98765
@@ -1,51 +1,54 @@
 from prompt2 import build_category_prompt
-import subprocess
-import re
+from ollama_client import get_client, OllamaError
+from metrics import inc
+import logging
 import json
 
-def get_category_from_ollama(description_texts: list[str]) -> list[str]:
-    # build_category_prompt already expects a list of strings
-    prompt = build_category_prompt(description_texts)
-
+logger = logging.getLogger(__name__)
 
-    # Execute ollama subprocess (wrap to surface clearer errors)
-    try:
-        process = subprocess.Popen(
-            ["ollama", "run", "glm-4.6:cloud"],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding='utf-8'
-        )
-    except FileNotFoundError as e:
-        raise RuntimeError("'ollama' executable not found. Is Ollama installed and on PATH?") from e
-
-    output, error = process.communicate(input=prompt)
-
-    if process.returncode != 0:
-        return ["Uncategorized LLM Error"]
-
-    # The LLM is instructed to return a JSON array of strings.
-    # We need to extract and parse this JSON.
-    cleaned_output = output.strip()
-    json_match = re.search(r'\[[\s\S]*?\]', cleaned_output, re.DOTALL)
-    
-    if json_match:
-        json_string = json_match.group(0)
+def parse_category_output(output: str) -> list[str] | None:
+    """The first JSON array of strings in the LLM output, or None if there is none."""
+    start = output.find("[")
+    while start != -1:
         try:
-            categories = json.loads(json_string)
-            if isinstance(categories, list) and all(isinstance(c, str) for c in categories):
-                return categories
-            else:
-                print(f"Warning: LLM returned non-list or non-string categories: {json_string}")
-                return ["Other"] * len(description_texts) # Fallback
+            categories, _ = json.JSONDecoder().raw_decode(output, start)
         except json.JSONDecodeError:
-            print(f"Warning: Failed to decode JSON from LLM for categorization: {json_string}")
-            return ["Other"] * len(description_texts) # Fallback
-    else:
-        print(f"Warning: No JSON array found in LLM output for categorization: {cleaned_output}")
+            start = output.find("[", start + 1)
+            continue
+        if isinstance(categories, list) and all(isinstance(c, str) for c in categories):
+            return categories
+        start = output.find("[", start + 1)
+    return None
+
+
+def request_categories(description_texts: list[str]) -> list[str] | None:
+    """
+    One categorization call. Returns the labels exactly as the LLM gave them
+    (the caller checks the length), or None if the call failed or returned no JSON array.
+    """
+    prompt = build_category_prompt(description_texts)
+
+    # Call Ollama over the shared pooled HTTP client
+    try:
+        output = get_client().generate(prompt, agent="categorization")
+    except OllamaError as e:
+        logger.warning("Ollama categorization call failed: %s", e)
+        inc("category_fallbacks", reason="llm_error", value=len(description_texts))
+        return None
+
+    categories = parse_category_output(output.strip())
+    if categories is None:
+        logger.warning("No JSON array of categories found in LLM output: %s", output.strip())
+        inc("category_fallbacks", reason="no_json", value=len(description_texts))
+    return categories
+
+
+def get_category_from_ollama(description_texts: list[str]) -> list[str]:
+    # build_category_prompt already expects a list of strings
+    categories = request_categories(description_texts)
+    if categories is None:
         return ["Other"] * len(description_texts) # Fallback
+    return categories
 
 
 if __name__ == "__main__":
@@ -1,25 +1,23 @@
 from prompt3 import user_query
-import subprocess
+from ollama_client import get_client
 import re
 
+def stream_user_query(user_input: str):
+    """Yields the raw LLM answer chunk by chunk, for showing the SQL while it is generated."""
+    yield from get_client().generate_stream(user_query(user_input), agent="sql")
+
+
 def response_to_user_query(user_input:str) -> str:
     prompt = user_query(user_input)
-    process = subprocess.Popen(
-        ["ollama", "run", "glm-4.6:cloud"],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        encoding='utf-8'
-    )
-    
-    output, error = process.communicate(input=prompt)
-    
-    #cleaning the output from llm  (ollama)
 
-    if process.returncode != 0:
-        raise RuntimeError(f"Ollama failed: {error}")
+    # Call Ollama over the shared pooled HTTP client (raises OllamaError on failure)
+    output = get_client().generate(prompt, agent="sql")
+    return extract_sql(output)
 
+
+def extract_sql(output: str) -> str:
+    """Pulls the final SQL statement out of the raw LLM answer."""
+    #cleaning the output from llm  (ollama)
     cleaned_output = output.strip()
 
     # Attempt to extract content from the last SQL markdown block
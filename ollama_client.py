@@ -0,0 +1,232 @@
+import http.client
+import json
+import os
+import queue
+import threading
+from urllib.parse import urlparse
+from metrics import inc, observe
+
+# Endpoint / model settings, overridable from the environment
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")
+MODEL_NAME = os.environ.get("OLLAMA_MODEL", "glm-4.6:cloud")
+KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")  # keep the model loaded between calls
+DEFAULT_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", "300"))
+POOL_SIZE = int(os.environ.get("OLLAMA_POOL_SIZE", "4"))
+
+
+class OllamaError(RuntimeError):
+    """Raised when the Ollama server cannot be reached or returns an error."""
+
+
+class OllamaClient:
+    """
+    Small client for the Ollama HTTP API.
+    Connections are kept alive and reused from a bounded pool, so each call
+    only pays for the request itself instead of starting an `ollama run` process.
+    """
+
+    def __init__(self, host: str = OLLAMA_HOST, model: str = MODEL_NAME,
+                 keep_alive: str = KEEP_ALIVE, timeout: float = DEFAULT_TIMEOUT,
+                 pool_size: int = POOL_SIZE):
+        if "://" not in host:
+            host = f"http://{host}"
+        parsed = urlparse(host)
+        self.scheme = parsed.scheme or "http"
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or (443 if self.scheme == "https" else 11434)
+        self.base_path = parsed.path.rstrip("/")
+        self.model = model
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    # --- connection pool ---
+
+    def _new_connection(self, timeout: float) -> http.client.HTTPConnection:
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _acquire(self, timeout: float):
+        if not self._slots.acquire(timeout=timeout):
+            raise OllamaError(f"No free Ollama connection after {timeout}s")
+        try:
+            conn = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = self._new_connection(timeout)
+            reused = False
+
+        # Per-call timeout, also applied to an already open socket
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, reused
+
+    def _release(self, conn, reusable: bool):
+        if reusable:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        """Closes every idle pooled connection."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    # --- requests ---
+
+    def _post(self, path: str, payload: dict, timeout: float | None = None) -> dict:
+        timeout = self.timeout if timeout is None else timeout
+        body = json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+
+        # One retry: a reused keep-alive connection may have been closed by the server
+        for attempt in range(2):
+            conn, reused = self._acquire(timeout)
+            reusable = False
+            try:
+                conn.request("POST", self.base_path + path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                reusable = not response.will_close
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                if reused and attempt == 0:
+                    inc("llm_retries")
+                    continue
+                inc("llm_errors")
+                raise OllamaError(f"Ollama connection failed: {e}") from e
+            except (OSError, http.client.HTTPException) as e:
+                inc("llm_errors")
+                raise OllamaError(f"Ollama request to {self.host}:{self.port} failed: {e}") from e
+            finally:
+                self._release(conn, reusable)
+
+            if response.status != 200:
+                inc("llm_errors")
+                raise OllamaError(f"Ollama failed ({response.status}): {data.decode('utf-8', 'replace')}")
+            try:
+                return json.loads(data)
+            except json.JSONDecodeError as e:
+                raise OllamaError(f"Invalid JSON from Ollama: {e}") from e
+
+        raise OllamaError("Ollama request failed after retry")
+
+    def _generate_payload(self, prompt: str, model: str | None, options: dict | None, stream: bool,
+                          format: dict | str | None = None) -> dict:
+        payload = {
+            "model": model or self.model,
+            "prompt": prompt,
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+        }
+        if options:
+            payload["options"] = options
+        if format:
+            # "json" or a JSON schema: Ollama constrains decoding to output matching it
+            payload["format"] = format
+        return payload
+
+    @staticmethod
+    def _record_usage(agent: str, prompt: str, response_text: str, body: dict):
+        observe("llm_prompt_chars", len(prompt), agent=agent)
+        observe("llm_response_chars", len(response_text), agent=agent)
+        if body.get("prompt_eval_count") is not None:
+            observe("llm_prompt_tokens", body["prompt_eval_count"], agent=agent)
+        if body.get("eval_count") is not None:
+            observe("llm_response_tokens", body["eval_count"], agent=agent)
+
+    def generate_response(self, prompt: str, model: str | None = None,
+                          timeout: float | None = None, options: dict | None = None,
+                          agent: str = "other", format: dict | str | None = None) -> dict:
+        """
+        Calls /api/generate (non-streaming) and returns the full response body,
+        including `response` and the token counters reported by Ollama.
+        agent labels the call in the metrics (extraction, categorization, sql).
+        format ("json" or a JSON schema dict) turns on constrained decoding.
+        """
+        inc("llm_calls", agent=agent, mode="blocking")
+        body = self._post("/api/generate", self._generate_payload(prompt, model, options, False, format), timeout)
+        self._record_usage(agent, prompt, body.get("response", ""), body)
+        return body
+
+    def generate(self, prompt: str, model: str | None = None,
+                 timeout: float | None = None, options: dict | None = None, agent: str = "other",
+                 format: dict | str | None = None) -> str:
+        """Returns only the generated text for the prompt."""
+        return self.generate_response(prompt, model, timeout, options, agent, format).get("response", "")
+
+    def generate_stream(self, prompt: str, model: str | None = None,
+                        timeout: float | None = None, options: dict | None = None, agent: str = "other"):
+        """
+        Yields the generated text chunk by chunk as Ollama produces it.
+        Closing the generator early (break / .close()) drops the connection,
+        which makes Ollama stop generating.
+        """
+        inc("llm_calls", agent=agent, mode="stream")
+        timeout = self.timeout if timeout is None else timeout
+        body = json.dumps(self._generate_payload(prompt, model, options, True)).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+
+        conn, _ = self._acquire(timeout)
+        reusable = False
+        received = []
+        final = None
+        try:
+            try:
+                conn.request("POST", self.base_path + "/api/generate", body=body, headers=headers)
+                response = conn.getresponse()
+                if response.status != 200:
+                    inc("llm_errors")
+                    raise OllamaError(f"Ollama failed ({response.status}): {response.read().decode('utf-8', 'replace')}")
+
+                # Newline-delimited JSON, one object per generated chunk
+                while True:
+                    line = response.readline()
+                    if not line:
+                        break
+                    if not line.strip():
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("error"):
+                        raise OllamaError(f"Ollama failed: {chunk['error']}")
+                    if chunk.get("response"):
+                        received.append(chunk["response"])
+                        yield chunk["response"]
+                    if chunk.get("done"):
+                        final = chunk
+                        response.read()
+                        reusable = not response.will_close
+                        break
+            except (OSError, http.client.HTTPException, json.JSONDecodeError) as e:
+                inc("llm_errors")
+                raise OllamaError(f"Ollama streaming request to {self.host}:{self.port} failed: {e}") from e
+        finally:
+            self._release(conn, reusable)
+            if final is None:
+                inc("llm_streams_stopped_early", agent=agent)
+            self._record_usage(agent, prompt, "".join(received), final or {})
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_client() -> OllamaClient:
+    """Returns the process-wide shared client (created on first use)."""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = OllamaClient()
+        return _default_client
+
+
+if __name__ == "__main__":
+    print(get_client().generate("Reply with the single word: ready"))
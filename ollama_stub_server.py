@@ -0,0 +1,157 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Ollama HTTP API, used to exercise ollama_client
+# without a real model. Answers /api/generate with a configurable responder.
+
+
+def default_responder(payload: dict) -> str:
+    return "{}"
+
+
+class StubOllamaServer:
+    """
+    Runs a minimal /api/generate endpoint on a background thread.
+    Args:
+        responder: function(payload) -> response text.
+        latency: seconds to sleep before answering each request.
+        token_latency: seconds between streamed chunks (stream=true requests).
+    """
+
+    def __init__(self, responder=default_responder, latency: float = 0.0,
+                 host: str = "127.0.0.1", port: int = 0, token_latency: float = 0.0):
+        self.responder = responder
+        self.latency = latency
+        self.token_latency = token_latency
+        self.request_count = 0
+        self.connection_count = 0
+        self.cancelled_count = 0  # streams the client closed before the end
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connection_count += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, body: dict):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def _stream(self, payload: dict, text: str):
+                # Chunked NDJSON like Ollama: one object per token, then a final "done" object
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                tokens = re.findall(r"\S+\s*|\s+", text)
+                try:
+                    for token in tokens:
+                        if stub.token_latency:
+                            time.sleep(stub.token_latency)
+                        self._write_chunk(json.dumps({"response": token, "done": False}).encode("utf-8") + b"\n")
+                    self._write_chunk(json.dumps({
+                        "response": "",
+                        "done": True,
+                        "prompt_eval_count": len(payload.get("prompt", "").split()),
+                        "eval_count": len(tokens),
+                    }).encode("utf-8") + b"\n")
+                    self._write_chunk(b"")
+                except (BrokenPipeError, ConnectionResetError):
+                    with stub._lock:
+                        stub.cancelled_count += 1
+                    self.close_connection = True
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._send_json(200, {"models": []})
+                else:
+                    self._send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    payload = json.loads(self.rfile.read(length) or b"{}")
+                except json.JSONDecodeError:
+                    self._send_json(400, {"error": "invalid json"})
+                    return
+                if self.path != "/api/generate":
+                    self._send_json(404, {"error": "not found"})
+                    return
+
+                with stub._lock:
+                    stub.request_count += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                text = stub.responder(payload)
+                if payload.get("stream", True):
+                    self._stream(payload, text)
+                    return
+                self._send_json(200, {
+                    "model": payload.get("model"),
+                    "response": text,
+                    "done": True,
+                    "prompt_eval_count": len(payload.get("prompt", "").split()),
+                    "eval_count": len(text.split()),
+                })
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="Run a stub Ollama server")
+    arg_parser.add_argument("--port", type=int, default=11434)
+    arg_parser.add_argument("--latency", type=float, default=0.0)
+    arg_parser.add_argument("--token-latency", type=float, default=0.0)
+    args = arg_parser.parse_args()
+
+    stub = StubOllamaServer(latency=args.latency, port=args.port, token_latency=args.token_latency).start()
+    print(f"Stub Ollama server listening on {stub.url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stub.stop()
@@ -1,103 +1,194 @@
-import os
 import json
-import re
-from ollama1 import get_json_from_prompt
-from ollama2 import get_category_from_ollama
+import logging
+import os
+from ollama1 import get_json_from_prompt, get_bill_with_categories, EXTRACTION_MODE
+from category_memo import categorize_with_memo, categorize_with_proposed, categorize_batch
+from date_normalizer import normalize_date
+from metrics import inc
+from ocr_records import RECORDS_FILE, read_records
+
+ocr_output_file = RECORDS_FILE
 
-ocr_output_file = "extracted_text.txt"
+# Bills whose descriptions are categorized together in iter_parsed_invoices
+CATEGORY_BATCH_BILLS = int(os.environ.get("BILL_CATEGORY_BATCH_BILLS", "50"))
 
+logger = logging.getLogger(__name__)
 
-def parse_multiple_invoices():
-    print(f"Parsing started...")
 
-    if not os.path.exists(ocr_output_file):
-        print(f"OCR file not found at {ocr_output_file}")
+def get_descriptions_for_categorization(structured_data_dict: dict) -> list[str]:
+    """
+    Returns the cleaned service descriptions from the extraction output,
+    ready to be sent to the categorization agent.
+    """
+    # Note: 'description' is from prompt1.py schema (lowercase)
+    description_list = structured_data_dict.get('description', [])
+    if description_list and isinstance(description_list, list):
+        return [str(d).strip() for d in description_list]
+    return []
+
+
+def build_structured_bill(structured_data_dict: dict, category_labels: list[str], source_filename: str) -> dict:
+    """
+    Combines the extraction output and the category labels into the final
+    bill dictionary (DB schema keys, one dict per line item).
+    """
+    # Note: 'description' and 'ammount' are from prompt1.py schema (lowercase)
+    description_list = structured_data_dict.get('description', [])
+    amount_list = structured_data_dict.get('ammount', [])
+    enriched_line_items = []
+
+    # Ensure category_labels matches the length of description_list
+    # (labels cannot be matched to positions then: leave every item uncategorized for review
+    # rather than claiming "Other")
+    if isinstance(description_list, list) and len(category_labels) != len(description_list):
+        logger.warning("Category labels count mismatch for %s. Expected %d, got %d. Leaving items uncategorized.",
+                       source_filename, len(description_list), len(category_labels))
+        inc("category_fallbacks", len(description_list), reason="count_mismatch")
+        category_labels = [None] * len(description_list)
+
+    # Combine descriptions, amounts, and categories
+    # Ensure description_list and amount_list are iterable and of same length
+    if isinstance(description_list, list) and isinstance(amount_list, list) and len(description_list) == len(amount_list):
+        for i, (desc_item_raw, amt) in enumerate(zip(description_list, amount_list)):
+            enriched_item = {
+                'service_description': str(desc_item_raw).strip(),
+                'Amount': amt,
+                'Category': category_labels[i] if i < len(category_labels) else None
+            }
+            enriched_line_items.append(enriched_item)
+    else:
+        logger.warning("Description or Amount lists are not valid for %s. Skipping categorization.", source_filename)
+        # Fallback if lists are not valid, try to use what's available
+        if description_list and amount_list:
+            enriched_line_items = [{'service_description': d, 'Amount': a, 'Category': category_labels[i] if i < len(category_labels) else None} for i, (d, a) in enumerate(zip(description_list, amount_list))]
+        elif description_list:
+            enriched_line_items = [{'service_description': d, 'Amount': None, 'Category': category_labels[i] if i < len(category_labels) else None} for i, d in enumerate(description_list)]
+        elif amount_list:
+             enriched_line_items = [{'service_description': 'Unknown', 'Amount': a, 'Category': None} for a in amount_list]
+
+    # Prepare final structured data, mapping LLM output keys to DB schema keys
+    return {
+        "Invoice_No": structured_data_dict.get("invoice_no"),
+        "Issue_Date": structured_data_dict.get("issue_date"),
+        "Issue_Date_ISO": normalize_date(structured_data_dict.get("issue_date")), # YYYY-MM-DD for date queries
+        "billed_to": structured_data_dict.get("billed_to"),
+        "billed_by": structured_data_dict.get("billed_by"),
+        "Grand_Total": structured_data_dict.get("grand_total"),
+        "source_file": source_filename, # Use the passed filename
+        "line_items": enriched_line_items # Store line items separately for easier processing
+    }
+
+
+def categorize_descriptions(descriptions: list[str], source_filename: str) -> list[str]:
+    # Agent 2: Batch Categorization (known descriptions are answered from the category memo)
+    if not descriptions:
         return []
-    
-    with open(ocr_output_file, 'r', encoding='utf-8') as f:
-        master_text = f.read()
+    logger.info("Batch Categorizing %d items for %s...", len(descriptions), source_filename)
+    return categorize_with_memo(descriptions)
+
+
+def extract_single_pass(bill_text: str, source_filename: str, use_cache: bool | None = None):
+    """
+    Agents 1 + 2 in one schema-constrained LLM call.
+    Returns (extraction dict, category labels), or None when the single-pass call
+    fails so the caller falls back to the two-call path.
+    """
+    try:
+        structured_data_dict, proposed_labels = get_bill_with_categories(bill_text, use_cache)
+    except RuntimeError as e:  # includes OllamaError
+        logger.warning("Single-pass extraction failed for %s, falling back to two calls: %s", source_filename, e)
+        inc("extraction_fallbacks")
+        return None
+    descriptions = get_descriptions_for_categorization(structured_data_dict)
+    return structured_data_dict, (categorize_with_proposed(descriptions, proposed_labels) if descriptions else [])
+
+
+def extract_bill(bill_text: str, source_filename: str, use_cache: bool | None = None,
+                 mode: str | None = None) -> tuple[dict, list[str] | None] | None:
+    """
+    Runs the extraction for one bill: (extraction dict, category labels) from the
+    single-pass call, or (extraction dict, None) when the descriptions still need
+    categorizing (two-call mode or fallback). Returns None when extraction fails.
+    """
+    if (mode or EXTRACTION_MODE) == "single":
+        single = extract_single_pass(bill_text, source_filename, use_cache)
+        if single:
+            return single
 
+    # Agent 1: Extraction
+    structured_data_dict = get_json_from_prompt(bill_text, use_cache)
+    if not structured_data_dict:
+        logger.warning("Failed to extract data for %s", source_filename)
+        return None
+    return structured_data_dict, None
 
-     # Split using the marker you chose
-    bill_section = re.split(r"--\s*Text\s+from\s+", master_text)[1:]
-    total_bills = len(bill_section)
-    print(f"Total bills to process: {total_bills}")
 
-    all_structured_list = []
+def parse_bill_text(bill_text: str, source_filename: str, use_cache: bool | None = None,
+                    mode: str | None = None) -> dict:
+    """
+    OCR text of one bill -> structured bill, with the single-pass call (mode "single",
+    default EXTRACTION_MODE) or extraction followed by categorization ("two-call").
+    Returns {} when extraction fails.
+    """
+    extracted = extract_bill(bill_text, source_filename, use_cache, mode)
+    if not extracted:
+        return {}
+    structured_data_dict, category_labels = extracted
+    if category_labels is None:
+        category_labels = categorize_descriptions(get_descriptions_for_categorization(structured_data_dict), source_filename)
+    return build_structured_bill(structured_data_dict, category_labels, source_filename)
+
+
+def _categorize_pending(pending: list[tuple[str, dict]]):
+    # Agent 2 once for a group of bills: shared descriptions are categorized once
+    description_lists = [get_descriptions_for_categorization(structured) for _, structured in pending]
+    logger.info("Batch categorizing %d items from %d bills...", sum(map(len, description_lists)), len(pending))
+    try:
+        label_lists = categorize_batch(description_lists)
+    except Exception as e:
+        logger.error("Batch categorization failed: %s", e)
+        label_lists = [[None] * len(descriptions) for descriptions in description_lists]
+    for (filename, structured), labels in zip(pending, label_lists):
+        yield build_structured_bill(structured, labels, filename)
 
 
-    for section in bill_section:
+def iter_parsed_invoices(records_file: str = ocr_output_file, batch_bills: int = CATEGORY_BATCH_BILLS):
+    """
+    Reads the OCR records one at a time and yields the structured bill for each,
+    so memory use does not grow with the batch size. Bills that fail are logged and skipped.
+    Bills still needing categories are held back and categorized batch_bills at a time.
+    """
+    logger.info("Parsing started...")
+    pending = []
+    for record in read_records(records_file):
+        filename = record.get("filename") or "unknown"
         try:
-            # Splitting filename and content
-            section = section.strip()
-            parts = section.split("--", 1)
-            filename = parts[0].strip()
-            bill_text = parts[1].strip() if len(parts) > 1 else ""
-            print(f" Processing: {filename}")
-
-            # Agent 1: Extraction
-            structured_data_dict = get_json_from_prompt(bill_text)
-
-
-            # dscription{expense1, expense2, expense3}, amount{amount1, amount2, amount3}
-
-            #breaking multiple descriptions into single line item id
-            if structured_data_dict:
-                # Note: 'description' and 'ammount' are from prompt1.py schema (lowercase)
-                description_list = structured_data_dict.get('description', [])
-                amount_list = structured_data_dict.get('ammount', [])
-                enriched_line_items = []
-
-                # Agent 2: Batch Categorization
-                if description_list and isinstance(description_list, list):
-                    print(f"   > Batch Categorizing {len(description_list)} items for {filename}...")
-                    category_labels = get_category_from_ollama([str(d).strip() for d in description_list])
-                    
-                    # Ensure category_labels matches the length of description_list
-                    if len(category_labels) != len(description_list):
-                        print(f"Warning: Category labels count mismatch for {filename}. Expected {len(description_list)}, got {len(category_labels)}. Filling with 'Other'.")
-                        category_labels = ["Other"] * len(description_list)
-                else:
-                    category_labels = ["Other"] * len(description_list) # If no descriptions, no categories
-
-                # Combine descriptions, amounts, and categories
-                # Ensure description_list and amount_list are iterable and of same length
-                if isinstance(description_list, list) and isinstance(amount_list, list) and len(description_list) == len(amount_list):
-                    for i, (desc_item_raw, amt) in enumerate(zip(description_list, amount_list)):
-                        enriched_item = {
-                            'service_description': str(desc_item_raw).strip(),
-                            'Amount': amt,
-                            'Category': category_labels[i] if i < len(category_labels) else 'Other'
-                        }
-                        enriched_line_items.append(enriched_item)
-                else:
-                    print(f"Warning: Description or Amount lists are not valid for {filename}. Skipping categorization.")
-                    # Fallback if lists are not valid, try to use what's available
-                    if description_list and amount_list:
-                        enriched_line_items = [{'service_description': d, 'Amount': a, 'Category': category_labels[i] if i < len(category_labels) else 'Other'} for i, (d, a) in enumerate(zip(description_list, amount_list))]
-                    elif description_list:
-                        enriched_line_items = [{'service_description': d, 'Amount': None, 'Category': category_labels[i] if i < len(category_labels) else 'Other'} for i, d in enumerate(description_list)]
-                    elif amount_list:
-                         enriched_line_items = [{'service_description': 'Unknown', 'Amount': a, 'Category': 'Other'} for a in amount_list]
-
-
-                # Prepare final structured data, mapping LLM output keys to DB schema keys
-                final_structured_data = {
-                    "Invoice_No": structured_data_dict.get("invoice_no"),
-                    "Issue_Date": structured_data_dict.get("issue_date"),
-                    "billed_to": structured_data_dict.get("billed_to"),
-                    "billed_by": structured_data_dict.get("billed_by"),
-                    "Grand_Total": structured_data_dict.get("grand_total"),
-                    "source_file": filename, # Use the passed filename
-                    "line_items": enriched_line_items # Store line items separately for easier processing
-                }
-                all_structured_list.append(final_structured_data)
-            else:
-                print(f"Failed to extract data for {filename}")
+            logger.info("Processing: %s", filename)
+            extracted = extract_bill(record["text"].strip(), filename)
+            if not extracted:
+                continue
+            structured_data_dict, category_labels = extracted
+            if category_labels is not None:
+                yield build_structured_bill(structured_data_dict, category_labels, filename)
+                continue
+            pending.append((filename, structured_data_dict))
 
         except Exception as e:
-            print(f" Error processing section for {filename}: {e}")
+            logger.error("Error processing record for %s: %s", filename, e)
+            continue
+
+        if len(pending) >= batch_bills:
+            yield from _categorize_pending(pending)
+            pending = []
+
+    if pending:
+        yield from _categorize_pending(pending)
 
+
+def parse_multiple_invoices(records_file: str = ocr_output_file) -> list[dict]:
+    """List form of iter_parsed_invoices, for callers that need every bill at once."""
+    all_structured_list = list(iter_parsed_invoices(records_file))
+    logger.info("Total bills parsed: %d", len(all_structured_list))
     return all_structured_list
 
 def parse_single_invoice_text(raw_invoice_text: str, source_filename: str) -> dict:
@@ -105,68 +196,16 @@ def parse_single_invoice_text(raw_invoice_text: str, source_filename: str) -> di
     Parses a single raw invoice text (OCR output) and returns structured data.
     """
     try:
-        # Agent 1: Extraction
-        structured_data_dict = get_json_from_prompt(raw_invoice_text)
-
-        if structured_data_dict:
-            # Note: 'description' and 'ammount' are from prompt1.py schema (lowercase)
-            description_list = structured_data_dict.get('description', [])
-            amount_list = structured_data_dict.get('ammount', [])
-            enriched_line_items = []
-
-            # Agent 2: Categorization
-            # Ensure description_list and amount_list are iterable and of same length
-            if isinstance(description_list, list) and isinstance(amount_list, list) and len(description_list) == len(amount_list):
-                print(f"   > Batch Categorizing {len(description_list)} items for {source_filename}...")
-                service_descriptions_for_llm = [str(d).strip() for d in description_list]
-                category_labels = get_category_from_ollama(service_descriptions_for_llm)
-
-                # Ensure category_labels matches the length of description_list
-                if len(category_labels) != len(description_list):
-                    print(f"Warning: Category labels count mismatch for {source_filename}. Expected {len(description_list)}, got {len(category_labels)}. Filling with 'Other'.")
-                    category_labels = ["Other"] * len(description_list)
-
-                for i, (desc_item_raw, amt) in enumerate(zip(description_list, amount_list)):
-                    enriched_item = {
-                        'service_description': str(desc_item_raw).strip(),
-                        'Amount': amt,
-                        'Category': category_labels[i] if i < len(category_labels) else 'Other'
-                    }
-                    enriched_line_items.append(enriched_item)
-            else:
-                print(f"Warning: Description or Amount lists are not valid for {source_filename}. Skipping categorization.")
-                # Fallback if lists are not valid, try to use what's available
-                if description_list and amount_list:
-                    enriched_line_items = [{'service_description': d, 'Amount': a, 'Category': 'Other'} for d, a in zip(description_list, amount_list)]
-                elif description_list:
-                    enriched_line_items = [{'service_description': d, 'Amount': None, 'Category': 'Other'} for d in description_list]
-                elif amount_list:
-                     enriched_line_items = [{'service_description': 'Unknown', 'Amount': a, 'Category': 'Other'} for a in amount_list]
-
-
-            # Prepare final structured data, mapping LLM output keys to DB schema keys
-            final_structured_data = {
-                "Invoice_No": structured_data_dict.get("invoice_no"),
-                "Issue_Date": structured_data_dict.get("issue_date"),
-                "billed_to": structured_data_dict.get("billed_to"),
-                "billed_by": structured_data_dict.get("billed_by"),
-                "Grand_Total": structured_data_dict.get("grand_total"),
-                "source_file": source_filename, # Use the passed filename
-                "line_items": enriched_line_items # Store line items separately for easier processing
-            }
-            return final_structured_data
-        else:
-            print(f"Failed to extract data for {source_filename}")
-            return {}
+        return parse_bill_text(raw_invoice_text, source_filename)
 
     except Exception as e:
-        print(f" Error processing single invoice text for {source_filename}: {e}")
+        logger.error("Error processing single invoice text for %s: %s", source_filename, e)
         return {}
 
-    return all_structured_list
-
 
 if __name__ == "__main__":
+    from metrics import configure_logging
+    configure_logging()
     final_extracted_data = parse_multiple_invoices()
     print(" Final List of Bills Generated!")
     # Use json.dumps for pretty printing the final result
@@ -0,0 +1,499 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from image_cleaning import clean_image_file_with_plan, describe_plan
+from manifest import IngestManifest, stage_reached
+from duplicate_index import DuplicateIndex
+from ocr_processor import perform_ocr_on_image_path, get_cached_source_ocr, cache_source_ocr
+from ollama1 import get_json_from_prompt, EXTRACTION_MODE
+from parser import get_descriptions_for_categorization, build_structured_bill, extract_single_pass
+from category_memo import categorize_batch, CATEGORY_CHUNK_SIZE
+
+# Pipelined batch ingestion: clean (process pool, CPU-bound) -> OCR (shared Tesseract worker pool)
+# -> extraction -> categorization (bounded concurrent LLM requests).
+# Every bill flows through the stages on its own, so bill N+1 is being
+# cleaned/OCR'd while bill N is still waiting on the LLM.
+# With a manifest, only new or changed images are processed and an interrupted
+# bill resumes after the last stage it completed. With a duplicate index, images of a
+# bill already ingested under another file name are skipped before cleaning.
+# At most max_in_flight images are admitted at a time, and finished bills can be handed
+# to the database in batches as they complete instead of after the whole folder.
+
+input_folder = "bill_image"
+output_folder = "image_cleaning_one_folder"
+
+VALID_EXTENSIONS = (".jpg", ".jpeg", ".png")
+STAGES = ("clean", "ocr", "extract", "categorize")
+
+logger = logging.getLogger(__name__)
+
+
+def _lookup_source_ocr(input_path: str) -> str | None:
+    with open(input_path, "rb") as f:
+        return get_cached_source_ocr(f.read())
+
+
+def _store_source_ocr(input_path: str, text: str):
+    with open(input_path, "rb") as f:
+        cache_source_ocr(f.read(), text)
+
+
+def _check_duplicate(duplicate_index: DuplicateIndex, input_path: str) -> dict | None:
+    # The image is reserved under its file name until mark_inserted confirms it or the bill fails
+    filename = os.path.basename(input_path)
+    with open(input_path, "rb") as f:
+        return duplicate_index.check(f.read(), filename, reserve_as=filename)
+
+
+class StageStats:
+    """Counts items and busy time for one pipeline stage."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.completed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def record(self, started: float, ended: float, ok: bool = True):
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.busy_seconds += ended - started
+        self.first_start = started if self.first_start is None else min(self.first_start, started)
+        self.last_end = ended if self.last_end is None else max(self.last_end, ended)
+
+    def as_dict(self) -> dict:
+        wall = (self.last_end - self.first_start) if self.completed and self.last_end else 0.0
+        return {
+            "stage": self.name,
+            "completed": self.completed,
+            "failed": self.failed,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "wall_seconds": round(wall, 3),
+            "items_per_second": round(self.completed / wall, 3) if wall > 0 else None,
+            "avg_seconds_per_item": round(self.busy_seconds / self.completed, 3) if self.completed else None,
+        }
+
+
+class CategoryBatcher:
+    """
+    Collects the descriptions of bills waiting for categorization at the same time and
+    categorizes them together (categorize_batch: duplicates across bills are sent once),
+    as soon as max_items descriptions are waiting or max_wait seconds have passed.
+    """
+
+    def __init__(self, pipeline: "BatchPipeline", executor, limit: asyncio.Semaphore,
+                 max_items: int = CATEGORY_CHUNK_SIZE, max_wait: float = 0.5):
+        self.pipeline = pipeline
+        self.executor = executor
+        self.limit = limit
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self._pending = []  # (descriptions, future)
+        self._items = 0
+        self._timer = None
+        self._tasks = set()
+
+    async def categorize(self, descriptions: list[str]) -> list[str | None]:
+        if not descriptions:
+            return []
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((descriptions, future))
+        self._items += len(descriptions)
+        if self._items >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._items = self._pending, [], 0
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list):
+        try:
+            async with self.limit:
+                label_lists = await self.pipeline._timed(
+                    "categorize", self.executor, categorize_batch, [descriptions for descriptions, _ in batch]
+                )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), labels in zip(batch, label_lists):
+            if not future.done():
+                future.set_result(labels)
+
+
+class BatchPipeline:
+    """
+    Runs the folder ingestion stages concurrently.
+    Args:
+        clean_workers: processes used for image cleaning (default: CPU count).
+        ocr_workers: OCR jobs in flight on the shared OCR worker pool (default: CPU count).
+        extract_concurrency: max extraction LLM requests in flight.
+        categorize_concurrency: max categorization LLM requests in flight; the descriptions of
+            bills reaching categorization together are sent as one deduplicated batch.
+        use_extraction_cache: False forces fresh LLM extraction for every bill.
+        extraction_mode: "single" (one call with categories) or "two-call" (default: EXTRACTION_MODE).
+        manifest: IngestManifest for incremental runs (None processes every image).
+        duplicate_index: DuplicateIndex; near-duplicates of images already indexed are
+            skipped (None processes every image).
+        max_in_flight: images admitted into the pipeline at the same time
+            (default: twice the cleaning, OCR and extraction slots together).
+        insert_batch_size: finished bills handed to run()'s insert callable at a time.
+    """
+
+    def __init__(self, clean_workers: int | None = None, ocr_workers: int | None = None,
+                 extract_concurrency: int = 4, categorize_concurrency: int = 4,
+                 use_extraction_cache: bool = True, manifest: IngestManifest | None = None,
+                 extraction_mode: str | None = None, duplicate_index: DuplicateIndex | None = None,
+                 max_in_flight: int | None = None, insert_batch_size: int = 20):
+        cpu_count = os.cpu_count() or 1
+        self.clean_workers = clean_workers or cpu_count
+        self.ocr_workers = ocr_workers or cpu_count
+        self.extract_concurrency = extract_concurrency
+        self.categorize_concurrency = categorize_concurrency
+        self.max_in_flight = max_in_flight or 2 * (self.clean_workers + self.ocr_workers + extract_concurrency)
+        self.insert_batch_size = insert_batch_size
+        self.use_extraction_cache = use_extraction_cache
+        self.manifest = manifest
+        self.extraction_mode = extraction_mode or EXTRACTION_MODE
+        self.duplicate_index = duplicate_index
+        self.resumed = 0
+        self.parsed = 0
+        self.inserted = 0
+        self.duplicates = {}  # filename -> {"duplicate_of": ..., "distance": ...}
+        self.stats = {name: StageStats(name) for name in STAGES}
+        self.ocr_cache_hits = 0
+        self.preprocessing = {}  # filename -> preprocessing record (plan, stats, timings)
+        self._category_batcher = None
+
+    async def _timed(self, stage: str, executor, func, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            result = await loop.run_in_executor(executor, func, *args)
+        except Exception:
+            self.stats[stage].record(started, time.perf_counter(), ok=False)
+            raise
+        self.stats[stage].record(started, time.perf_counter(), ok=bool(result) or result == [])
+        return result
+
+    async def _record(self, filename: str, stage: str, **outputs):
+        if self.manifest:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, lambda: self.manifest.record(filename, stage, **outputs))
+
+    async def _record_error(self, filename: str, error: str):
+        if self.manifest:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.manifest.record_error, filename, error)
+
+    async def _process_bill(self, input_path: str, cleaned_path: str, pools: dict, limits: dict):
+        filename = os.path.basename(input_path)
+        loop = asyncio.get_running_loop()
+        try:
+            # Read when the bill is admitted, so resumed OCR texts and bills are not all held at once
+            entry = await loop.run_in_executor(None, self.manifest.entry, filename) if self.manifest else None
+
+            # Resumed bills are checked again too: a copy may have been inserted since their last attempt
+            if self.duplicate_index is not None:
+                duplicate = await loop.run_in_executor(None, _check_duplicate, self.duplicate_index, input_path)
+                if duplicate:
+                    self.duplicates[filename] = duplicate
+                    await self._record_error(filename, f"duplicate of {duplicate['duplicate_of']}")
+                    return None
+
+            # Resume: a bill parsed in an earlier run only still needs inserting
+            if stage_reached(entry, "parsed") and entry["bill_json"]:
+                self.resumed += 1
+                return json.loads(entry["bill_json"])
+
+            if stage_reached(entry, "ocr") and entry["ocr_text"]:
+                self.resumed += 1
+                ocr_text = entry["ocr_text"]
+            else:
+                # A cached OCR result for the original image skips cleaning and OCR entirely
+                ocr_text = await loop.run_in_executor(None, _lookup_source_ocr, input_path)
+                if ocr_text:
+                    self.ocr_cache_hits += 1
+                else:
+                    if not (stage_reached(entry, "cleaned") and os.path.exists(cleaned_path)):
+                        record = await self._timed("clean", pools["clean"], clean_image_file_with_plan, input_path, cleaned_path)
+                        if not record:
+                            await self._record_error(filename, "cleaning failed")
+                            return None
+                        self.preprocessing[filename] = record
+                        await self._record(filename, "cleaned")
+
+                    ocr_text = await self._timed("ocr", pools["ocr"], perform_ocr_on_image_path, cleaned_path)
+                    if not ocr_text:
+                        logger.warning("Failed to extract text (OCR) from %s", filename)
+                        await self._record_error(filename, "no OCR text")
+                        return None
+                    await loop.run_in_executor(None, _store_source_ocr, input_path, ocr_text)
+                await self._record(filename, "ocr", ocr_text=ocr_text)
+
+            single = None
+            if self.extraction_mode == "single":
+                async with limits["extract"]:
+                    single = await self._timed("extract", pools["llm"], extract_single_pass, ocr_text, filename, self.use_extraction_cache)
+
+            if single:
+                structured_data_dict, category_labels = single
+            else:
+                # Two-call mode, or the fallback when the single-pass call failed
+                async with limits["extract"]:
+                    structured_data_dict = await self._timed("extract", pools["llm"], get_json_from_prompt, ocr_text, self.use_extraction_cache)
+                if not structured_data_dict:
+                    logger.warning("Failed to extract data for %s", filename)
+                    await self._record_error(filename, "extraction failed")
+                    return None
+
+                descriptions = get_descriptions_for_categorization(structured_data_dict)
+                category_labels = await self._category_batcher.categorize(descriptions)
+
+            bill = build_structured_bill(structured_data_dict, category_labels, filename)
+            await self._record(filename, "parsed", bill=bill)
+            return bill
+
+        except Exception as e:
+            logger.error("Error processing %s: %s", filename, e)
+            await self._record_error(filename, str(e))
+            return None
+
+    def _insert_batch(self, insert, bills: list[dict]):
+        try:
+            committed = insert(bills)
+        except Exception as e:
+            logger.error("Inserting %d bills failed: %s", len(bills), e)
+            committed = []
+        self.inserted += len(committed)
+        self.mark_inserted(bills, committed)
+
+    async def run_async(self, input_paths: list[str], output_folder: str, insert=None) -> list[dict]:
+        limits = {
+            "extract": asyncio.Semaphore(self.extract_concurrency),
+            "categorize": asyncio.Semaphore(self.categorize_concurrency),
+        }
+        admitted = asyncio.Semaphore(self.max_in_flight)
+        loop = asyncio.get_running_loop()
+        results = {}  # input index -> bill, when there is no insert callable
+        ready = []  # finished bills waiting for the next insert batch
+        tasks, inserts = set(), []
+
+        def flush():
+            batch = ready[:]
+            ready.clear()
+            inserts.append(loop.run_in_executor(insert_pool, self._insert_batch, insert, batch))
+
+        async def process(index: int, path: str):
+            try:
+                bill = await self._process_bill(path, os.path.join(output_folder, os.path.basename(path)),
+                                                pools, limits)
+            finally:
+                admitted.release()
+            if not bill:
+                # Failed bills must not block a later, better photo of the same bill
+                if self.duplicate_index is not None:
+                    self.duplicate_index.release(os.path.basename(path))
+                return
+            self.parsed += 1
+            if insert is None:
+                results[index] = bill
+                return
+            ready.append(bill)
+            if len(ready) >= self.insert_batch_size:
+                flush()
+
+        # One writer thread: insert batches commit one after another, in completion order
+        with ProcessPoolExecutor(self.clean_workers) as clean_pool, \
+                ThreadPoolExecutor(self.ocr_workers) as ocr_pool, \
+                ThreadPoolExecutor(self.extract_concurrency + self.categorize_concurrency) as llm_pool, \
+                ThreadPoolExecutor(1, thread_name_prefix="insert") as insert_pool:
+            pools = {"clean": clean_pool, "ocr": ocr_pool, "llm": llm_pool}
+            self._category_batcher = CategoryBatcher(self, llm_pool, limits["categorize"])
+            for index, path in enumerate(input_paths):
+                await admitted.acquire()
+                task = asyncio.ensure_future(process(index, path))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+            if ready:
+                flush()
+            await asyncio.gather(*inserts)
+        return [results[index] for index in sorted(results)]
+
+    def run(self, input_folder: str, output_folder: str, min_age: float = 0.0,
+            retry_failed: bool = True, insert=None) -> list[dict]:
+        """
+        Processes the images in input_folder and returns the structured bills.
+        With a manifest, unchanged images already inserted are skipped; min_age skips
+        images modified in the last few seconds (possibly still being copied) and
+        retry_failed=False skips unchanged images that failed before.
+        insert: callable that writes a list of bills and returns the ones committed
+            (data_insertion.commit_bills). Bills are then handed to it in batches of
+            insert_batch_size as they finish and marked inserted per batch, and nothing
+            is returned; self.parsed and self.inserted count them.
+        """
+        os.makedirs(output_folder, exist_ok=True)
+        input_paths = [
+            os.path.join(input_folder, filename)
+            for filename in sorted(os.listdir(input_folder))
+            if filename.lower().endswith(VALID_EXTENSIONS)
+        ]
+        if self.manifest:
+            total = len(input_paths)
+            input_paths = [path for path, _ in self.manifest.pending(input_paths, min_age, retry_failed)]
+            logger.info("Manifest: %d of %d images new, changed or unfinished", len(input_paths), total)
+        if not input_paths:
+            return []
+        logger.info("Total bills to process: %d", len(input_paths))
+
+        started = time.perf_counter()
+        bills = asyncio.run(self.run_async(input_paths, output_folder, insert))
+        elapsed = time.perf_counter() - started
+        logger.info("Pipeline finished: %d/%d bills in %.2fs (%d served from the OCR cache, %d resumed, "
+                    "%d duplicates skipped)",
+                    self.parsed, len(input_paths), elapsed, self.ocr_cache_hits, self.resumed, len(self.duplicates))
+        return bills
+
+    def mark_inserted(self, bills: list[dict], committed: list[dict]):
+        """
+        Records the bills commit_bills committed as done in the manifest, and stores their
+        image hashes for duplicate detection. The other bills keep their last stage with an
+        error, so the next run retries them, and their image reservations are released.
+        """
+        committed_files = {bill["source_file"] for bill in committed}
+        if self.manifest:
+            for bill in bills:
+                if bill["source_file"] in committed_files:
+                    self.manifest.record(bill["source_file"], "inserted")
+                else:
+                    self.manifest.record_error(bill["source_file"], "not inserted into the database")
+        if self.duplicate_index is not None:
+            for bill in bills:
+                if bill["source_file"] in committed_files:
+                    self.duplicate_index.confirm(bill["source_file"])
+                else:
+                    # Not in the database: a later photo of the bill must not be rejected
+                    self.duplicate_index.release(bill["source_file"])
+
+    def release_reservations(self, bills: list[dict]):
+        """Forgets the image hashes of parsed bills that were not inserted."""
+        if self.duplicate_index is not None:
+            for bill in bills:
+                self.duplicate_index.release(bill["source_file"])
+
+    def report(self) -> list[dict]:
+        """Returns per-stage throughput numbers for the last run."""
+        return [self.stats[name].as_dict() for name in STAGES]
+
+    def preprocessing_report(self) -> list[dict]:
+        """Groups the cleaned images of the last run by preprocessing plan."""
+        groups = {}
+        for record in self.preprocessing.values():
+            group = groups.setdefault(describe_plan(record["plan"]), {"images": 0, "seconds": 0.0})
+            group["images"] += 1
+            group["seconds"] += record["total_seconds"]
+        return [
+            {"plan": plan, "images": group["images"], "avg_seconds": round(group["seconds"] / group["images"], 4)}
+            for plan, group in sorted(groups.items(), key=lambda item: -item[1]["images"])
+        ]
+
+
+if __name__ == "__main__":
+    import argparse
+    from data_insertion import commit_bills
+    from metrics import configure_logging, metrics
+
+    arg_parser = argparse.ArgumentParser(description="Pipelined batch ingestion of bill images")
+    arg_parser.add_argument("--input", default=input_folder)
+    arg_parser.add_argument("--output", default=output_folder)
+    arg_parser.add_argument("--clean-workers", type=int, default=None)
+    arg_parser.add_argument("--ocr-workers", type=int, default=None)
+    arg_parser.add_argument("--extract-concurrency", type=int, default=4)
+    arg_parser.add_argument("--categorize-concurrency", type=int, default=4)
+    arg_parser.add_argument("--max-in-flight", type=int, default=None,
+                            help="Images admitted into the pipeline at the same time")
+    arg_parser.add_argument("--insert-batch", type=int, default=20,
+                            help="Finished bills inserted per database batch, while the rest are still processed")
+    arg_parser.add_argument("--fresh-extraction", action="store_true", help="Bypass the extraction cache")
+    arg_parser.add_argument("--extraction-mode", choices=["single", "two-call"], default=None,
+                            help="One LLM call per bill, or extraction + categorization (default: BILL_EXTRACTION_MODE)")
+    arg_parser.add_argument("--no-insert", action="store_true", help="Print the parsed bills as JSON instead of inserting them")
+    arg_parser.add_argument("--metrics-out", help="Write metrics to this file (.prom for Prometheus text, JSON otherwise)")
+    arg_parser.add_argument("--log-level", default=None, help="e.g. DEBUG to log raw OCR text and LLM output")
+    arg_parser.add_argument("--full", action="store_true", help="Ignore the manifest and process every image")
+    arg_parser.add_argument("--allow-duplicates", action="store_true",
+                            help="Process images that look like a bill already ingested under another name")
+    arg_parser.add_argument("--watch", action="store_true", help="Keep polling the input folder for new or changed images")
+    arg_parser.add_argument("--interval", type=float, default=10.0, help="Seconds between polls in --watch mode")
+    arg_parser.add_argument("--settle", type=float, default=2.0,
+                            help="In --watch mode, skip images modified less than this many seconds ago")
+    args = arg_parser.parse_args()
+    if args.watch and args.full:
+        arg_parser.error("--watch relies on the manifest and cannot be combined with --full")
+    configure_logging(args.log_level)
+
+    manifest = None if args.full else IngestManifest()
+    duplicate_index = None if args.allow_duplicates else DuplicateIndex()
+
+    def ingest_once(min_age: float = 0.0, retry_failed: bool = True):
+        pipeline = BatchPipeline(args.clean_workers, args.ocr_workers,
+                                 args.extract_concurrency, args.categorize_concurrency,
+                                 use_extraction_cache=not args.fresh_extraction,
+                                 manifest=manifest, extraction_mode=args.extraction_mode,
+                                 duplicate_index=duplicate_index, max_in_flight=args.max_in_flight,
+                                 insert_batch_size=args.insert_batch)
+        if args.no_insert:
+            all_bill_data = pipeline.run(args.input, args.output, min_age, retry_failed)
+            if all_bill_data:
+                print(json.dumps(all_bill_data, indent=2, ensure_ascii=False))
+            pipeline.release_reservations(all_bill_data)
+        else:
+            pipeline.run(args.input, args.output, min_age, retry_failed, insert=commit_bills)
+            if pipeline.parsed:
+                print(f"data insertion for {pipeline.inserted} of {pipeline.parsed} bills completed")
+        return pipeline
+
+    if args.watch:
+        logger.info("Watching %s every %.0fs (Ctrl+C to stop)", args.input, args.interval)
+        try:
+            # Failed images are retried at startup and when they change, not on every poll
+            ingest_once(args.settle)
+            while True:
+                time.sleep(args.interval)
+                ingest_once(args.settle, retry_failed=False)
+                if args.metrics_out:
+                    metrics.write(args.metrics_out)
+        except KeyboardInterrupt:
+            pass
+    else:
+        pipeline = ingest_once()
+        for stage in pipeline.report():
+            print(stage)
+        for plan in pipeline.preprocessing_report():
+            print(plan)
+        for filename, duplicate in pipeline.duplicates.items():
+            print(f"{filename}: skipped, duplicate of {duplicate['duplicate_of']} ({duplicate['distance']} bits apart)")
+        if manifest:
+            print(manifest.summary())
+        if args.metrics_out:
+            metrics.write(args.metrics_out)
@@ -1,4 +1,5 @@
 import json
+from prompt2 import categories
 
 #Define the precise schema for the extracted invoice data
 JSON_SCHEMA = {
@@ -11,27 +12,87 @@ JSON_SCHEMA = {
     "grand_total": "The total amount in the bill (must be a single number, float or integer)."
 }
 
-def data_conversion(extracted_text: str) -> str:
-    schema_string = json.dumps(JSON_SCHEMA, indent=2)
-    
-    return f"""
+def _split_template(template: str) -> tuple[str, str]:
+    """Splits a prompt at its {extracted_text} slot, so a call only concatenates the OCR text."""
+    head, _, tail = template.partition("{extracted_text}")
+    return head, tail
+
+
+# Built once at import: the schema is serialized here, not on every call
+_EXTRACTION_HEAD, _EXTRACTION_TAIL = _split_template(f"""
 You are an expert in data extraction bot. Your sole task is to analyze the raw data from OCR text
 from a single invoice and convert it into a valid JSON object based on the required schema.
 
 #Required JSON SCHEMA
-{schema_string}
+{json.dumps(JSON_SCHEMA, indent=2)}
 
 #Extraction Instructions:
 - **STRICTLY:** Return only valid JSON Object
 
 -----
 Raw Invoice text to analyze:
-{extracted_text}
+{{extracted_text}}
 
 Return only valid JSON Object
 
 -----
-"""
+""")
+
+
+def data_conversion(extracted_text: str) -> str:
+    return _EXTRACTION_HEAD + extracted_text + _EXTRACTION_TAIL
+
+# Single-pass mode: extraction and categorization in one call. Passed to Ollama as
+# `format`, so decoding is constrained to this JSON schema and the output parses directly.
+SINGLE_PASS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "invoice_no": {"type": "string"},
+        "issue_date": {"type": "string"},
+        "billed_to": {"type": "string"},
+        "billed_by": {"type": "string"},
+        "line_items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "description": {"type": "string"},
+                    "amount": {"type": "number"},
+                    "category": {"type": "string", "enum": categories},
+                },
+                "required": ["description", "amount", "category"],
+            },
+        },
+        "grand_total": {"type": "number"},
+    },
+    "required": ["invoice_no", "issue_date", "billed_to", "billed_by", "line_items", "grand_total"],
+}
+
+
+_SINGLE_PASS_HEAD, _SINGLE_PASS_TAIL = _split_template(f"""
+You are an expert in data extraction bot. Your sole task is to analyze the raw data from OCR text
+from a single invoice and convert it into a JSON object.
+
+#Fields:
+- invoice_no: The unique invoice identifier.
+- issue_date: The date the invoice was created (format: MM/DD/YYYY).
+- billed_to: Name of the company / person to whom the bill is charged.
+- billed_by: Name of the company who has issued the bill.
+- line_items: One entry per individual service, with its description, amount (number)
+  and category, which must be one of: {",".join(categories)}. If the description is vague or doesn't fit, choose "Other".
+- grand_total: The total amount in the bill (a single number).
+
+-----
+Raw Invoice text to analyze:
+{{extracted_text}}
+
+-----
+""")
+
+
+def data_conversion_with_categories(extracted_text: str) -> str:
+    return _SINGLE_PASS_HEAD + extracted_text + _SINGLE_PASS_TAIL
+
 
 # Backwards-compatible alias for existing imports using the misspelled name
 data_convertion = data_conversion
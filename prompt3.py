@@ -1,14 +1,15 @@
 def user_query(user_input:str) -> str:
     return f"""
 
-The data is stored in a SQLite database with one table. The table contains all the details about expense extracted from the bill. Calling that one table as report
+The data is stored in a SQLite database. The main table contains all the details about expense extracted from the bill. Calling that main table as report
 
 Table: ocr_line_items
 
 Below are the column labels in the table:
 -`Invoice_No`: Unique id number of each bill
 -`line_item_id`: Serial number for expense within the bill. A bill can have mulitple serial number
--`Issue_Date`: Date of issuing the bill and is usually stored in DD-MM-YYYY format
+-`Issue_Date`: Date of issuing the bill exactly as printed on the bill (free text, do not filter or sort on it)
+-`Issue_Date_ISO`: Date of issuing the bill in YYYY-MM-DD format. Use this column for every date filter, range, sort or grouping, e.g. `Issue_Date_ISO BETWEEN '2025-01-01' AND '2025-01-31'` or `strftime('%Y-%m', Issue_Date_ISO)`
 -`billed_to`: Bill created in the name of user or the purchaser
 -`billed_by`: Bill generated by the shop or from where it is purchased
 -`Description`: Description of the expense 
@@ -17,6 +18,24 @@ Below are the column labels in the table:
 -`Grand_Total`: Total Expense against the invoice_no
 -`source_file`: image_file id 
 
+Pre-aggregated summary tables (always up to date, much faster than aggregating ocr_line_items):
+
+Table: category_month_summary (one row per Category and month)
+-`Category`: expense category ('Uncategorized' when missing)
+-`month`: month of Issue_Date_ISO in YYYY-MM format ('unknown' when the date is missing)
+-`total_amount`: sum of Amount of the line items
+-`item_count`: number of line items
+
+Table: vendor_month_summary (one row per billed_by and month)
+-`billed_by`: shop / vendor ('Unknown' when missing)
+-`month`: month of Issue_Date_ISO in YYYY-MM format ('unknown' when the date is missing)
+-`total_amount`: sum of Amount of the line items
+-`item_count`: number of line items
+-`invoice_count`: number of bills
+-`grand_total`: sum of Grand_Total of the bills
+
+Prefer the summary tables for totals, counts or averages per category, vendor and/or month (for example total by category, spend per vendor per month). Use ocr_line_items when individual line items, descriptions or exact dates are needed.
+
 
 Use only valid SQLite syntax
 ---
@@ -0,0 +1,117 @@
+import hashlib
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+import pandas as pd
+from cache_store import SQLiteCache
+from metrics import span, timed
+from ollama3 import response_to_user_query, stream_user_query, extract_sql
+from ollama_client import get_client
+from prompt3 import user_query
+
+# Caches for the "Chat with your Expenses" panel:
+# - question -> generated SQL (persistent, invalidated when prompt3 or the model changes)
+# - SQL -> result rows (in memory, valid until the database changes)
+
+DB_NAME = "ocr_master.db"
+
+sql_cache = SQLiteCache("sql_cache", max_entries=5000)
+
+MAX_CACHED_RESULTS = 256
+_result_cache = OrderedDict()
+_result_lock = threading.Lock()
+
+# Long-lived reader connection: PRAGMA data_version only changes for commits
+# made by *other* connections, so it has to be read on the same connection each time
+_reader = None
+_reader_lock = threading.Lock()
+
+
+def normalize_question(question: str) -> str:
+    """Lower-cases, collapses whitespace and drops trailing punctuation."""
+    return " ".join(question.lower().split()).rstrip(" ?.!")
+
+
+def _sql_cache_key(question: str) -> str:
+    digest = hashlib.sha256(normalize_question(question).encode("utf-8"))
+    digest.update(hashlib.sha256(user_query("").encode("utf-8")).digest())
+    digest.update(get_client().model.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _reader_connection() -> sqlite3.Connection:
+    global _reader
+    if _reader is None:
+        _reader = sqlite3.connect(DB_NAME, check_same_thread=False)
+    return _reader
+
+
+def get_data_version() -> int:
+    """Changes whenever another connection commits a write to the database."""
+    with _reader_lock:
+        return _reader_connection().execute("PRAGMA data_version").fetchone()[0]
+
+
+@timed("sql_generation")
+def get_sql_for_question(question: str, on_token=None) -> tuple[str, bool]:
+    """
+    Returns (sql, served_from_cache).
+    on_token: optional callback(text_so_far); when given, a cache miss is streamed
+    and the callback is called with the partial answer as it arrives.
+    """
+    key = _sql_cache_key(question)
+    cached = sql_cache.get(key)
+    if cached is not None:
+        return cached, True
+
+    if on_token is None:
+        sql = response_to_user_query(question)
+    else:
+        output = ""
+        for chunk in stream_user_query(question):
+            output += chunk
+            on_token(output)
+        sql = extract_sql(output)
+    sql_cache.set(key, sql)
+    return sql, False
+
+
+def forget_question(question: str):
+    """Drops a cached SQL answer, e.g. after it failed to execute."""
+    sql_cache.delete(_sql_cache_key(question))
+
+
+def _is_read_only(sql: str) -> bool:
+    return re.match(r"\s*(SELECT|WITH|PRAGMA)\b", sql, re.IGNORECASE) is not None
+
+
+def run_query(sql: str) -> tuple[pd.DataFrame, bool]:
+    """
+    Runs the SQL on the shared reader connection.
+    Returns (result, served_from_cache); results are reused until the data version changes.
+    """
+    with _reader_lock:
+        con = _reader_connection()
+        version = con.execute("PRAGMA data_version").fetchone()[0]
+        key = (sql.strip(), version)
+
+        if _is_read_only(sql):
+            with _result_lock:
+                if key in _result_cache:
+                    _result_cache.move_to_end(key)
+                    return _result_cache[key].copy(), True
+
+        with span("sql_query"):
+            output = pd.read_sql_query(sql, con)
+
+    if _is_read_only(sql):
+        with _result_lock:
+            _result_cache[key] = output.copy()
+            # Entries for older data versions can never hit again
+            for old_key in [k for k in _result_cache if k[1] != version]:
+                del _result_cache[old_key]
+            while len(_result_cache) > MAX_CACHED_RESULTS:
+                _result_cache.popitem(last=False)
+    return output, False
+
@@ -1,4 +1,5 @@
 import sqlite3
+from db_schema import ensure_schema
 
 db_name  = "ocr_master.db"
 con = None
@@ -7,29 +8,13 @@ con = None
 try:
     # establishing connenction
     con = sqlite3.connect(db_name)
-    cur = con.cursor()
-
-
-    #creating table:
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS ocr_line_items ( 
-            Invoice_No TEXT NOT NULL,
-            line_item_id INTEGER NOT NULL,
-            Issue_Date TEXT,
-            billed_to TEXT,
-            billed_by TEXT,
-            Description TEXT,
-            Category TEXT,
-            Amount REAL,
-            Grand_Total REAL,
-            source_file TEXT, -- column name case for consistency
-            PRIMARY KEY (Invoice_No, line_item_id)
-        )
-    """)
+
+    #creating (or migrating) the invoices / line_items tables and the ocr_line_items view:
+    version = ensure_schema(con)
 
      #closing the connection
     con.commit()
-    print(f"table succeffully created")
+    print(f"table succeffully created (schema version {version})")
 
 except sqlite3.Error as e:
     print(f"error is {e}")
@@ -0,0 +1,158 @@
+import sqlite3
+
+import pytest
+
+from data_insertion import commit_bills, connect_db, insert_bills
+from db_schema import SCHEMA_VERSION, ensure_schema, get_schema_version, rebuild_summaries
+
+
+def _bill(invoice_no, items, billed_by="Cafe", date="2024-01-15", grand_total=None, source_file=None):
+    return {
+        "Invoice_No": invoice_no,
+        "Issue_Date": date,
+        "billed_to": "Me",
+        "billed_by": billed_by,
+        "Grand_Total": grand_total if grand_total is not None else sum(amount for _, _, amount in items),
+        "source_file": source_file or f"{invoice_no}.png",
+        "line_items": [
+            {"service_description": description, "Category": category, "Amount": amount}
+            for description, category, amount in items
+        ],
+    }
+
+
+def _summaries(con):
+    return (
+        sorted(con.execute("SELECT Category, month, ROUND(total_amount, 6), item_count FROM category_month_summary")),
+        sorted(con.execute(
+            "SELECT billed_by, month, ROUND(total_amount, 6), item_count, invoice_count, ROUND(grand_total, 6) "
+            "FROM vendor_month_summary"
+        )),
+    )
+
+
+def assert_summaries_match_rebuild(con):
+    maintained = _summaries(con)
+    con.execute("BEGIN")
+    rebuild_summaries(con)
+    rebuilt = _summaries(con)
+    con.execute("ROLLBACK")
+    assert maintained == rebuilt
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "bills.db")
+
+
+@pytest.fixture
+def con(db_path):
+    con = connect_db(db_path)
+    yield con
+    con.close()
+
+
+def test_new_database_is_at_current_version(con):
+    assert get_schema_version(con) == SCHEMA_VERSION
+
+
+def test_reinserted_bill_updates_line_items_and_drops_stale_ones(con):
+    insert_bills([_bill("1", [("Tea", "food", 20), ("Bus", "travel", 50), ("Cake", "food", 80)])], con=con)
+    insert_bills([_bill("1", [("Tea", "food", 25), ("Taxi", "travel", 300)])], con=con)
+
+    rows = con.execute("SELECT line_item_id, Description, Amount FROM line_items WHERE Invoice_No = '1' "
+                       "ORDER BY line_item_id").fetchall()
+    assert rows == [(1, "Tea", 25), (2, "Taxi", 300)]
+    assert_summaries_match_rebuild(con)
+
+
+def test_summaries_follow_inserts_overwrites_and_deletes(con):
+    insert_bills([
+        _bill("1", [("Tea", "food", 20), ("Bus", "travel", 50)]),
+        _bill("2", [("Rice", "food", 120)], billed_by="Mart", date="2024-02-03"),
+        _bill("3", [("Fuel", None, 900)], billed_by=None, date=None),
+    ], con=con)
+    assert_summaries_match_rebuild(con)
+
+    # Overwrite with another vendor, month and categories
+    insert_bills([_bill("1", [("Tea", "snacks", 30)], billed_by="Mart", date="2024-03-01")], con=con)
+    assert_summaries_match_rebuild(con)
+
+    con.execute("UPDATE line_items SET Category = 'groceries', Amount = 150 WHERE Invoice_No = '2'")
+    con.execute("UPDATE invoices SET Grand_Total = 999 WHERE Invoice_No = '3'")
+    assert_summaries_match_rebuild(con)
+
+    con.execute("DELETE FROM line_items WHERE Invoice_No = '3'")
+    con.execute("DELETE FROM invoices WHERE Invoice_No = '1'")
+    assert_summaries_match_rebuild(con)
+
+
+@pytest.mark.parametrize("recursive_triggers", ["OFF", "ON"])
+def test_replace_from_another_connection_keeps_summaries_exact(con, db_path, recursive_triggers):
+    insert_bills([_bill("1", [("Tea", "food", 20), ("Bus", "travel", 50)])], con=con)
+
+    other = sqlite3.connect(db_path, isolation_level=None)
+    other.execute(f"PRAGMA recursive_triggers={recursive_triggers}")
+    other.execute("INSERT OR REPLACE INTO line_items VALUES ('1', 1, 'Coffee', 'snacks', 35)")
+    other.execute("INSERT OR REPLACE INTO invoices (Invoice_No, billed_by, Grand_Total, Issue_Date_ISO) "
+                  "VALUES ('1', 'Mart', 85, '2024-04-02')")
+    other.execute("INSERT OR IGNORE INTO line_items VALUES ('1', 2, 'Train', 'travel', 70)")
+    other.execute("INSERT OR REPLACE INTO line_items VALUES ('1', 2, 'Train', 'travel', 70)")
+    other.close()
+
+    assert_summaries_match_rebuild(con)
+
+
+def test_legacy_single_table_database_migrates(db_path):
+    legacy = sqlite3.connect(db_path)
+    legacy.execute("""
+        CREATE TABLE ocr_line_items (
+            Invoice_No TEXT NOT NULL,
+            line_item_id INTEGER NOT NULL,
+            Issue_Date TEXT,
+            billed_to TEXT,
+            billed_by TEXT,
+            Description TEXT,
+            Category TEXT,
+            Amount REAL,
+            Grand_Total REAL,
+            source_file TEXT,
+            PRIMARY KEY (Invoice_No, line_item_id)
+        )
+    """)
+    legacy.executemany("INSERT INTO ocr_line_items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+        ("1", 1, "2024-01-15", "Me", "Cafe", "Tea", "food", 20, 70, "1.png"),
+        ("1", 2, "2024-01-15", "Me", "Cafe", "Bus", "travel", 50, 70, "1.png"),
+        ("2", 1, "2024-02-03", "Me", "Mart", "Rice", "food", 120, 120, "2.png"),
+    ])
+    legacy.commit()
+    legacy.close()
+
+    con = sqlite3.connect(db_path, isolation_level=None)
+    assert get_schema_version(con) == 1
+    assert ensure_schema(con) == SCHEMA_VERSION
+
+    assert con.execute("SELECT COUNT(*) FROM invoices").fetchone() == (2,)
+    assert con.execute("SELECT COUNT(*) FROM line_items").fetchone() == (3,)
+    assert con.execute("SELECT Issue_Date_ISO FROM invoices WHERE Invoice_No = '2'").fetchone() == ("2024-02-03",)
+    # The compatibility view still answers the old queries
+    assert con.execute("SELECT SUM(Amount) FROM ocr_line_items WHERE billed_by = 'Cafe'").fetchone() == (70,)
+    assert ("food", "2024-01", 20, 1) in _summaries(con)[0]
+    assert_summaries_match_rebuild(con)
+
+    # Old-style inserts into the view still land in both tables and the summaries
+    con.execute("INSERT INTO ocr_line_items (Invoice_No, line_item_id, Issue_Date, billed_by, Description, "
+                "Category, Amount, Grand_Total, source_file, Issue_Date_ISO) "
+                "VALUES ('2', 1, '2024-02-03', 'Mart', 'Rice', 'groceries', 130, 130, '2.png', '2024-02-03')")
+    assert_summaries_match_rebuild(con)
+    con.close()
+
+
+def test_commit_bills_leaves_out_skipped_bills(con):
+    bills = [
+        _bill(None, [("Tea", "food", 20)], source_file="a.png"),
+        _bill("5", [], source_file="b.png"),
+        _bill("6", [("Rice", "food", 120)], source_file="c.png"),
+    ]
+    committed = commit_bills(bills, con=con)
+    assert [bill["source_file"] for bill in committed] == ["c.png"]
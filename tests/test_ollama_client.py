@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from ollama_client import OllamaClient, OllamaError
+from ollama_stub_server import StubOllamaServer
+
+
+@pytest.fixture
+def stub():
+    with StubOllamaServer(lambda payload: f"echo {payload['prompt']}") as server:
+        yield server
+
+
+def test_generate_returns_response_text(stub):
+    client = OllamaClient(stub.url, model="test-model")
+    assert client.generate("hello") == "echo hello"
+
+
+def test_connections_are_reused(stub):
+    client = OllamaClient(stub.url, pool_size=2)
+    for i in range(5):
+        assert client.generate(f"call {i}") == f"echo call {i}"
+    assert stub.request_count == 5
+    assert stub.connection_count == 1
+
+
+def test_timeout_raises_ollama_error():
+    with StubOllamaServer(latency=1.0) as slow:
+        client = OllamaClient(slow.url, timeout=0.2)
+        started = time.perf_counter()
+        with pytest.raises(OllamaError):
+            client.generate("slow")
+        assert time.perf_counter() - started < 1.0
+
+
+def test_non_200_raises_ollama_error(stub):
+    client = OllamaClient(f"{stub.url}/missing")
+    with pytest.raises(OllamaError, match="404"):
+        client.generate("hello")
+    with pytest.raises(OllamaError, match="404"):
+        list(client.generate_stream("hello"))
+
+
+def test_stream_yields_chunks(stub):
+    client = OllamaClient(stub.url)
+    assert "".join(client.generate_stream("a b c")) == "echo a b c"
+
+
+def test_closing_stream_early_cancels_generation():
+    long_text = " ".join(f"token{i}" for i in range(200))
+    with StubOllamaServer(lambda payload: long_text, token_latency=0.01) as server:
+        client = OllamaClient(server.url, pool_size=1)
+        stream = client.generate_stream("long")
+        assert next(stream) == "token0 "
+        stream.close()
+
+        # The server notices the dropped connection on its next write
+        deadline = time.time() + 5
+        while server.cancelled_count == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        assert server.cancelled_count == 1
+
+        # The pool slot was given back: the single-connection pool still serves calls
+        assert client.generate("after", timeout=2) == long_text
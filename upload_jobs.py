@@ -0,0 +1,224 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cache_store import CACHE_DB
+from image_cleaning import clean_image_array_with_plan, describe_plan
+from ocr_processor import perform_ocr_on_array, get_cached_source_ocr, cache_source_ocr
+from parser import parse_single_invoice_text
+from duplicate_index import DuplicateIndex
+from metrics import inc
+
+# Background processing of bills uploaded in the app: each upload becomes a row in the
+# upload_jobs table (status, stage, progress, result) and runs on a thread pool, so the
+# Streamlit script only submits and polls. Jobs are keyed by the image content, so a
+# rerun (or uploading the same image again) finds the existing job instead of reprocessing.
+# The job table lives in the cache database: progress updates written to ocr_master.db would
+# bump its data_version and drop the dashboard and chat caches on every poll.
+
+JOB_TABLE = "upload_jobs"
+
+UPLOAD_WORKERS = int(os.environ.get("BILL_UPLOAD_WORKERS", "2"))
+# Cleaned images kept in memory for the review display (most recently used first to stay)
+MAX_CLEANED_IMAGES = 8
+
+# queued -> running -> done | failed | duplicate; done -> saved once the bill is confirmed in the review editor
+ACTIVE_STATUSES = ("queued", "running")
+
+logger = logging.getLogger(__name__)
+
+
+class UploadJobQueue:
+    """
+    SQLite-backed job table plus a pool of worker threads that clean, OCR and parse uploads.
+    Cleaning and OCR release the GIL and the LLM calls wait on the network, so threads overlap.
+    Args:
+        workers: uploads processed at the same time (default: BILL_UPLOAD_WORKERS).
+        duplicate_index: DuplicateIndex; uploads that look like a bill already ingested stop
+            with status "duplicate" before cleaning (None processes every upload).
+    """
+
+    def __init__(self, workers: int | None = None, db_name: str = CACHE_DB,
+                 duplicate_index: DuplicateIndex | None = None):
+        self.workers = workers or UPLOAD_WORKERS
+        self.duplicate_index = duplicate_index
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(db_name, timeout=30, check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.row_factory = sqlite3.Row
+        self._con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {JOB_TABLE} (
+                job_id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                progress REAL NOT NULL DEFAULT 0,
+                preprocessing TEXT,
+                ocr_text TEXT,
+                result_json TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        # Jobs left active by a previous server process will never finish
+        self._con.execute(
+            f"UPDATE {JOB_TABLE} SET status = 'failed', error = 'Interrupted by an app restart' "
+            f"WHERE status IN ({','.join('?' * len(ACTIVE_STATUSES))})",
+            ACTIVE_STATUSES,
+        )
+        self._con.commit()
+
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="upload")
+        self._cleaned_images = OrderedDict()  # job_id -> cleaned image array, for display only (LRU)
+
+    # --- job table ---
+
+    def _update(self, job_id: str, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._con.execute(f"UPDATE {JOB_TABLE} SET {assignments} WHERE job_id = ?", [*fields.values(), job_id])
+            self._con.commit()
+
+    @staticmethod
+    def _as_job(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["bill"] = json.loads(job.pop("result_json")) if job["result_json"] else None
+        return job
+
+    def job(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._con.execute(f"SELECT * FROM {JOB_TABLE} WHERE job_id = ?", (job_id,)).fetchone()
+        return self._as_job(row) if row else None
+
+    def jobs(self, job_ids: list[str]) -> list[dict]:
+        """The given jobs, oldest first."""
+        if not job_ids:
+            return []
+        with self._lock:
+            rows = self._con.execute(
+                f"SELECT * FROM {JOB_TABLE} WHERE job_id IN ({','.join('?' * len(job_ids))}) ORDER BY created_at",
+                job_ids,
+            ).fetchall()
+        return [self._as_job(row) for row in rows]
+
+    def cleaned_image(self, job_id: str):
+        with self._lock:
+            if job_id not in self._cleaned_images:
+                return None
+            self._cleaned_images.move_to_end(job_id)
+            return self._cleaned_images[job_id]
+
+    def _keep_cleaned_image(self, job_id: str, cleaned_image):
+        with self._lock:
+            self._cleaned_images[job_id] = cleaned_image
+            self._cleaned_images.move_to_end(job_id)
+            while len(self._cleaned_images) > MAX_CLEANED_IMAGES:
+                self._cleaned_images.popitem(last=False)
+
+    def _drop_cleaned_image(self, job_id: str):
+        with self._lock:
+            self._cleaned_images.pop(job_id, None)
+
+    # --- submitting ---
+
+    def submit(self, filename: str, data: bytes, retry: bool = False, allow_duplicate: bool = False) -> str:
+        """
+        Queues an uploaded image and returns its job id. An image that already has a job
+        is not processed again; retry=True requeues a failed or duplicate one, and
+        allow_duplicate=True processes it even if it looks like a bill already ingested.
+        """
+        job_id = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        with self._lock:
+            row = self._con.execute(f"SELECT status FROM {JOB_TABLE} WHERE job_id = ?", (job_id,)).fetchone()
+            if row and not (retry and row["status"] in ("failed", "duplicate")):
+                return job_id
+            self._con.execute(
+                f"""
+                INSERT OR REPLACE INTO {JOB_TABLE}
+                (job_id, filename, status, stage, progress, created_at, updated_at)
+                VALUES (?, ?, 'queued', NULL, 0, ?, ?)
+                """,
+                (job_id, filename, now, now),
+            )
+            self._con.commit()
+        inc("upload_jobs", status="queued")
+        self._executor.submit(self._run, job_id, filename, data, allow_duplicate)
+        return job_id
+
+    def mark_saved(self, job_id: str):
+        self._update(job_id, status="saved")
+        self._drop_cleaned_image(job_id)
+        if self.duplicate_index is not None:
+            self.duplicate_index.confirm(job_id)  # only saved bills are stored for duplicate detection
+
+    # --- worker ---
+
+    def _fail(self, job_id: str, error: str, **fields):
+        logger.warning("Upload job %s failed: %s", job_id[:12], error)
+        inc("upload_jobs", status="failed")
+        self._drop_cleaned_image(job_id)
+        if self.duplicate_index is not None:
+            self.duplicate_index.release(job_id)
+        self._update(job_id, status="failed", error=error, **fields)
+
+    def _run(self, job_id: str, filename: str, data: bytes, allow_duplicate: bool = False):
+        try:
+            if self.duplicate_index is not None:
+                self._update(job_id, status="running", stage="dedup", progress=0.05)
+                # Reserved while processed and reviewed; stored by mark_saved
+                if allow_duplicate:
+                    self.duplicate_index.reserve(data, filename, job_id)
+                else:
+                    duplicate = self.duplicate_index.check(data, filename, same_file_is_duplicate=True, reserve_as=job_id)
+                    if duplicate:
+                        inc("upload_jobs", status="duplicate")
+                        state = "a bill that was already saved" if duplicate["stored"] else "a bill that is still being processed or reviewed"
+                        self._update(job_id, status="duplicate", stage=None, progress=1.0,
+                                     error=f"{filename} looks like {duplicate['duplicate_of']}, {state}.")
+                        return
+
+            self._update(job_id, status="running", stage="cleaning", progress=0.1)
+
+            # Same image seen before: reuse its OCR text and skip cleaning + OCR
+            ocr_text = get_cached_source_ocr(data)
+            if not ocr_text:
+                cleaned_image, preprocessing = clean_image_array_with_plan(data)
+                if cleaned_image is None:
+                    self._fail(job_id, f"Failed to clean image {filename}.")
+                    return
+                self._keep_cleaned_image(job_id, cleaned_image)
+                self._update(job_id, stage="ocr", progress=0.35,
+                             preprocessing=f"{describe_plan(preprocessing['plan'])} "
+                                           f"({preprocessing['total_seconds']:.2f}s)")
+
+                ocr_text = perform_ocr_on_array(cleaned_image)
+                if not ocr_text:
+                    self._fail(job_id, f"Failed to extract text (OCR) from {filename}.")
+                    return
+                cache_source_ocr(data, ocr_text)
+
+            self._update(job_id, stage="parsing", progress=0.6, ocr_text=ocr_text)
+            structured_bill_data = parse_single_invoice_text(ocr_text, filename)
+            if not structured_bill_data or not structured_bill_data.get("line_items"):
+                self._fail(job_id, f"Failed to parse structured data or no line items found from {filename}.")
+                return
+
+            self._update(job_id, status="done", stage=None, progress=1.0, error=None,
+                         result_json=json.dumps(structured_bill_data))
+            inc("upload_jobs", status="done")
+
+        except Exception as e:
+            logger.exception("Upload job for %s crashed", filename)
+            self._fail(job_id, f"An error occurred during bill processing: {e}")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._con.close()